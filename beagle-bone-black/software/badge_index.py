@@ -0,0 +1,262 @@
+#! /usr/bin/python
+
+"""
+The whole member roster for HardcodedRFIDs, so that badges can be checked
+while MakerManager cannot be reached, without parsing tens of thousands of
+badges out of the config.  The roster is compiled into a file of fixed width
+records sorted by badge, which is memory mapped and binary searched, so a
+lookup costs a few page reads however many badges there are, and the badges
+are never loaded into memory.
+
+The roster is a text file of one badge per line, followed by the state it
+calls for, separated by a comma or spaces, with # for comments:
+
+    # badge, state
+    8945884, active
+    9089706, error:maintenance
+    10216663
+
+Badges without a state get --state, active by default.  Compile it with:
+
+    badge_index.py compile roster.csv /var/lib/muther/badges.idx
+    badge_index.py lookup /var/lib/muther/badges.idx 8945884
+    badge_index.py info /var/lib/muther/badges.idx
+
+The compiled file is written next to the old one and renamed over it, and
+the interlock notices the new file at the next swipe, so the roster can be
+updated without a restart.
+
+The file is laid out as:
+
+    header (HEADER_SIZE bytes): magic, version, record size, how many
+        records there are, and the table of state names as JSON
+    records: RECORD, sorted by badge
+"""
+
+import mmap, os, sys, struct, json, logging
+
+from configuration import write_atomically
+
+MAGIC = "MBDX"
+VERSION = 1
+HEADER = struct.Struct("<4sHHI")
+HEADER_SIZE = 4096
+STATE_NAMES_OFFSET = HEADER.size
+
+#
+# the badge, padded with NULs, which keeps the padded badges in the same
+# order as the badges, and an index into the table of state names
+#
+KEY_WIDTH = 24
+RECORD = struct.Struct("<" + str(KEY_WIDTH) + "sH")
+
+class BadgeIndex(object):
+    """
+    Looks badges up in a compiled roster.  Before each lookup the file is
+    checked with os.stat(), and if it has been replaced the new one is
+    mapped in its place.  If the new one cannot be read, the old one is
+    kept.
+    """
+    def __init__(self, filename):
+        """
+        raises IOError, OSError or ValueError when the file cannot be used
+        """
+        self.filename = filename
+        self.mapped = self.open()
+
+    def open(self):
+        """
+        map the file in, returns (its identity, the map, how many records it
+        has, and its state names)
+        """
+        with open(self.filename, "rb") as index:
+            status = os.fstat(index.fileno())
+            if status.st_size < HEADER_SIZE:
+                raise ValueError(self.filename + ": not a badge index")
+            index_map = mmap.mmap(index.fileno(), 0,
+                    access=mmap.ACCESS_READ)
+        magic, version, record_size, count = HEADER.unpack_from(index_map, 0)
+        if magic != MAGIC or version != VERSION or \
+                record_size != RECORD.size:
+            raise ValueError(self.filename + ": not a version " +
+                    repr(VERSION) + " badge index")
+        if len(index_map) < HEADER_SIZE + count * RECORD.size:
+            raise ValueError(self.filename + ": cut short, it should have " +
+                    repr(count) + " badges")
+        table = index_map[STATE_NAMES_OFFSET:HEADER_SIZE].rstrip("\0")
+        state_names = [str(name) for name in json.loads(table or "[]")]
+        identity = (status.st_ino, status.st_mtime, status.st_size)
+        return identity, index_map, count, state_names
+
+    def refresh(self):
+        """
+        map the file in again if it has been replaced
+        """
+        log = logging.getLogger("BadgeIndex.refresh")
+        try:
+            status = os.stat(self.filename)
+        except OSError as error:
+            log.warning(self.filename + ": keeping the badges we have: " +
+                    repr(error))
+            return
+        if (status.st_ino, status.st_mtime, status.st_size) == \
+                self.mapped[0]:
+            return
+        try:
+            #
+            # the old map is unmapped once nothing refers to it
+            #
+            self.mapped = self.open()
+            log.info(self.filename + ": now has " + repr(self.mapped[2]) +
+                    " badges")
+        except (IOError, OSError, ValueError) as error:
+            log.error(self.filename + ": keeping the badges we have: " +
+                    repr(error))
+
+    def lookup(self, badge_id):
+        """
+        the state that badge_id calls for, or None if it is not in the roster
+        """
+        self.refresh()
+        identity, index_map, count, state_names = self.mapped
+        badge_id = str(badge_id)
+        if len(badge_id) > KEY_WIDTH:
+            return None
+        key = RECORD.pack(badge_id, 0)[:KEY_WIDTH]
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            offset = HEADER_SIZE + middle * RECORD.size
+            if index_map[offset:offset + KEY_WIDTH] < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low == count:
+            return None
+        found, code = RECORD.unpack_from(index_map,
+                HEADER_SIZE + low * RECORD.size)
+        if found != key:
+            return None
+        return state_names[code] if code < len(state_names) else None
+
+    def __len__(self):
+        return self.mapped[2]
+
+    def states(self):
+        """
+        how many badges call for each state
+        """
+        identity, index_map, count, state_names = self.mapped
+        counts = {}
+        for number in range(count):
+            code = RECORD.unpack_from(index_map,
+                    HEADER_SIZE + number * RECORD.size)[1]
+            counts[state_names[code]] = counts.get(state_names[code], 0) + 1
+        return counts
+
+def read_roster(lines, default_state="active"):
+    """
+    the (badge, state, line number) of each line of a roster, and what is
+    wrong with it
+    """
+    entries = []
+    problems = []
+    for number, line in enumerate(lines):
+        line = line.split("#")[0].replace(",", " ").split()
+        if not line:
+            continue
+        if len(line) > 2:
+            problems.append("line " + str(number + 1) + ": needs to be a " +
+                    "badge, and optionally a state")
+            continue
+        badge = line[0]
+        if len(badge) > KEY_WIDTH:
+            problems.append("line " + str(number + 1) + ": " + badge +
+                    ": badges can be at most " + str(KEY_WIDTH) +
+                    " characters")
+            continue
+        entries.append((badge, line[1] if len(line) > 1 else default_state,
+                number + 1))
+    return entries, problems
+
+def compile_roster(entries, filename, states=None):
+    """
+    Write the (badge, state, line) entries to filename as a badge index,
+    replacing it atomically.  states, if given, are the states that may be
+    called for.  Returns what was wrong, in which case nothing is written.
+    """
+    problems = []
+    seen = {}
+    for badge, state, line in entries:
+        if states != None and state not in states:
+            problems.append("line " + str(line) + ": " + state +
+                    ": is not a state")
+        if badge in seen and seen[badge][0] != state:
+            problems.append("line " + str(line) + ": " + badge +
+                    ": is also on line " + str(seen[badge][1]) + " as " +
+                    seen[badge][0])
+        seen.setdefault(badge, (state, line))
+
+    state_names = sorted(set([state for state, line in seen.values()]))
+    table = json.dumps(state_names)
+    if len(table) > HEADER_SIZE - STATE_NAMES_OFFSET:
+        problems.append("too many states")
+    if problems:
+        return problems
+
+    codes = {name: code for code, name in enumerate(state_names)}
+    records = [RECORD.pack(badge, codes[seen[badge][0]])
+            for badge in sorted(seen)]
+    header = HEADER.pack(MAGIC, VERSION, RECORD.size, len(records)) + table
+    write_atomically(filename,
+            header.ljust(HEADER_SIZE, "\0") + "".join(records))
+    return []
+
+def main(argv=None):
+    """
+    compile a roster, and look badges up in it
+    """
+    import argparse
+    parser = argparse.ArgumentParser(
+            description="compile a roster of badges for HardcodedRFIDs")
+    commands = parser.add_subparsers(dest="command")
+    command = commands.add_parser("compile",
+            help="compile a roster into a badge index")
+    command.add_argument("roster")
+    command.add_argument("index")
+    command.add_argument("--state", default="active",
+            help="the state of the badges that do not have one")
+    command = commands.add_parser("lookup", help="the state of badges")
+    command.add_argument("index")
+    command.add_argument("badges", nargs="+")
+    command = commands.add_parser("info",
+            help="how many badges call for each state")
+    command.add_argument("index")
+    arguments = parser.parse_args(argv)
+
+    if arguments.command == "compile":
+        from rfid_interlock import MessageTypes
+        with open(arguments.roster) as roster:
+            entries, problems = read_roster(roster, arguments.state)
+        problems += compile_roster(entries, arguments.index,
+                MessageTypes.ALL_STATES)
+        for problem in problems:
+            print >> sys.stderr, arguments.roster + ": " + problem
+        if problems:
+            return 1
+        print arguments.index + ": " + \
+                str(len(BadgeIndex(arguments.index))) + " badges"
+    elif arguments.command == "lookup":
+        index = BadgeIndex(arguments.index)
+        for badge in arguments.badges:
+            print badge, index.lookup(badge) or "-"
+    else:
+        index = BadgeIndex(arguments.index)
+        counts = index.states()
+        print arguments.index + ": " + str(len(index)) + " badges"
+        for state in sorted(counts):
+            print "%-20s %8d" % (state, counts[state])
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,42 +1,577 @@
 #! /usr/bin/python
 
-import json
+"""
+Reads and writes the configuration, /etc/muther.ini.
+
+The configuration can be checked against the schema below, with its defaults
+filled in, and saved as a snapshot before it is deployed:
+
+    configuration.py compile /etc/muther.ini
+
+which refuses a configuration with errors, and otherwise writes
+/etc/muther.ini.compiled.  read() loads the snapshot as it is when it was
+compiled from the configuration file as it is now, and otherwise reads the
+JSON and fills in the defaults itself.
+"""
+
+import json, os, sys, marshal, hashlib, logging
 
 configuration_filename = "/etc/muther.ini"
 
+#
+# the configuration is read before logging is set up
+#
+logging.getLogger("configuration").addHandler(logging.NullHandler())
+
+#
+# where the last read() found the configuration: "snapshot" or "json"
+#
+read_from = None
+
 def write(updated_config):
-    """ 
-    Write the configuration.  
+    """
+    Write the configuration.
     Pass in the entire configuration to be saved.
     """
     global configuration_filename
-    print "writing configuration_filename = " + configuration_filename
+    log = logging.getLogger("configuration.write")
+    log.info("writing configuration_filename = " + configuration_filename)
 
-    original_config =  json.loads(open(configuration_filename, "r").read())
+    original_config = read_json()
     config = dict(updated_config.items() + original_config.items())
     new_config_string = json.dumps(config, sort_keys=True, indent=4)
-    open(configuration_filename , "w").write(new_config_string)
+    write_atomically(configuration_filename, new_config_string)
 
 def read(field = None):
-    """ 
-    Read in the configuration.  
-    Pass in the fieldname of interest, otherwise the entire configuarion will 
+    """
+    Read in the configuration.
+    Pass in the fieldname of interest, otherwise the entire configuarion will
     be returned.
     """
-    global configuration_filename
-    print "reading configuration_filename = " + configuration_filename
+    global configuration_filename, read_from
+    log = logging.getLogger("configuration.read")
+    log.info("reading configuration_filename = " + configuration_filename)
 
-    config = json.loads(open(configuration_filename, "r").read())
+    source = open(configuration_filename, "r").read()
+    config = read_snapshot(snapshot_filename(), source)
+    if config != None:
+        read_from = "snapshot"
+    else:
+        read_from = "json"
+        config = json.loads(source)
+        try:
+            for error in check(config, fill_defaults=True, warn=False):
+                log.warning(error)
+        except Exception:
+            log.exception("cannot check " + configuration_filename +
+                    ", carrying on without its defaults")
     if field == None:
         return config
     else:
         return config[field] if field in config else None
 
+def read_json():
+    """
+    the configuration file as it is, without defaults
+    """
+    return json.loads(open(configuration_filename, "r").read())
+
 def use_file(filename):
-    """ 
-    Read in the configuration.  
-    Pass in the fieldname of interest, otherwise the entire configuarion will 
+    """
+    Read in the configuration.
+    Pass in the fieldname of interest, otherwise the entire configuarion will
     be returned.
     """
     global configuration_filename
     configuration_filename = filename
+
+def signature():
+    """
+    Something that changes whenever the configuration file does: its
+    modification time, size and inode.  None if the file cannot be found.
+    """
+    try:
+        status = os.stat(configuration_filename)
+    except OSError:
+        return None
+    return (status.st_mtime, status.st_size, status.st_ino)
+
+def write_atomically(filename, data):
+    """
+    write data to filename so that the file has either its old or its new
+    content, even if we crash along the way
+    """
+    temporary_filename = filename + ".tmp"
+    with open(temporary_filename, "w") as temporary:
+        temporary.write(data)
+        temporary.flush()
+        os.fsync(temporary.fileno())
+    os.rename(temporary_filename, filename)
+
+################################################################################
+#
+#  the snapshot
+#
+################################################################################
+
+SNAPSHOT_MAGIC = "MUTHERCF"
+
+#
+# change whenever the schema, or what is in the snapshot, changes, so that
+# snapshots from before are not used
+#
+SNAPSHOT_VERSION = 2
+
+def snapshot_filename():
+    """
+    where the snapshot of the configuration file is kept
+    """
+    return configuration_filename + ".compiled"
+
+def write_snapshot(filename, source, config):
+    """
+    save the checked config, with the hash of the source it came from
+    """
+    write_atomically(filename, marshal.dumps((SNAPSHOT_MAGIC,
+            SNAPSHOT_VERSION, tuple(sys.version_info[:2]),
+            hashlib.sha1(source).hexdigest(), config)))
+
+def read_snapshot(filename, source):
+    """
+    the config from the snapshot, or None if there is none, or it was compiled
+    from something other than source, by another version of this module, or
+    by another version of python whose marshal format might differ
+    """
+    log = logging.getLogger("configuration.read")
+    try:
+        with open(filename, "rb") as snapshot:
+            magic, version, python_version, source_hash, config = \
+                    marshal.loads(snapshot.read())
+    except IOError:
+        return None
+    except (EOFError, ValueError, TypeError) as error:
+        log.warning(filename + ": not a snapshot: " + repr(error))
+        return None
+
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION or \
+            python_version != tuple(sys.version_info[:2]):
+        log.warning(filename + ": from another version, compile it again")
+        return None
+    if source_hash != hashlib.sha1(source).hexdigest():
+        log.warning(filename + ": older than " + configuration_filename +
+                ", compile it again")
+        return None
+    return config
+
+def compile_file(filename, output_filename=None):
+    """
+    check the configuration file, and snapshot it with its defaults filled in,
+    returns the errors and warnings, the snapshot is not written if there are
+    any errors
+    """
+    source = open(filename, "r").read()
+    try:
+        config = json.loads(source)
+    except ValueError as error:
+        return ["error: " + filename + ": " + str(error)]
+    problems = check(config, fill_defaults=True)
+    if not [problem for problem in problems if problem.startswith("error")]:
+        write_snapshot(output_filename or filename + ".compiled", source,
+                config)
+    return problems
+
+################################################################################
+#
+#  the schema
+#
+################################################################################
+
+#
+# Each setting is (what it may be, its default).  What it may be is a tuple
+# of types, a list of the values it may have, a dictionary of the settings
+# inside it, or a function which returns what is wrong with a value.  A
+# default of None is none, REQUIRED means it must be there.
+#
+REQUIRED = "required"
+
+NUMBER = (int, long, float)
+INTEGER = (int, long)
+STRING = (unicode, str)
+BOOLEAN = (bool,)
+
+SETTINGS = {
+    "tool_id":                  (STRING + INTEGER, None),
+    "tool_desc":                (STRING, None),
+    "timeout":                  (NUMBER, 0),
+    "warning":                  (NUMBER, 0),
+    "init_timeout":             (NUMBER, 10),
+    "low_wakeup":               (BOOLEAN, False),
+    "runtime":                  (["threads", "reactor"], "threads"),
+    "executor_workers":         (INTEGER, 2),
+    "wakeup_report_seconds":    (NUMBER, 0),
+    "dispatch_report_seconds":  (NUMBER, 0),
+    "config_check_seconds":     (NUMBER, 0),
+    "log_queue":                (BOOLEAN, True),
+    "logging":                  ((dict,), None),
+    "plugins":                  ((dict,), {}),
+    "transitions":              ((dict,), {}),
+    "tools":                    ((dict,), None),
+    "error_log": ({
+        "capacity":             (INTEGER, 100),
+        "max_sources":          (INTEGER, 256)}, {}),
+    "metrics": ({
+        "address":              (STRING, "127.0.0.1"),
+        "port":                 (INTEGER, 9187)}, None),
+    "update_budget": ({
+        "seconds":              (NUMBER, .05),
+        "slow_after":           (INTEGER, 3),
+        "degrade":              (BOOLEAN, False),
+        "report_seconds":       (NUMBER, 0)}, {}),
+    "profiler": ({
+        "rate":                 (NUMBER, 100),
+        "directory":            (STRING, "/var/tmp")}, {}),
+    "state_journal": ({
+        "filename":             (STRING, REQUIRED),
+        "capacity":             (INTEGER, 65536)}, None),
+    "record": ({
+        "filename":             (STRING, REQUIRED)}, None)
+}
+
+#
+# every connection can have these, the budget has no defaults so that those
+# of the top level update_budget apply
+#
+CONNECTION_SETTINGS = {
+    "type":                     (STRING, REQUIRED),
+    "comment":                  (STRING, None),
+    "depends_on":               (STRING + (list,), None),
+    "init_timeout":             (NUMBER, None),
+    "update_budget": ({
+        "seconds":              (NUMBER, None),
+        "slow_after":           (INTEGER, None),
+        "degrade":              (BOOLEAN, None)}, None)
+}
+
+def lcd_message(value):
+    """
+    the lines of an LCD message
+    """
+    if type(value) != list or len(value) != 2 or \
+            [line for line in value
+                if not isinstance(line, STRING) or len(line) != 16]:
+        return "needs to be an array of 2 strings of 16 characters"
+
+def lcd_color(value):
+    """
+    the red, green and blue of an LCD's backlight
+    """
+    if type(value) != list or len(value) != 3 or \
+            [number for number in value
+                if type(number) not in NUMBER or number < 0 or number > 255]:
+        return "needs to be a tuple of 3 numbers between 0 and 255"
+
+def webservice_state(value):
+    """
+    what a webservice does in a state
+    """
+    if isinstance(value, STRING):
+        return None
+    if type(value) != dict or ("url" not in value and "endpoints" not in value):
+        return "needs to be a url, or a dictionary with a url or endpoints"
+
+def hardcoded_badges(value):
+    """
+    the badges that HardcodedRFIDs knows, each in one when clause
+    """
+    if type(value) != dict:
+        return "needs to be a dictionary of \"<state>:when\" to badges"
+    seen = {}
+    for when_clause, badges in value.items():
+        if when_clause.split(":")[-1] != "when" or type(badges) != list:
+            return when_clause + ": needs to be \"<state>:when\" and a list " + \
+                    "of badges"
+        for badge in badges:
+            if badge in seen:
+                return str(badge) + ": is in both " + seen[badge] + \
+                        " and " + when_clause
+            seen[badge] = when_clause
+
+    #
+    # the ranges, prefixes and facility codes must make sense, and must not
+    # overlap those of another state
+    #
+    from rfid_interlock import BadgeRules
+    problems = BadgeRules().compile([(badge, when_clause[:-len(":when")])
+            for when_clause, badges in sorted(value.items())
+            for badge in badges if BadgeRules.is_rule(badge)])
+    if problems:
+        return "; ".join(problems)
+
+DIGITAL_OUTPUTS = ["ON", "OFF", "BLINK", "SOS"]
+
+BADGE_READER_SETTINGS = {
+    "code_skip_chars":          (INTEGER, None),
+    "code_len":                 (INTEGER, None),
+    "code_base":                ([10, 16], 16)
+}
+
+#
+# for each connection type: its settings, what each of its states may be,
+# and the connection names it may have, None for any
+#
+CONNECTION_TYPES = {
+    "digital:output": ({
+            "on":               (["HIGH", "LOW"], "HIGH")},
+        (DIGITAL_OUTPUTS, {
+            "output":           (DIGITAL_OUTPUTS, REQUIRED),
+            "seconds":          (NUMBER, None)}),
+        None),
+    "stdio:output": ({}, None, None),
+    "lcd_p018:output": ({}, ({
+            "message":          (lcd_message, REQUIRED),
+            "color":            (lcd_color, REQUIRED),
+            "timeout":          (NUMBER, None)},),
+        ["i2c:0:0x38", "i2c:1:0x38"]),
+    "webservice:connection": ({
+            "timeout":          (NUMBER, 10),
+            "grace_seconds":    (NUMBER, 0),
+            "circuit_breaker": ({
+                "failures":     (INTEGER, 3),
+                "open_seconds": (NUMBER, 30)}, {}),
+            "heartbeat_monitor": ({
+                "url":          (STRING, None),
+                "endpoints":    ((dict,), None),
+                "interval":     (NUMBER, 30),
+                "timeout":      (NUMBER, 10),
+                "backoff_max":  (NUMBER, 300),
+                "recovery_probes": (INTEGER, 2),
+                "jitter":       (NUMBER, .1)}, None)},
+        (webservice_state,),
+        None),
+    "serial:badge_reader": (dict(BADGE_READER_SETTINGS,
+            baud=(INTEGER, REQUIRED)), None, None),
+    "stdio:badge_reader": (BADGE_READER_SETTINGS, None, ["stdin"]),
+    "input_event:badge_reader": (BADGE_READER_SETTINGS, None, None),
+    "analog:monitor": ({
+            "sample_seconds":   (NUMBER, .01),
+            "idle_sample_seconds": (NUMBER, None),
+            "energy": ({
+                "watts_full_scale": (NUMBER, REQUIRED),
+                "spindle_on":   (NUMBER, 0),
+                "block_size":   (INTEGER, 10)}, None)},
+        ({
+            "higher":           (NUMBER, None),
+            "lower":            (NUMBER, None)},),
+        ["AIN0", "AIN1", "AIN2", "AIN3", "AIN4", "AIN5", "AIN6"]),
+    "digital:monitor": ({}, (["FALLING", "RISING"],), None),
+    "internal:hardcoded_rfids": ({
+            "check_badge":      (hardcoded_badges, REQUIRED),
+            "badge_file":       (STRING, None)}, None, None),
+    "event_log:connection": ({
+            "journal":          (STRING, REQUIRED),
+            "url":              (STRING, REQUIRED),
+            "batch_size":       (INTEGER, 50),
+            "timeout":          (NUMBER, 10),
+            "backoff_max":      (NUMBER, 300),
+            "compact_bytes":    (INTEGER, 65536)}, None, None)
+}
+
+def check(config, fill_defaults=False, warn=True):
+    """
+    Returns what is wrong with config, each starting with "error: " or
+    "warning: ".  fill_defaults puts the default of every setting that is
+    missing into config, warn=False leaves out the warnings.
+    """
+    problems = []
+    plugins = config.get("plugins", {})
+    check_tool(config, "", plugins, problems, fill_defaults, warn)
+
+    #
+    # the tools get what they do not set from the top of the config, so
+    # the defaults are only filled in there
+    #
+    tools = config.get("tools")
+    if type(tools) == dict:
+        for name, tool_config in sorted(tools.items()):
+            if type(tool_config) != dict:
+                problems.append("error: tools: " + name + ": needs to be " +
+                        "a dictionary")
+            else:
+                check_tool(tool_config, "tools: " + name + ": ", plugins,
+                        problems, False, warn)
+    return problems
+
+def check_tool(config, prefix, plugins, problems, fill_defaults, warn):
+    """
+    check the settings and connections of a tool, or of the whole config
+    """
+    from rfid_interlock import MessageTypes
+
+    connections = [name for name, section in config.items()
+            if type(section) == dict and "type" in section]
+
+    check_settings(SETTINGS, config, prefix, problems, fill_defaults)
+    for name, value in sorted(config.items()):
+        if name in SETTINGS:
+            continue
+        elif name in connections:
+            check_connection(name, value, connections, plugins,
+                    MessageTypes.INTERLOCK_CLASS, problems, fill_defaults,
+                    warn, prefix)
+        elif warn:
+            problems.append("warning: " + prefix + name + ": not a " +
+                    "setting, or a connection")
+
+def check_connection(name, section, connections, plugins, states, problems,
+        fill_defaults, warn, prefix=""):
+    """
+    check one connection's section of the config
+    """
+    prefix = prefix + name + ": "
+    check_settings(CONNECTION_SETTINGS, section, prefix, problems,
+            fill_defaults)
+
+    depends_on = section.get("depends_on", [])
+    for dependency in [depends_on] if isinstance(depends_on, STRING) \
+            else depends_on:
+        if dependency not in connections:
+            problems.append("error: " + prefix + "depends_on: " +
+                    repr(dependency) + " is not a connection")
+
+    connection_type = section.get("type")
+    if not isinstance(connection_type, STRING) or connection_type in plugins:
+        return
+    if connection_type not in CONNECTION_TYPES:
+        problems.append("error: " + prefix + "type: " + repr(connection_type) +
+                " should be one of: " + ", ".join(sorted(
+                CONNECTION_TYPES.keys() + plugins.keys())))
+        return
+
+    settings, state_kinds, names = CONNECTION_TYPES[connection_type]
+    if names != None and name not in names:
+        problems.append("error: " + prefix + "should be: " + ", ".join(names))
+    check_settings(settings, section, prefix, problems, fill_defaults)
+    for key, value in sorted(section.items()):
+        if key in CONNECTION_SETTINGS or key in settings:
+            continue
+        elif key in states:
+            if state_kinds != None:
+                check_alternatives(state_kinds, value, prefix + key + ": ",
+                        problems, fill_defaults)
+        elif warn:
+            problems.append("warning: " + prefix + key + ": not a setting " +
+                    "or a state of " + connection_type)
+
+def check_settings(settings, section, prefix, problems, fill_defaults):
+    """
+    check that those which are required are there, fill in the defaults of
+    those which are not, and check the values of those which are
+    """
+    for name, (kinds, default) in sorted(settings.items()):
+        if name not in section:
+            if default == REQUIRED:
+                problems.append("error: " + prefix + name + ": missing")
+            elif default != None and fill_defaults:
+                section[name] = default if type(default) != dict else {}
+                if type(kinds) == dict:
+                    check_settings(kinds, section[name], prefix + name + ": ",
+                            problems, fill_defaults)
+        else:
+            check_setting(kinds, section[name], prefix + name + ": ",
+                    problems, fill_defaults)
+
+def check_alternatives(alternatives, value, prefix, problems, fill_defaults):
+    """
+    a value which may be any one of alternatives, when it is none of them the
+    problems are those of the dictionary for a dictionary, otherwise those of
+    the first
+    """
+    reported = None
+    for kinds in alternatives:
+        attempt = []
+        check_setting(kinds, value, prefix, attempt, fill_defaults)
+        if not attempt:
+            return
+        if reported == None or \
+                (type(kinds) == dict and type(value) == dict):
+            reported = attempt
+    problems.extend(reported)
+
+def check_setting(kinds, value, prefix, problems, fill_defaults):
+    """
+    check one value against what it may be
+    """
+    if type(kinds) == tuple:
+        if not isinstance(value, kinds) or \
+                (isinstance(value, bool) and bool not in kinds):
+            problems.append("error: " + prefix + repr(value) +
+                    " needs to be " + " or ".join(sorted(set(
+                    [KIND_NAMES.get(kind, kind.__name__) for kind in kinds]))))
+    elif type(kinds) == list:
+        if value not in kinds:
+            problems.append("error: " + prefix + repr(value) +
+                    " should be one of: " + ", ".join([
+                    str(kind) for kind in kinds]))
+    elif type(kinds) == dict:
+        if type(value) != dict:
+            problems.append("error: " + prefix + "needs to be a dictionary")
+        else:
+            check_settings(kinds, value, prefix, problems, fill_defaults)
+    else:
+        error = kinds(value)
+        if error != None:
+            problems.append("error: " + prefix + error)
+
+KIND_NAMES = {int: "an int", long: "an int", float: "a float",
+        unicode: "a string", str: "a string", bool: "true or false",
+        dict: "a dictionary", list: "a list"}
+
+################################################################################
+#
+#  command line
+#
+################################################################################
+
+def main(argv=None):
+    """
+    check, compile or show the configuration from the command line
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description="check and compile the " +
+            "configuration before it is deployed")
+    parser.add_argument("command", choices=["check", "compile", "show"],
+            help="check: only look for problems, compile: snapshot it too, " +
+            "show: print the configuration that the daemon would use")
+    parser.add_argument("filename", nargs="?", default=configuration_filename)
+    parser.add_argument("--output", help="where the snapshot is written, " +
+            "the filename followed by .compiled")
+    arguments = parser.parse_args(argv)
+
+    if arguments.command == "show":
+        use_file(arguments.filename)
+        config = read()
+        print json.dumps(config, sort_keys=True, indent=4)
+        print >> sys.stderr, "from the " + read_from
+        return 0
+
+    if arguments.command == "compile":
+        problems = compile_file(arguments.filename, arguments.output)
+    else:
+        try:
+            problems = check(json.loads(open(arguments.filename).read()))
+        except ValueError as error:
+            problems = ["error: " + arguments.filename + ": " + str(error)]
+    for problem in problems:
+        print >> sys.stderr, problem
+    errors = [problem for problem in problems if problem.startswith("error")]
+    if errors:
+        print >> sys.stderr, repr(len(errors)) + " errors" + \
+                (", not compiled" if arguments.command == "compile" else "")
+        return 1
+    if arguments.command == "compile":
+        print >> sys.stderr, "wrote " + (arguments.output or
+                arguments.filename + ".compiled")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,254 @@
+#! /usr/bin/python
+
+"""
+A durable queue for the events that we tell the server about, such as the end
+of a session, so that none are lost while the network is down.
+
+Events are appended to a journal file, one JSON object per line.  A writer
+thread commits whatever has been appended since its last commit with a single
+write and fsync (a group commit).  An uploader thread sends the committed
+events to the server in batches, retrying with backoff until the server
+accepts them, and remembers how far it got in "<journal>.offset".  Once enough
+of the journal has been uploaded it is compacted by rewriting only what is
+left.
+
+Events are sent at least once: a crash between an upload and saving the offset
+sends that batch again, so every event carries an "id" for the server to spot
+the repeats.
+"""
+
+import json, os, random, threading, time, uuid, logging, urllib2, httplib
+import socket
+
+from scheduler import WakeupEvent, wakeups
+from configuration import write_atomically
+
+class EventJournal(object):
+    """
+    append() events from any thread, start() the writer and uploader.
+    """
+    def __init__(self, filename, url, batch_size=50, timeout=10,
+            backoff_max=300, compact_bytes=65536):
+        """
+        filename: the journal, "<filename>.offset" is also written
+        url: where batches are POSTed, as a JSON list of events
+        batch_size: the most events in one POST
+        timeout: seconds to wait for the server
+        backoff_max: the longest wait between retries while the server is down
+        compact_bytes: compact once this much of the journal has been uploaded
+        """
+        self.filename = filename
+        self.offset_filename = filename + ".offset"
+        self.url = url
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.backoff_max = backoff_max
+        self.compact_bytes = compact_bytes
+
+        #
+        # pending is what has been appended but not yet committed, file_lock
+        # keeps the writer and the compaction out of each other's way
+        #
+        self.pending = []
+        self.pending_lock = threading.Lock()
+        self.file_lock = threading.Lock()
+        self.appended = WakeupEvent()
+        self.committed = WakeupEvent()
+        self.stopping = WakeupEvent()
+
+        self.recover()
+        self.journal = open(self.filename, "a")
+
+        self.writer = threading.Thread(target=self.write_loop,
+                name="EventJournal.writer")
+        self.writer.daemon = True
+        self.uploader = threading.Thread(target=self.upload_loop,
+                name="EventJournal.uploader")
+        self.uploader.daemon = True
+
+    def start(self):
+        """
+        start committing and uploading
+        """
+        self.writer.start()
+        self.uploader.start()
+
+    def stop(self):
+        """
+        commit whatever has been appended, and stop both threads, waiting for
+        an upload that is under way to finish
+        """
+        self.stopping.set()
+        self.appended.set()
+        self.committed.set()
+        self.writer.join(5)
+        self.uploader.join(self.timeout + 1)
+        for event in (self.appended, self.committed, self.stopping):
+            event.close()
+
+    def recover(self):
+        """
+        After a crash, the journal may end with half of an event, cut it off.
+        """
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename, "r+") as journal:
+            data = journal.read()
+            end = data.rfind("\n") + 1
+            if end != len(data):
+                journal.truncate(end)
+
+    def append(self, event):
+        """
+        queue up an event, it is committed to the journal shortly
+        """
+        event = dict(event)
+        event.setdefault("id", uuid.uuid4().hex)
+        event.setdefault("time", time.time())
+        line = json.dumps(event, sort_keys=True) + "\n"
+        with self.pending_lock:
+            self.pending.append(line)
+        self.appended.set()
+
+    def write_loop(self):
+        """
+        the writer thread: commit everything that was appended with one write
+        and one fsync
+        """
+        while True:
+            self.appended.wait()
+            self.appended.clear()
+            wakeups.tick("EventJournal.writer")
+            with self.pending_lock:
+                lines = self.pending
+                self.pending = []
+            if lines:
+                with self.file_lock:
+                    self.journal.write("".join(lines))
+                    self.journal.flush()
+                    os.fsync(self.journal.fileno())
+                self.committed.set()
+            if self.stopping.is_set():
+                with self.file_lock:
+                    self.journal.close()
+                return
+
+    def read_offset(self):
+        """
+        how far into the journal has been uploaded
+        """
+        try:
+            return int(open(self.offset_filename).read())
+        except (IOError, ValueError):
+            return 0
+
+    def write_offset(self, offset):
+        """
+        save how far into the journal has been uploaded, atomically
+        """
+        write_atomically(self.offset_filename, str(offset))
+
+    def read_batch(self, offset):
+        """
+        returns up to batch_size events from offset on, and the offset after
+        them
+        """
+        events = []
+        with open(self.filename) as journal:
+            journal.seek(offset)
+            while len(events) < self.batch_size:
+                line = journal.readline()
+                if not line.endswith("\n"):
+                    break
+                offset += len(line)
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    logging.getLogger("EventJournal.upload").error(
+                            "skipping " + repr(line))
+        return events, offset
+
+    def post(self, events):
+        """
+        send the events to the server, returns whether it accepted them
+        """
+        log = logging.getLogger("EventJournal.upload")
+        request = urllib2.Request(self.url, json.dumps(events),
+                {"Content-Type": "application/json"})
+        try:
+            urllib2.urlopen(request, timeout=self.timeout).read()
+            return True
+        except (urllib2.URLError, httplib.HTTPException, socket.timeout,
+                socket.error, ValueError) as error:
+            log.error("cannot upload " + repr(len(events)) + " events to " +
+                    self.url + ": " + repr(error))
+            return False
+
+    def upload_loop(self):
+        """
+        the uploader thread: send committed events in batches, back off while
+        the server is down, and compact the journal now and then
+        """
+        log = logging.getLogger("EventJournal.upload")
+        failures = 0
+        while not self.stopping.is_set():
+            self.committed.clear()
+            wakeups.tick("EventJournal.uploader")
+            try:
+                offset = self.read_offset()
+                events, next_offset = self.read_batch(offset)
+                if not events:
+                    self.committed.wait()
+                    continue
+
+                uploaded = self.post(events)
+                if uploaded:
+                    failures = 0
+                    self.write_offset(next_offset)
+                    if next_offset >= self.compact_bytes and \
+                            not self.stopping.is_set():
+                        self.compact()
+            except Exception:
+                #
+                # whatever went wrong, the uploader has to carry on, or the
+                # events would pile up until the daemon is restarted
+                #
+                log.exception("cannot upload, trying again later")
+                uploaded = False
+
+            if not uploaded:
+                failures += 1
+                seconds = min(self.backoff_max, 2.0 ** min(failures, 16))
+                self.stopping.wait(seconds / 2 +
+                        random.uniform(0, seconds / 2))
+
+    def compact(self):
+        """
+        rewrite the journal with only what has not been uploaded yet.
+
+        The offset is reset before the new journal replaces the old one, so a
+        crash in between sends some events twice rather than losing any.
+        """
+        log = logging.getLogger("EventJournal.compact")
+        with self.file_lock:
+            offset = self.read_offset()
+            with open(self.filename) as journal:
+                journal.seek(offset)
+                remaining = journal.read()
+            remaining = remaining[:remaining.rfind("\n") + 1]
+
+            compacted_filename = self.filename + ".compact"
+            with open(compacted_filename, "w") as compacted:
+                compacted.write(remaining)
+                compacted.flush()
+                os.fsync(compacted.fileno())
+            self.write_offset(0)
+            os.rename(compacted_filename, self.filename)
+            self.journal.close()
+            self.journal = open(self.filename, "a")
+        log.info("compacted " + self.filename + " from " +
+                repr(offset + len(remaining)) + " to " +
+                repr(len(remaining)) + " bytes")
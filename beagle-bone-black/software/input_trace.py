@@ -0,0 +1,799 @@
+#! /usr/bin/python
+
+"""
+Recordings of everything that the daemon reads, so that what happened on the
+shop floor can be played back at a desk.  With
+
+    "record": {"filename": "/var/tmp/muther.trace"}
+
+in the config, the daemon records every raw input with the monotonic time it
+came in: the bytes from the badge readers, the edges on the digital monitors'
+lines, the analog monitors' samples, and the webservice replies along with how
+long they took.  It records the transitions that it made as well, so that a
+replay can be checked against them.
+
+Replaying runs the real Interlocks from the config in the recording, with the
+hardware modules swapped for fakes that give back what was recorded: readers
+read the recorded bytes from pipes at the recorded times, the GPIO lines go up
+and down, the ADC reads the sample of the moment, and every url gets the reply
+that it got, after the same delay.  Then the transitions are compared:
+
+    input_trace.py summary /var/tmp/muther.trace
+    input_trace.py dump /var/tmp/muther.trace --kinds read,reply
+    input_trace.py replay /var/tmp/muther.trace
+    input_trace.py replay /var/tmp/muther.trace --speed 0 --output fast.trace
+    input_trace.py compare /var/tmp/muther.trace fast.trace
+
+--speed 0 replays as fast as possible, feeding the next input as soon as the
+interlock has settled down after the last one.  The timers still run on the
+clock, so the transitions that are made on a timer, such as inactive_soon or
+those of the heartbeat, are only compared when replaying in real time, at
+--speed 1.  The analog monitors take their samples on their own clock too, so
+when replaying faster they only see the samples of the moments that the other
+inputs were fed at.
+
+The file is laid out as:
+
+    header: magic, version, and the length of the config that follows as
+        JSON
+    records: RECORD, followed by its payload
+
+The first record of each channel, a reader, line, webservice or tool, names
+it, the rest refer to it by number.
+"""
+
+#
+# only what the daemon needs to record, it imports this module when it is
+# asked to; what replaying needs is imported when replaying
+#
+import struct, json, os, sys, time, threading, bisect, collections
+import fcntl, logging, stat
+
+from scheduler import monotonic
+
+MAGIC = "MTRC"
+VERSION = 1
+HEADER = struct.Struct("<4sHI")
+
+#
+# seconds since the recording started, kind, channel, length of the payload
+#
+RECORD = struct.Struct("<dBHH")
+SAMPLE = struct.Struct("<f")
+
+CHANNEL, READ, EDGE, ANALOG, REPLY, TRANSITION = range(6)
+KINDS = ["channel", "read", "edge", "analog", "reply", "transition"]
+
+#
+# what a transition's reaction time is measured from, the analog samples come
+# in all the time so they are left out
+#
+STIMULI = (READ, EDGE, REPLY)
+
+#
+# the sources of the transitions that are made on a timer, rather than
+# straight away because of an input
+#
+TIMED_SOURCES = ("Interlock.", "NetworkHeartbeatMonitor.")
+
+class TraceWriter(object):
+    """
+    Records inputs from any thread.  Records are buffered, and written out
+    whenever a transition is recorded, so that the file is up to date as of
+    the last transition.
+    """
+    def __init__(self, filename, config):
+        """
+        config is the daemon's whole config, which a replay runs with.  As it
+        holds the passwords, only we may read the recording.
+        """
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.channels = {}
+        descriptor = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                0600)
+        if stat.S_ISREG(os.fstat(descriptor).st_mode):
+            os.fchmod(descriptor, 0600)
+        self.file = os.fdopen(descriptor, "wb")
+        config_json = json.dumps(config, sort_keys=True)
+        self.file.write(HEADER.pack(MAGIC, VERSION, len(config_json)) +
+                config_json)
+        self.start = monotonic()
+
+    def write(self, kind, channel, payload):
+        """
+        add a record, returns when it happened, in seconds since the start
+        """
+        if isinstance(channel, unicode):
+            channel = channel.encode("utf-8")
+        with self.lock:
+            seconds = monotonic() - self.start
+            if self.file == None:
+                return seconds
+            try:
+                number = self.channels.get(channel)
+                if number == None:
+                    number = self.channels[channel] = len(self.channels)
+                    self.file.write(RECORD.pack(seconds, CHANNEL, number,
+                            len(channel)) + channel)
+                self.file.write(RECORD.pack(seconds, kind, number,
+                        len(payload)) + payload)
+                if kind == TRANSITION:
+                    self.file.flush()
+            except (IOError, OSError, struct.error) as error:
+                #
+                # a full disk must not take the interlock down with it
+                #
+                logging.getLogger("TraceWriter.write").error(
+                        self.filename + ": recording stopped: " + repr(error))
+                self.file = None
+        return seconds
+
+    def read(self, channel, data):
+        """
+        bytes read by a badge reader
+        """
+        self.write(READ, channel, data)
+
+    def edge(self, channel, level):
+        """
+        a digital line went up (1) or down (0)
+        """
+        self.write(EDGE, channel, "\x01" if level else "\x00")
+
+    def sample(self, channel, reading):
+        """
+        a reading from an analog line
+        """
+        self.write(ANALOG, channel, SAMPLE.pack(reading))
+
+    def reply(self, channel, url, reply, error, seconds):
+        """
+        what url replied, or the error, "http" or "url", that it failed with,
+        and how many seconds it took
+        """
+        self.write(REPLY, channel, json.dumps([url, reply, error, seconds]))
+
+    def transition(self, tool, state, source):
+        """
+        the state that a tool, None in a config without tools, went to
+        """
+        self.write(TRANSITION, tool or "", json.dumps([state, source]))
+
+    def close(self):
+        """
+        write out whatever is buffered, and stop recording
+        """
+        with self.lock:
+            if self.file != None:
+                self.file.close()
+                self.file = None
+
+def read_trace(filename):
+    """
+    Returns the config of a recording, and its records as a list of (seconds,
+    kind, channel, value) where value is the bytes read, the level of an edge,
+    the analog reading, (url, reply, error, seconds) for a reply, or (state,
+    source) for a transition.  A recording cut off part way through a record
+    ends at the record before.
+    """
+    with open(filename, "rb") as trace:
+        data = trace.read()
+    if len(data) < HEADER.size:
+        raise ValueError(filename + ": not a recording")
+    magic, version, config_length = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(filename + ": not a version " + repr(VERSION) +
+                " recording")
+    offset = HEADER.size + config_length
+    config = json.loads(data[HEADER.size:offset])
+
+    channels = {}
+    records = []
+    while offset + RECORD.size <= len(data):
+        seconds, kind, number, length = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        if offset + length > len(data):
+            break
+        payload = data[offset:offset + length]
+        offset += length
+        if kind == CHANNEL:
+            channels[number] = payload
+            continue
+        if kind == EDGE:
+            value = ord(payload)
+        elif kind == ANALOG:
+            value = SAMPLE.unpack(payload)[0]
+        elif kind in (REPLY, TRANSITION):
+            value = tuple(json.loads(payload))
+        else:
+            value = payload
+        records.append((seconds, kind, channels.get(number, "?"), value))
+    return config, records
+
+def transitions(records, timed=True):
+    """
+    The transitions in records as (tool, state, seconds, reaction, source),
+    reaction being how long after the last input it came.  timed=False leaves
+    out the ones which were made on a timer, by the Interlock or the
+    heartbeat.
+    """
+    found = []
+    last_input = 0.0
+    for seconds, kind, channel, value in records:
+        if kind in STIMULI:
+            last_input = seconds
+        elif kind == TRANSITION:
+            state, source = value
+            if timed or not (source or "").startswith(TIMED_SOURCES):
+                found.append((channel, state, seconds, seconds - last_input,
+                        source))
+    return found
+
+################################################################################
+#
+#  hardware that plays back a recording
+#
+################################################################################
+
+#
+# the key codes that InputEventStream turns into these characters
+#
+KEY_CODES = dict([(str(digit), digit + 1) for digit in range(1, 10)] +
+        [("0", 11), ("\n", 28)])
+InputEvent = collections.namedtuple("InputEvent", "type code value")
+
+def bytes_waiting(fd):
+    """
+    how much there is to read from a pipe
+    """
+    import termios
+    waiting = fcntl.ioctl(fd, termios.FIONREAD, "\0\0\0\0")
+    return struct.unpack("i", waiting)[0]
+
+class ReplayPipe(object):
+    """
+    A reader's device: what was read from it is written into a pipe at the
+    time it was read, and the reader reads it from there.  Works as a serial
+    port, as the evdev InputDevice of InputEventStream, and as stdin.
+    """
+    EV_KEY = 1
+
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        self.file = os.fdopen(self.read_fd, "rb", 0)
+        self.fd = self.read_fd
+
+    def feed(self, data):
+        os.write(self.write_fd, data)
+
+    def waiting(self):
+        return bytes_waiting(self.read_fd)
+
+    #
+    # as a serial port, or as stdin
+    #
+    def fileno(self):
+        return self.read_fd
+
+    def readline(self):
+        return self.file.readline()
+
+    def inWaiting(self):
+        return self.waiting()
+
+    def read(self, size=None):
+        #
+        # as an InputDevice, read() with no size gives the key presses
+        #
+        if size == None:
+            return self.key_presses(os.read(self.read_fd, 4096))
+        return os.read(self.read_fd, size)
+
+    def close(self):
+        pass
+
+    #
+    # as an InputDevice
+    #
+    def key_presses(self, characters):
+        return [InputEvent(self.EV_KEY, KEY_CODES[character], 1)
+                for character in characters if character in KEY_CODES]
+
+    def read_loop(self):
+        while True:
+            for event in self.key_presses(os.read(self.read_fd, 4096)):
+                yield event
+
+class ReplaySerial(object):
+    """
+    stands in for the serial module
+    """
+    def __init__(self, hardware):
+        self.hardware = hardware
+
+    def Serial(self, port, baud=None, **kwargs):
+        return self.hardware.pipe(port)
+
+class ReplayGPIO(object):
+    """
+    Stands in for Adafruit_BBIO.GPIO.  The input lines start out at the
+    opposite of their first recorded edge, outputs only remember what they
+    were set to.
+    """
+    IN, OUT = "in", "out"
+    LOW, HIGH = 0, 1
+    RISING, FALLING, BOTH = 1, 2, 3
+
+    def __init__(self, levels):
+        self.levels = dict(levels)
+        self.edges = collections.defaultdict(int)
+        self.callbacks = {}
+        self.changed = threading.Condition()
+
+    def setup(self, pin, direction, **kwargs):
+        self.levels.setdefault(pin, self.LOW)
+
+    def input(self, pin):
+        return self.levels.get(pin, self.LOW)
+
+    def output(self, pin, level):
+        self.levels[pin] = level
+
+    def wait_for_edge(self, pin, edge):
+        """
+        wait for the next edge of the kind, counting them so that one which
+        comes straight after another is not missed
+        """
+        level = self.HIGH if edge == self.RISING else self.LOW
+        with self.changed:
+            seen = self.edges[pin, level]
+            while self.edges[pin, level] == seen:
+                self.changed.wait()
+
+    def add_event_detect(self, pin, edge, callback=None):
+        self.callbacks[pin] = callback
+
+    def remove_event_detect(self, pin):
+        self.callbacks.pop(pin, None)
+
+    def set_level(self, pin, level):
+        """
+        the replay moves the line
+        """
+        with self.changed:
+            self.levels[pin] = level
+            self.edges[pin, level] += 1
+            self.changed.notify_all()
+        callback = self.callbacks.get(pin)
+        if callback != None:
+            callback(pin)
+
+class ReplayADC(object):
+    """
+    stands in for Adafruit_BBIO.ADC, each read gives the last sample that
+    was recorded before the replay's clock
+    """
+    def __init__(self, samples, clock):
+        self.samples = samples
+        self.clock = clock
+
+    def setup(self):
+        pass
+
+    def read(self, pin):
+        times, readings = self.samples.get(pin, ((), ()))
+        if not readings:
+            return 0.0
+        index = bisect.bisect_right(times, self.clock()) - 1
+        return readings[max(index, 0)]
+
+class ReplayURLs(object):
+    """
+    Stands in for urllib2: every url gets the replies that it got, in the
+    order that it got them, after as long as they took.  Once they run out
+    it keeps getting the last one, a url that was never asked for cannot be
+    reached.
+    """
+    def __init__(self, replies, speed):
+        import urllib2
+        self.HTTPError = urllib2.HTTPError
+        self.URLError = urllib2.URLError
+        self.replies = replies
+        self.speed = speed
+        self.lock = threading.Lock()
+        self.in_flight = 0
+
+    def urlopen(self, url, timeout=None):
+        import StringIO
+        with self.lock:
+            self.in_flight += 1
+            waiting = self.replies.get(url)
+            reply, error, seconds = waiting[0] if waiting else \
+                    (None, "url", 0)
+            if waiting and len(waiting) > 1:
+                waiting.popleft()
+        try:
+            if self.speed:
+                time.sleep(seconds / self.speed)
+            if error == "http":
+                raise self.HTTPError(url, 500, "replayed", None, None)
+            if error != None:
+                raise self.URLError("replayed")
+            return StringIO.StringIO(reply)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+class ReplayLCD(object):
+    """
+    stands in for lcd_i2c_p018, and for the lcd that it makes
+    """
+    def lcd(self, bus_number):
+        return self
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+class ReplayHardware(object):
+    """
+    The fakes for a recording, installed in place of the hardware modules of
+    rfid_interlock.
+    """
+    def __init__(self, records, speed, clock):
+        self.pipes = {}
+        levels = {}
+        samples = {}
+        replies = {}
+        for seconds, kind, channel, value in records:
+            if kind == READ:
+                self.pipe(channel)
+            elif kind == EDGE:
+                levels.setdefault(channel, 1 - value)
+            elif kind == ANALOG:
+                times, readings = samples.setdefault(channel, ([], []))
+                times.append(seconds)
+                readings.append(value)
+            elif kind == REPLY:
+                url, reply, error, took = value
+                replies.setdefault(url, collections.deque()).append(
+                        (reply, error, took))
+        self.gpio = ReplayGPIO(levels)
+        self.adc = ReplayADC(samples, clock)
+        self.urls = ReplayURLs(replies, speed)
+
+    def pipe(self, channel):
+        """
+        the pipe that a reader reads channel from
+        """
+        if channel not in self.pipes:
+            self.pipes[channel] = ReplayPipe()
+        return self.pipes[channel]
+
+    def install(self, module):
+        """
+        swap module's hardware modules for the fakes, and stdin for a pipe
+        """
+        module.serial = ReplaySerial(self)
+        module.InputDevice = self.pipe
+        module.ecodes = ReplayPipe
+        module.lcd_i2c_p018 = ReplayLCD()
+        module.urllib2 = self.urls
+        module.ADC = self.adc
+        module.GPIO = self.gpio
+        sys.stdin = self.pipe("stdin").file
+
+    def feed(self, kind, channel, value):
+        """
+        replay an input that the hardware pushes at us
+        """
+        if kind == READ:
+            self.pipe(channel).feed(value)
+        elif kind == EDGE:
+            self.gpio.set_level(channel, value)
+
+    def busy(self):
+        """
+        whether a reader has yet to read what it was fed, or a reply is on
+        its way
+        """
+        return self.urls.in_flight > 0 or \
+                [pipe for pipe in self.pipes.values() if pipe.waiting()]
+
+################################################################################
+#
+#  replaying
+#
+################################################################################
+
+class ReplayRecorder(TraceWriter):
+    """
+    records the replay, keeping the records for the comparison as well,
+    until it is closed
+    """
+    def __init__(self, filename, config):
+        TraceWriter.__init__(self, filename, config)
+        self.records = []
+        self.recording = True
+        self.last_write = monotonic()
+
+    def write(self, kind, channel, payload):
+        seconds = TraceWriter.write(self, kind, channel, payload)
+        if kind != ANALOG:
+            self.last_write = monotonic()
+        value = tuple(json.loads(payload)) if kind in (REPLY, TRANSITION) \
+                else None
+        if isinstance(channel, unicode):
+            channel = channel.encode("utf-8")
+        with self.lock:
+            if self.recording:
+                self.records.append((seconds, kind, channel, value))
+        return seconds
+
+    def close(self):
+        TraceWriter.close(self)
+        self.recording = False
+
+def replay_config(config):
+    """
+    the recorded config, without what would write files, serve metrics or
+    reload the config from /etc
+    """
+    import rfid_interlock
+    config = dict(config)
+    for setting in ("record", "metrics", "logging", "state_journal",
+            "config_check_seconds", "wakeup_report_seconds"):
+        config.pop(setting, None)
+
+    def without_event_logs(tool_config):
+        return dict([(name, value) for name, value in tool_config.items()
+                if not (type(value) == dict and
+                    value.get("type") == "event_log:connection")])
+
+    config = without_event_logs(config)
+    if type(config.get("tools")) == dict:
+        config["tools"] = dict([(name, without_event_logs(tool_config))
+                for name, tool_config in config["tools"].items()
+                if type(tool_config) == dict])
+    return config
+
+def replay(filename, speed=1.0, settle=.05, output=None):
+    """
+    Replay a recording, speed times faster than it happened, or as fast as
+    possible when speed is 0, waiting settle seconds after each input for
+    the interlock to quiet down.  Returns the recorded and replayed records.
+    """
+    import rfid_interlock
+    log = logging.getLogger("Replay.run")
+    recorded_config, recorded = read_trace(filename)
+    config = replay_config(recorded_config)
+
+    #
+    # the trace time that the replay has got to, for the ADC
+    #
+    clock = {"fed": 0.0}
+
+    def now():
+        if speed:
+            return (monotonic() - recorder.start) * speed
+        return clock["fed"]
+
+    hardware = ReplayHardware(recorded, speed, now)
+    hardware.install(rfid_interlock)
+
+    error_log = rfid_interlock.ErrorArrayHandler()
+    error_log.setLevel(logging.ERROR)
+    logging.getLogger().addHandler(error_log)
+
+    recorder = ReplayRecorder(output or os.devnull, config)
+    host = rfid_interlock.Host(config)
+    host.recorder = recorder
+    interlocks = [rfid_interlock.Interlock(tool_config, error_log, host,
+            tool_name)
+            for tool_name, tool_config in rfid_interlock.tool_configs(config)]
+    rfid_interlock.start_tools(interlocks, error_log)
+
+    def quiet():
+        """
+        wait until nothing has happened for settle seconds
+        """
+        give_up = monotonic() + 10
+        while monotonic() < give_up:
+            if not hardware.busy() and \
+                    not [interlock for interlock in interlocks
+                        if not interlock.action_queue.empty()] and \
+                    monotonic() - recorder.last_write >= settle:
+                return
+            time.sleep(settle / 5)
+        log.warning("still busy after 10 seconds, carrying on")
+
+    for seconds, kind, channel, value in recorded:
+        if kind not in (READ, EDGE):
+            continue
+        if speed:
+            delay = recorder.start + seconds / speed - monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        else:
+            quiet()
+            clock["fed"] = seconds
+        hardware.feed(kind, channel, value)
+
+    #
+    # in real time the replay ends where the recording did, otherwise once
+    # the last input has been dealt with
+    #
+    if speed:
+        end = recorded[-1][0] if recorded else 0
+        delay = recorder.start + end / speed - monotonic()
+        if delay > 0:
+            time.sleep(delay)
+    else:
+        quiet()
+    recorder.close()
+    return recorded, recorder.records
+
+################################################################################
+#
+#  comparing
+#
+################################################################################
+
+def percentiles(values):
+    """
+    the median, 99th percentile and most of values, in milliseconds
+    """
+    if not values:
+        return "-"
+    values = sorted(values)
+    return "/".join(["{0:.1f}".format(value * 1000) for value in
+            (values[len(values) / 2], values[int(len(values) * .99)],
+            values[-1])])
+
+def compare(recorded, replayed, timed=True, show=20, out=sys.stdout):
+    """
+    Print how the transitions of a replay line up with those recorded, and
+    how the reaction times differ.  Returns whether the same transitions
+    were made.
+    """
+    import difflib
+    expected = transitions(recorded, timed)
+    got = transitions(replayed, timed)
+    matcher = difflib.SequenceMatcher(None,
+            [(tool, state) for tool, state, _, _, _ in expected],
+            [(tool, state) for tool, state, _, _, _ in got], autojunk=False)
+
+    pairs = []
+    differences = []
+    for operation, start, end, got_start, got_end in matcher.get_opcodes():
+        if operation == "equal":
+            pairs.extend(zip(expected[start:end], got[got_start:got_end]))
+            continue
+        for tool, state, seconds, reaction, source in expected[start:end]:
+            differences.append((seconds, "missing", tool, state, source))
+        for tool, state, seconds, reaction, source in got[got_start:got_end]:
+            differences.append((seconds, "extra", tool, state, source))
+
+    print >> out, "transitions: {0} recorded, {1} replayed, {2} the same" \
+            .format(len(expected), len(got), len(pairs))
+    print >> out, "reaction ms (p50/p99/max): recorded {0}, replayed {1}" \
+            .format(percentiles([pair[0][3] for pair in pairs]),
+                    percentiles([pair[1][3] for pair in pairs]))
+    print >> out, "replayed - recorded ms (p50/p99/max): {0}".format(
+            percentiles([pair[1][3] - pair[0][3] for pair in pairs]))
+
+    by_state = {}
+    for before, after in pairs:
+        by_state.setdefault(before[1], []).append((before[3], after[3]))
+    for state in sorted(by_state):
+        reactions = by_state[state]
+        print >> out, "  {0:<20} {1:>5}  recorded {2:>8.1f} ms  " \
+                "replayed {3:>8.1f} ms".format(state, len(reactions),
+                1000 * sum([before for before, after in reactions]) /
+                    len(reactions),
+                1000 * sum([after for before, after in reactions]) /
+                    len(reactions))
+
+    for seconds, what, tool, state, source in sorted(differences)[:show]:
+        print >> out, "{0:>12.3f} {1:<8} {2}{3} from {4}".format(seconds, what,
+                tool + ": " if tool else "", state, source)
+    if len(differences) > show:
+        print >> out, "... and " + str(len(differences) - show) + " more"
+    return not differences
+
+################################################################################
+#
+#  command line
+#
+################################################################################
+
+def summary(config, records, out=sys.stdout):
+    """
+    how much of each kind of input each channel had
+    """
+    counts = collections.defaultdict(int)
+    for seconds, kind, channel, value in records:
+        counts[channel, KINDS[kind]] += 1
+    seconds = records[-1][0] if records else 0
+    print >> out, "{0} records over {1:.1f} seconds".format(len(records),
+            seconds)
+    for (channel, kind), count in sorted(counts.items()):
+        print >> out, "  {0:<12} {1:<24} {2:>9} {3:>9.2f}/s".format(kind,
+                channel or "(tool)", count, count / seconds if seconds else 0)
+
+def dump(records, kinds, out=sys.stdout):
+    """
+    every record, one per line
+    """
+    for seconds, kind, channel, value in records:
+        if kinds and KINDS[kind] not in kinds:
+            continue
+        print >> out, "{0:>12.6f} {1:<10} {2:<20} {3!r}".format(seconds,
+                KINDS[kind], channel, value)
+
+def main(argv=None):
+    """
+    look at, replay and compare recordings
+    """
+    import argparse
+    parser = argparse.ArgumentParser(
+            description="look at, replay and compare recordings of inputs")
+    commands = parser.add_subparsers(dest="command")
+    command = commands.add_parser("summary", help="the inputs by channel")
+    command.add_argument("trace")
+    command = commands.add_parser("dump", help="every record")
+    command.add_argument("trace")
+    command.add_argument("--kinds", default="",
+            help="only these, such as read,edge,analog,reply,transition")
+    command = commands.add_parser("replay",
+            help="replay through the Interlock, and compare the transitions")
+    command.add_argument("trace")
+    command.add_argument("--speed", type=float, default=1,
+            help="how many times faster than recorded, 0 for as fast as " +
+            "possible")
+    command.add_argument("--settle", type=float, default=.05,
+            help="how long the interlock has to be quiet for it to have " +
+            "settled down")
+    command.add_argument("--output", help="record the replay here")
+    command.add_argument("--show", type=int, default=20,
+            help="how many differences to list")
+    command = commands.add_parser("compare",
+            help="compare the transitions of two recordings")
+    command.add_argument("trace")
+    command.add_argument("other")
+    command.add_argument("--timers", action="store_true",
+            help="compare the transitions that the timers made too")
+    command.add_argument("--show", type=int, default=20,
+            help="how many differences to list")
+    arguments = parser.parse_args(argv)
+
+    if arguments.command == "summary":
+        summary(*read_trace(arguments.trace))
+    elif arguments.command == "dump":
+        dump(read_trace(arguments.trace)[1],
+                [kind for kind in arguments.kinds.split(",") if kind])
+    elif arguments.command == "compare":
+        same = compare(read_trace(arguments.trace)[1],
+                read_trace(arguments.other)[1], arguments.timers,
+                arguments.show)
+        return 0 if same else 1
+    else:
+        logging.basicConfig(level=logging.WARNING)
+        #
+        # the connections print as they are made
+        #
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        recorded, replayed = replay(arguments.trace, arguments.speed,
+                arguments.settle, arguments.output)
+        same = compare(recorded, replayed, arguments.speed == 1,
+                arguments.show, stdout)
+        stdout.flush()
+        #
+        # the readers' threads are still waiting on their pipes
+        #
+        os._exit(0 if same else 1)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
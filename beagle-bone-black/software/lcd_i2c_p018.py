@@ -13,6 +13,7 @@ class lcd:
 
     def __init__(self, i2c_bus = -1):
         self.device = i2c(0x38, i2c_bus)
+        self.retries = 0
 
     def show_rgb(self, message, rgb = None):
         if rgb <> self.previous_rgb and False:
@@ -41,6 +42,7 @@ class lcd:
                         time.sleep(self.wait)
                         break
                     except IOError as err:
+                        self.retries += 1
                         print chr(7) + "**** exception caught ****: " + repr(err)
                         time.sleep(self.wait)
                         pass
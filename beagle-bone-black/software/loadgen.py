@@ -0,0 +1,427 @@
+#! /usr/bin/python
+
+"""
+How many tools can MakerManager serve before swipes get slow?  Runs fleets of
+virtual interlocks against a stand-in MakerManager, and reports for each size
+of fleet how many requests the server saw, how long each tool waited for its
+swipes to be answered, and how much of the traffic was heartbeats:
+
+    loadgen.py --tools 10,50,100,200 --seconds 60 --swipes-per-hour 60
+
+Each fleet runs in a process of its own, sharing a Host like a multi-tool
+daemon does.  Every virtual interlock has a simulated badge reader, which
+swipes with the chosen arrival distribution, a webservice connection with a
+heartbeat, and a fake output which notes when each swipe was answered, so no
+hardware is needed.  The stand-in runs in this process and answers after
+--server-delay seconds, denying --deny of the badges.  --url points the
+fleets at another server instead, whose requests cannot then be counted.
+
+In the reactor runtime every tool adds a few pipes to the files that the
+Scheduler polls, so each fleet raises its limit on open files as far as it
+is allowed to.
+"""
+
+import sys, os, time, json, random, threading, subprocess, resource
+import BaseHTTPServer, SocketServer
+
+import rfid_interlock
+import metrics
+from rfid_interlock import Connection, MessageTypes, ActionMessage
+from scheduler import monotonic
+
+################################################################################
+#
+#  the stand-in MakerManager
+#
+################################################################################
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    answers /auth with whether the badge is authorized, and /heartbeat that
+    all is well, after the server's delay
+    """
+    def do_GET(self):
+        server = self.server
+        if server.delay:
+            time.sleep(server.delay)
+        heartbeat = self.path.startswith("/heartbeat")
+        server.hit(heartbeat)
+        reply = {"authorized": heartbeat or random.random() >= server.deny}
+        body = json.dumps(reply) + "\n"
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class StandInMakerManager(SocketServer.ThreadingMixIn,
+        BaseHTTPServer.HTTPServer):
+    """
+    Counts the requests it answers by second, as (auth, heartbeat), from a
+    thread of its own.
+    """
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, port, delay=0, deny=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", port),
+                StandInHandler)
+        self.delay = delay
+        self.deny = deny
+        self.lock = threading.Lock()
+        self.seconds = {}
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever,
+                name="StandInMakerManager")
+        thread.daemon = True
+        thread.start()
+
+    def hit(self, heartbeat):
+        """
+        count a request in the second that it was answered
+        """
+        second = int(time.time())
+        with self.lock:
+            counts = self.seconds.setdefault(second, [0, 0])
+            counts[1 if heartbeat else 0] += 1
+
+    def counts(self, start, end):
+        """
+        (auth requests, heartbeats, most requests in one second) between
+        start and end
+        """
+        with self.lock:
+            seconds = [counts for second, counts in self.seconds.items()
+                    if start <= second < end]
+        return (sum([auth for auth, heartbeat in seconds]),
+                sum([heartbeat for auth, heartbeat in seconds]),
+                max([auth + heartbeat for auth, heartbeat in seconds] or [0]))
+
+################################################################################
+#
+#  the virtual interlocks
+#
+################################################################################
+
+class ToolStats(object):
+    """
+    the swipes of one tool, and how long each took to be answered
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = None
+        self.latencies = []
+        self.unanswered = 0
+        self.errors = 0
+        self.measuring = False
+
+    def swiped(self):
+        with self.lock:
+            if self.pending != None and self.measuring:
+                self.unanswered += 1
+            self.pending = monotonic()
+
+    def answered(self, state):
+        with self.lock:
+            if self.pending == None:
+                return
+            if self.measuring:
+                if state == MessageTypes.ERROR_NETWORK:
+                    self.errors += 1
+                else:
+                    self.latencies.append(monotonic() - self.pending)
+            self.pending = None
+
+#
+# by tool_id, filled in as the readers are made
+#
+stats = {}
+
+class SimulatedReader(Connection):
+    """
+    Swipes a random badge, as a BadgeReader would, at random times:
+
+    swipes_per_hour: how often, on average
+    arrivals: "poisson" for swipes that come at random, "uniform" for one
+        every so often, or "burst" for bursts of burst swipes in a row
+    burst: how many swipes a burst has, a second apart
+
+    A swipe while the tool is active swipes out instead.
+    """
+    def __init__(self, interlock, connection, config):
+        Connection.__init__(self, interlock, connection, config)
+        self.mean_seconds = 3600.0 / float(config.get("swipes_per_hour", 60))
+        self.arrivals = config.get("arrivals", "poisson")
+        self.burst = int(config.get("burst", 3))
+        self.stats = stats.setdefault(interlock.tool_id, ToolStats())
+        self.active = False
+        self.call = interlock.scheduler.call_later(
+                random.uniform(0, self.mean_seconds), self.swipe)
+
+    def next_swipe(self):
+        """
+        seconds until the next swipe, or burst of swipes
+        """
+        if self.arrivals == "uniform":
+            return self.mean_seconds
+        if self.arrivals == "burst":
+            return random.expovariate(1.0 / (self.mean_seconds * self.burst))
+        return random.expovariate(1.0 / self.mean_seconds)
+
+    def swipe(self, left_in_burst=None):
+        """
+        on the scheduler: swipe, and decide when to swipe next
+        """
+        if self.stopped:
+            return
+        if self.active:
+            self.interlock.action_queue.put(ActionMessage(
+                    MessageTypes.INACTIVE, "SimulatedReader swipe out"))
+        else:
+            self.stats.swiped()
+            self.interlock.action_queue.put(ActionMessage(
+                    MessageTypes.CHECK_BADGE, "SimulatedReader",
+                    str(random.randint(1, 100000))))
+
+        if left_in_burst == None and self.arrivals == "burst":
+            left_in_burst = self.burst - 1
+        if left_in_burst:
+            self.call = self.interlock.scheduler.call_later(
+                    1, self.swipe, left_in_burst - 1)
+        else:
+            self.call = self.interlock.scheduler.call_later(
+                    self.next_swipe(), self.swipe)
+
+    def handles(self):
+        return [MessageTypes.ACTIVE, MessageTypes.INACTIVE]
+
+    def update(self, action_message):
+        self.active = action_message.state == MessageTypes.ACTIVE
+
+    def stop(self):
+        Connection.stop(self)
+        self.call.cancel()
+
+class FakeOutput(Connection):
+    """
+    notes when a swipe has been answered
+    """
+    answers = [MessageTypes.ACTIVE, MessageTypes.LOGIN_DENIED,
+            MessageTypes.ERROR_NETWORK]
+
+    def __init__(self, interlock, connection, config):
+        Connection.__init__(self, interlock, connection, config)
+        self.stats = stats.setdefault(interlock.tool_id, ToolStats())
+
+    def handles(self):
+        return self.answers
+
+    def update(self, action_message):
+        self.stats.answered(action_message.state)
+
+rfid_interlock.register_connection_type("loadgen:reader", SimulatedReader)
+rfid_interlock.register_connection_type("loadgen:output", FakeOutput)
+
+def fleet_config(arguments, count, url):
+    """
+    the config of a multi-tool daemon with count virtual interlocks
+    """
+    tools = {}
+    for number in range(count):
+        tools["tool{0:04d}".format(number)] = {
+            "tool_id": str(number + 1),
+            "reader": {
+                "type": "loadgen:reader",
+                "swipes_per_hour": arguments.swipes_per_hour,
+                "arrivals": arguments.arrivals,
+                "burst": arguments.burst},
+            "output": {"type": "loadgen:output"},
+            "webservice": {
+                "type": "webservice:connection",
+                "timeout": arguments.timeout,
+                "heartbeat_monitor": {
+                    "url": url + "/heartbeat?tool={tool_id}",
+                    "interval": arguments.heartbeat_interval},
+                "check_badge": {
+                    "url": url + "/auth?tool={tool_id}&badge={badge_id}",
+                    "active:when": {"authorized": True},
+                    "login_denied:when": {"authorized": False}}}}
+    #
+    # read_endpoints() wants the urls as unicode, as they are when read
+    #
+    return json.loads(json.dumps({
+        "runtime": arguments.runtime,
+        "executor_workers": arguments.workers,
+        "timeout": 3600,
+        "warning": 60,
+        "tools": tools}))
+
+def run_fleet(arguments, count, url):
+    """
+    In the fleet's own process: run count virtual interlocks, and return
+    what they saw as a dictionary, with the window that was measured in
+    wall time, so that the server's counts can be matched up with it.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    config = fleet_config(arguments, count, url)
+    host = rfid_interlock.Host(config)
+    error_log = rfid_interlock.ErrorArrayHandler()
+    interlocks = [rfid_interlock.Interlock(tool_config, error_log, host,
+            tool_name)
+            for tool_name, tool_config in rfid_interlock.tool_configs(config)]
+    for interlock in interlocks:
+        interlock.start()
+
+    time.sleep(arguments.warmup)
+    start = time.time()
+    for tool_stats in stats.values():
+        tool_stats.measuring = True
+    time.sleep(arguments.seconds)
+    for tool_stats in stats.values():
+        tool_stats.measuring = False
+    end = time.time()
+
+    return {
+        "start": start,
+        "end": end,
+        "latencies": [stats[tool_id].latencies for tool_id in sorted(stats)],
+        "unanswered": sum([tool_stats.unanswered
+                for tool_stats in stats.values()]),
+        "errors": sum([tool_stats.errors for tool_stats in stats.values()]),
+        "threads": threading.active_count(),
+        "rss": metrics.resident_memory_bytes(),
+        "logged_errors": len(error_log.get_errors())
+    }
+
+################################################################################
+#
+#  the report
+#
+################################################################################
+
+def percentile(values, fraction):
+    """
+    the value that fraction of the sorted values are at or below
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+HEADINGS = "{0:>6} {1:>10} {2:>7} {3:>12} {4:>7} {5:>8} {6:>8} {7:>8} " \
+        "{8:>10} {9:>10} {10:>7} {11:>8} {12:>7}"
+
+def report_line(count, result, server_counts):
+    """
+    one line of the report: the server's requests per second, the most in
+    any second, and its heartbeats per second, then the swipes, their
+    latencies over all the tools, the worst tool's 99th percentile, and how
+    the fleet's process did
+    """
+    seconds = result["end"] - result["start"]
+    everyone = sorted(sum(result["latencies"], []))
+    per_tool = [percentile(sorted(latencies), .99)
+            for latencies in result["latencies"] if latencies]
+    if server_counts != None:
+        auth, heartbeats, peak = server_counts
+        requests = "{0:.1f}".format((auth + heartbeats) / seconds)
+        peak = str(peak)
+        heartbeats = "{0:.1f}".format(heartbeats / seconds)
+    else:
+        requests = peak = heartbeats = "-"
+    return HEADINGS.format(count, requests, peak, heartbeats, len(everyone),
+            "{0:.1f}".format(percentile(everyone, .5) * 1000),
+            "{0:.1f}".format(percentile(everyone, .99) * 1000),
+            "{0:.1f}".format((everyone[-1] if everyone else 0) * 1000),
+            "{0:.1f}".format(max(per_tool or [0]) * 1000),
+            "{0}/{1}".format(result["unanswered"], result["errors"]),
+            result["threads"],
+            "{0:.1f}".format(result["rss"] / 1e6),
+            result["logged_errors"])
+
+def main(argv=None):
+    """
+    run a fleet of each size, one after the other, and report on each
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description="load MakerManager, or a " +
+            "stand-in for it, with fleets of virtual interlocks")
+    parser.add_argument("--tools", default="10,50,100",
+            help="the sizes of fleet to run, default 10,50,100")
+    parser.add_argument("--seconds", type=float, default=60,
+            help="how long each fleet is measured for")
+    parser.add_argument("--warmup", type=float, default=5,
+            help="how long each fleet runs before it is measured")
+    parser.add_argument("--swipes-per-hour", type=float, default=60,
+            help="how often each tool is swiped, on average")
+    parser.add_argument("--arrivals", default="poisson",
+            choices=["poisson", "uniform", "burst"])
+    parser.add_argument("--burst", type=int, default=3,
+            help="how many swipes a burst has")
+    parser.add_argument("--heartbeat-interval", type=float, default=30)
+    parser.add_argument("--timeout", type=float, default=10,
+            help="how long the tools wait for the server")
+    parser.add_argument("--runtime", default="threads",
+            choices=["threads", "reactor"])
+    parser.add_argument("--workers", type=int, default=4,
+            help="executor threads in the reactor runtime")
+    parser.add_argument("--server-delay", type=float, default=0.01,
+            help="how long the stand-in takes to answer")
+    parser.add_argument("--deny", type=float, default=0.1,
+            help="the fraction of badges that the stand-in denies")
+    parser.add_argument("--port", type=int, default=18090,
+            help="where the stand-in listens")
+    parser.add_argument("--url", help="the server to load instead of the " +
+            "stand-in, such as http://makermanager.example")
+    parser.add_argument("--fleet", type=int, help=argparse.SUPPRESS)
+    arguments = parser.parse_args(argv)
+    url = arguments.url or "http://127.0.0.1:" + str(arguments.port)
+
+    if arguments.fleet != None:
+        #
+        # a fleet: the connections print as they are made, so the result
+        # goes to the real stdout once they are done
+        #
+        import logging
+        logging.basicConfig(level=logging.ERROR)
+        result_file = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+        sys.stdout = open(os.devnull, "w")
+        result_file.write(json.dumps(run_fleet(arguments, arguments.fleet,
+                url)) + "\n")
+        result_file.flush()
+        os._exit(0)
+
+    server = None
+    if arguments.url == None:
+        server = StandInMakerManager(arguments.port, arguments.server_delay,
+                arguments.deny)
+        server.start()
+
+    print HEADINGS.format("tools", "requests/s", "peak/s", "heartbeats/s",
+            "swipes", "p50 ms", "p99 ms", "max ms", "worst p99", "lost/err",
+            "threads", "rss MB", "errors")
+    failed = 0
+    for count in [int(count) for count in arguments.tools.split(",")]:
+        fleet = subprocess.Popen([sys.executable, os.path.abspath(__file__)] +
+                (argv if argv != None else sys.argv[1:]) +
+                ["--fleet", str(count), "--url", url],
+                stdout=subprocess.PIPE)
+        output = fleet.communicate()[0]
+        if fleet.returncode != 0 or not output.strip():
+            print >> sys.stderr, "the fleet of " + repr(count) + " failed"
+            failed = 1
+            continue
+        result = json.loads(output.strip().splitlines()[-1])
+        server_counts = server.counts(result["start"], result["end"]) \
+                if server != None else None
+        print report_line(count, result, server_counts)
+        sys.stdout.flush()
+    return failed
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,304 @@
+#! /usr/bin/python
+
+"""
+Counters, histograms and gauges about how the daemon is doing, served over
+HTTP in the Prometheus text format:
+
+    curl http://127.0.0.1:9187/metrics
+
+Counting must cost next to nothing on the dispatch thread, so each thread
+counts into a dictionary of its own without taking a lock, and the
+dictionaries are only added up when the metrics are read.  Gauges are
+functions which are only called when the metrics are read.
+"""
+
+import threading, bisect, os, logging, Queue, BaseHTTPServer, resource
+
+from scheduler import monotonic, wakeups
+
+#
+# in seconds, for everything from an I2C write to a webservice timeout
+#
+DURATION_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05,
+        .1, .25, .5, 1, 2.5, 5, 10)
+
+class Registry(object):
+    """
+    Where the metrics are described, counted and read.
+
+    Labels are passed as a tuple of (name, value) pairs, so that they can be
+    part of a dictionary key.
+    """
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+        #
+        # each thread's dictionary of (name, labels) to a number, or to a
+        # list of bucket counts followed by the sum for a histogram.  The
+        # dictionaries of threads which have ended are added into retired.
+        #
+        self.shards = []
+        self.retired = {}
+
+        self.descriptions = {}
+        self.buckets = {}
+        self.functions = {}
+
+    def describe(self, name, kind, help_text, function=None,
+            buckets=DURATION_BUCKETS):
+        """
+        kind: "counter", "gauge" or "histogram"
+        function: for metrics that are read rather than counted, returns a
+            number, or a list of (labels, number)
+        """
+        self.descriptions[name] = (kind, help_text)
+        if kind == "histogram":
+            self.buckets[name] = tuple(buckets)
+        if function != None:
+            self.functions[name] = function
+
+    def values(self):
+        """
+        the calling thread's own dictionary to count into
+        """
+        try:
+            return self.local.values
+        except AttributeError:
+            values = {}
+            with self.lock:
+                if len(self.shards) > 32:
+                    self.retire()
+                self.shards.append((threading.current_thread(), values))
+            self.local.values = values
+            return values
+
+    def inc(self, name, labels=(), amount=1):
+        """
+        add to a counter
+        """
+        values = self.values()
+        key = (name, labels)
+        values[key] = values.get(key, 0) + amount
+
+    def observe(self, name, value, labels=()):
+        """
+        add a value, such as how long something took, to a histogram
+        """
+        values = self.values()
+        key = (name, labels)
+        buckets = self.buckets.get(name, DURATION_BUCKETS)
+        counts = values.get(key)
+        if counts == None:
+            counts = values[key] = [0] * (len(buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(buckets, value)] += 1
+        counts[-1] += value
+
+    def retire(self):
+        """
+        fold the dictionaries of threads that have ended into retired, called
+        with the lock held
+        """
+        alive = []
+        for thread, values in self.shards:
+            if thread.is_alive():
+                alive.append((thread, values))
+            else:
+                add_values(self.retired, values)
+        self.shards = alive
+
+    def collect(self):
+        """
+        returns every thread's counts added up
+        """
+        with self.lock:
+            self.retire()
+            totals = {}
+            add_values(totals, self.retired)
+            for thread, values in self.shards:
+                add_values(totals, values)
+        return totals
+
+    def render(self):
+        """
+        the metrics in the Prometheus text format
+        """
+        log = logging.getLogger("Metrics.render")
+        totals = self.collect()
+
+        samples = {}
+        for (name, labels), value in totals.items():
+            samples.setdefault(name, []).append((labels, value))
+        for name, function in self.functions.items():
+            try:
+                value = function()
+            except Exception:
+                log.exception("cannot read " + name)
+                continue
+            if isinstance(value, list):
+                samples.setdefault(name, []).extend(value)
+            else:
+                samples.setdefault(name, []).append(((), value))
+
+        lines = []
+        for name in sorted(samples):
+            kind, help_text = self.descriptions.get(name, ("untyped", ""))
+            lines.append("# HELP " + name + " " + help_text)
+            lines.append("# TYPE " + name + " " + kind)
+            for labels, value in sorted(samples[name]):
+                if kind == "histogram":
+                    lines.extend(histogram_lines(name, labels, value,
+                            self.buckets.get(name, DURATION_BUCKETS)))
+                else:
+                    lines.append(name + format_labels(labels) + " " +
+                            format_value(value))
+        return "\n".join(lines) + "\n"
+
+def add_values(totals, values):
+    """
+    add one thread's counts into totals
+    """
+    for key, value in values.items():
+        if isinstance(value, list):
+            total = totals.get(key)
+            if total == None:
+                totals[key] = list(value)
+            else:
+                for index, count in enumerate(value):
+                    total[index] += count
+        else:
+            totals[key] = totals.get(key, 0) + value
+
+def histogram_lines(name, labels, counts, buckets):
+    """
+    the _bucket, _sum and _count lines of a histogram, the buckets counting
+    every value up to and including their bound
+    """
+    lines = []
+    cumulative = 0
+    for bound, count in zip(buckets + ("+Inf",), counts[:-1]):
+        cumulative += count
+        lines.append(name + "_bucket" +
+                format_labels(labels + (("le", format_value(bound)),)) +
+                " " + format_value(cumulative))
+    lines.append(name + "_sum" + format_labels(labels) + " " +
+            format_value(counts[-1]))
+    lines.append(name + "_count" + format_labels(labels) + " " +
+            format_value(cumulative))
+    return lines
+
+def format_labels(labels):
+    """
+    {name="value",...}, or nothing when there are no labels
+    """
+    if not labels:
+        return ""
+    return "{" + ",".join([
+            name + '="' + str(value).replace("\\", "\\\\")
+                    .replace('"', '\\"').replace("\n", "\\n") + '"'
+            for name, value in labels]) + "}"
+
+def format_value(value):
+    """
+    numbers the way that Prometheus reads them
+    """
+    if isinstance(value, str):
+        return value
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+registry = Registry()
+
+################################################################################
+#
+#  things worth measuring
+#
+################################################################################
+
+class TimedQueue(Queue.Queue):
+    """
+    A Queue which observes how long each item waited in it, in the histogram
+    called name.  ready, when it is given a WakeupEvent, is set whenever an
+    item is put, so that a poll() loop can wait on the queue.
+    """
+    def __init__(self, name, maxsize=0):
+        Queue.Queue.__init__(self, maxsize)
+        self.name = name
+        self.ready = None
+
+    def _put(self, item):
+        self.queue.append((monotonic(), item))
+        if self.ready != None:
+            self.ready.set()
+
+    def _get(self):
+        queued, item = self.queue.popleft()
+        registry.observe(self.name, monotonic() - queued)
+        return item
+
+def resident_memory_bytes():
+    """
+    how much memory the process is using, from /proc
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        return 0
+
+def wakeup_counts():
+    """
+    the wakeups that the scheduler module has counted, by thread
+    """
+    return [((("thread", name),), count)
+            for name, count in dict(wakeups.counts).items()]
+
+registry.describe("muther_threads", "gauge",
+        "how many threads are running", threading.active_count)
+registry.describe("muther_resident_memory_bytes", "gauge",
+        "resident memory of the process", resident_memory_bytes)
+registry.describe("muther_wakeups_total", "counter",
+        "how many times each thread has woken up", wakeup_counts)
+
+################################################################################
+#
+#  serving them
+#
+################################################################################
+
+class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    answers GET /metrics
+    """
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = registry.render()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.getLogger("Metrics.request").debug(format % args)
+
+class MetricsServer(threading.Thread):
+    """
+    Serves the metrics from a thread of its own, which sleeps until a request
+    comes in.  BaseHTTPServer's serve_forever() would wake up twice a second
+    to check whether it should stop, so requests are handled one at a time
+    instead.
+    """
+    def __init__(self, address="127.0.0.1", port=9187):
+        threading.Thread.__init__(self, name="MetricsServer")
+        self.daemon = True
+        self.server = BaseHTTPServer.HTTPServer((address, port),
+                MetricsRequestHandler)
+
+    def run(self):
+        while True:
+            self.server.handle_request()
+            wakeups.tick("MetricsServer")
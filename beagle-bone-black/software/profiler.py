@@ -0,0 +1,130 @@
+#! /usr/bin/python
+
+"""
+A sampling profiler that can be switched on and off while the daemon runs:
+
+    kill -USR1 $(cat /var/lock/muther_rfid)     # start sampling
+    kill -USR2 $(cat /var/lock/muther_rfid)     # stop, and write the samples
+
+While it is on, a thread of its own takes the stack of every other thread a
+number of times a second.  When it is stopped the samples are written in the
+collapsed stack format, one line per distinct stack with how many times it was
+seen, ready for flamegraph.pl:
+
+    flamegraph.pl /var/tmp/muther-1234-20160101-120000.collapsed > out.svg
+
+Each dispatch is also traced while it is on, with how long every connection's
+update() took, into a ".trace" file next to the samples.
+
+While it is off there is no thread and nothing is traced, so it costs nothing.
+"""
+
+import sys, os, time, threading, logging
+
+from configuration import write_atomically
+
+class SamplingProfiler(object):
+    """
+    start() and stop() may be called from signal handlers, the sampling and
+    the writing happen on the sampler's thread.
+    """
+    def __init__(self, rate=100, directory="/var/tmp", max_traces=100000):
+        """
+        rate: samples per second
+        directory: where the collapsed stacks and the traces are written
+        max_traces: the most dispatches that are traced in one run
+        """
+        self.rate = rate
+        self.directory = directory
+        self.max_traces = max_traces
+        self.running = False
+        self.sampler = None
+        self.stopping = None
+        self.traces = []
+
+    def start(self):
+        """
+        start sampling, unless we already are
+        """
+        log = logging.getLogger("Profiler.start")
+        if self.running:
+            return
+        self.traces = []
+        self.stopping = threading.Event()
+        self.sampler = threading.Thread(target=self.sample_loop,
+                args=(self.stopping, self.traces), name="Profiler")
+        self.sampler.daemon = True
+        self.running = True
+        self.sampler.start()
+        log.info("sampling " + repr(self.rate) + " times a second")
+
+    def stop(self):
+        """
+        stop sampling, the sampler's thread writes out what it found
+        """
+        if not self.running:
+            return
+        self.running = False
+        self.stopping.set()
+
+    def trace(self, line):
+        """
+        note something about the current dispatch, while we are running
+        """
+        if len(self.traces) < self.max_traces:
+            self.traces.append(line)
+
+    def sample_loop(self, stopping, traces):
+        """
+        the sampler thread: take samples until stopped, then write them and
+        the traces
+        """
+        log = logging.getLogger("Profiler.sample")
+        own_ident = threading.current_thread().ident
+        interval = 1.0 / self.rate
+        stacks = {}
+        samples = 0
+        started = time.time()
+
+        while not stopping.is_set():
+            names = dict([(thread.ident, thread.name)
+                    for thread in threading.enumerate()])
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = collapse(names.get(ident, "thread-" + str(ident)),
+                        frame)
+                stacks[stack] = stacks.get(stack, 0) + 1
+            samples += 1
+            time.sleep(interval)
+
+        filename = os.path.join(self.directory, "muther-{0}-{1}.collapsed"
+                .format(os.getpid(),
+                time.strftime("%Y%m%d-%H%M%S", time.localtime(started))))
+        try:
+            write_atomically(filename, "".join([
+                    stack + " " + str(count) + "\n"
+                    for stack, count in sorted(stacks.items())]))
+            write_atomically(filename[:-len(".collapsed")] + ".trace",
+                    "".join([line + "\n" for line in traces]))
+        except (IOError, OSError) as error:
+            log.error("cannot write " + filename + ": " + repr(error))
+            return
+        log.info("wrote " + repr(samples) + " samples over " +
+                "{0:.1f}".format(time.time() - started) + " seconds to " +
+                filename)
+
+def collapse(thread_name, frame):
+    """
+    a stack as "thread;outermost;...;innermost", each function as
+    "name (file:line)"
+    """
+    functions = []
+    while frame != None:
+        code = frame.f_code
+        functions.append("{0} ({1}:{2})".format(code.co_name,
+                os.path.basename(code.co_filename), code.co_firstlineno))
+        frame = frame.f_back
+    functions.append(thread_name)
+    functions.reverse()
+    return ";".join([function.replace(";", ":") for function in functions])
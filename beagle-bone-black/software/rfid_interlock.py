@@ -3,10 +3,10 @@
 """
 This module implement a very generic rfid reader / controller as a very
 intracate finite state machine where.  The main actors are:
-    the message queue in which each message is a dictionary of the following:
-        "state": the next state as documented in MessageTypes
-        "from": a string describing the connection generating the new state
-        "badge_id": optional, the rfid of the badge to be checked
+    the message queue in which each message is an ActionMessage of:
+        state: the next state as documented in MessageTypes
+        source: a string describing the connection generating the new state
+        badge_id: optional, the rfid of the badge to be checked
 
     Interlock class:
         akin to an operating system's kernal
@@ -30,23 +30,66 @@ intracate finite state machine where.  The main actors are:
 #
 
 from datetime import datetime, timedelta
-import time, json, serial, threading, Queue, sys, fcntl, os
-
-from evdev import InputDevice, ecodes
-import lcd_i2c_p018
-
-import urllib2
-from uuid import getnode as get_mac_address
-
-import Adafruit_BBIO.ADC  as ADC
-import Adafruit_BBIO.GPIO as GPIO
+import time, json, threading, Queue, sys, fcntl, os, array
+import random, socket, atexit, collections, copy, re, signal, importlib
+import errno, bisect
 
 import configuration
+import state_journal
+import metrics
+from profiler import SamplingProfiler
+from scheduler import Scheduler, Executor, WakeupEvent, wakeups, monotonic
 
 import logging
 import logging.config
 import logging.handlers
 
+################################################################################
+#
+#  hardware and other slow modules, imported when they are first needed
+#
+################################################################################
+
+class LazyModule(object):
+    """
+    Stands in for a module, or for something in a module, until it is first
+    used.  The connection type registry swaps it for the real thing when a
+    connection that needs it is made, so that only the hardware which the
+    config actually uses is imported.
+    """
+    def __init__(self, module_name, attribute=None):
+        self._module_name = module_name
+        self._attribute = attribute
+        self._target = None
+
+    def _load(self):
+        """
+        import the module, raises ImportError if it is not there
+        """
+        if self._target == None:
+            module = importlib.import_module(self._module_name)
+            self._target = getattr(module, self._attribute) \
+                    if self._attribute else module
+        return self._target
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+serial = LazyModule("serial")
+InputDevice = LazyModule("evdev", "InputDevice")
+ecodes = LazyModule("evdev", "ecodes")
+lcd_i2c_p018 = LazyModule("lcd_i2c_p018")
+urllib2 = LazyModule("urllib2")
+httplib = LazyModule("httplib")
+ADC = LazyModule("Adafruit_BBIO.ADC")
+GPIO = LazyModule("Adafruit_BBIO.GPIO")
+event_journal = LazyModule("event_journal")
+badge_index = LazyModule("badge_index")
+input_trace = LazyModule("input_trace")
+
 ################################################################################
 #
 #  action_queue
@@ -78,6 +121,11 @@ class MessageTypes(object):
 
     RESET_TIMER = "reset_timer"
 
+    #
+    # internal to the Interlock, never passed on to the connections
+    #
+    RELOAD_CONFIG = "reload_config"
+
     ALL_STATES = [
         POWER_UP,
         ACTIVE,
@@ -100,44 +148,403 @@ class MessageTypes(object):
 
     INTERLOCK_CLASS = ALL_STATES + [RESET_TIMER]
 
+    #
+    # every state as a small integer, so that dispatching on a state is a
+    # list lookup rather than comparing strings
+    #
+    NAMES = ALL_STATES + [RESET_TIMER, RELOAD_CONFIG]
+    CODES = {name: code for code, name in enumerate(NAMES)}
+
+    @staticmethod
+    def table(entries, default=None):
+        """
+        a list with an entry for each state code, from a dictionary of state
+        names to entries
+        """
+        return [entries.get(name, default) for name in MessageTypes.NAMES]
+
+class ActionMessage(object):
+    """
+    One message through the action_queue.  The state is kept both by name and
+    by its code in MessageTypes.CODES, names read from the config are swapped
+    for the ones in MessageTypes, and states that are not in there get the
+    code None.  source is who sent it, badge_id the badge to check if there
+    is one, created the time.time() when it was made, and connection the name
+    of the connection that sent it, for the messages whose sender matters.
+
+    Messages cannot be changed once they are made, so the same one is handed
+    to every connection, on whatever thread, without copying it.  For
+    connections written when the messages were dictionaries, message["state"],
+    message["from"], message["badge_id"], get() and items() still work.
+    """
+    __slots__ = ("state", "code", "source", "badge_id", "created",
+            "connection")
+
+    KEYS = {"state": "state", "from": "source", "badge_id": "badge_id"}
+
+    def __init__(self, state, source=None, badge_id=None, created=None,
+            connection=None):
+        code = MessageTypes.CODES.get(state)
+        if code != None:
+            state = MessageTypes.NAMES[code]
+        setter = object.__setattr__
+        setter(self, "state", state)
+        setter(self, "code", code)
+        setter(self, "source", source)
+        setter(self, "badge_id", badge_id)
+        setter(self, "created", time.time() if created == None else created)
+        setter(self, "connection", connection)
+
+    @classmethod
+    def of(cls, message):
+        """
+        the message as an ActionMessage, for the dictionaries that plugins
+        may still put on the action_queue
+        """
+        if isinstance(message, ActionMessage):
+            return message
+        return cls(message.get("state"), message.get("from"),
+                message.get("badge_id"))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("an ActionMessage cannot be changed")
+
+    __delattr__ = __setattr__
+
+    def __reduce__(self):
+        return (ActionMessage, (self.state, self.source, self.badge_id,
+                self.created, self.connection))
+
+    def __getitem__(self, key):
+        return getattr(self, self.KEYS[key])
+
+    def __contains__(self, key):
+        return self.get(key) != None
+
+    def get(self, key, default=None):
+        attribute = self.KEYS.get(key)
+        value = getattr(self, attribute) if attribute else None
+        return default if value == None else value
+
+    def items(self):
+        """
+        (key, value) for the keys that a dictionary message would have had
+        """
+        return [(key, getattr(self, attribute))
+                for key, attribute in self.KEYS.items()
+                if getattr(self, attribute) != None]
+
+    def __repr__(self):
+        return "ActionMessage(" + repr(self.state) + ", " + \
+                repr(self.source) + \
+                (", badge_id=" + repr(self.badge_id)
+                if self.badge_id != None else "") + ")"
+
+################################################################################
+#
+#  the state machine
+#
+################################################################################
+
+#
+# the states which may follow each state that the tool can be in.  The info
+# only states pass through without changing the state the tool is in, and
+# they, powering up, going inactive and the errors are allowed from anywhere.
+# A reset_timer only makes sense while the tool is on, and never gets past
+# the Interlock.  The config's "transitions" can replace any of these.  On
+# top of these, only the connection that put the tool into maintenance may
+# take it out of maintenance, other than into another error.
+#
+ALWAYS_ALLOWED = MessageTypes.INFO_ONLY + [
+    MessageTypes.POWER_UP,
+    MessageTypes.INACTIVE,
+    MessageTypes.ERROR,
+    MessageTypes.ERROR_CONFIG,
+    MessageTypes.ERROR_NETWORK,
+    MessageTypes.ERROR_MAINTENANCE
+]
+
+TRANSITIONS = {
+    MessageTypes.POWER_UP:          ALWAYS_ALLOWED + [MessageTypes.ACTIVE],
+    MessageTypes.INACTIVE:          ALWAYS_ALLOWED + [MessageTypes.ACTIVE],
+    MessageTypes.ACTIVE:            ALWAYS_ALLOWED + [MessageTypes.ACTIVE,
+            MessageTypes.INACTIVE_SOON, MessageTypes.RESET_TIMER],
+    MessageTypes.INACTIVE_SOON:     ALWAYS_ALLOWED + [MessageTypes.ACTIVE,
+            MessageTypes.RESET_TIMER],
+    MessageTypes.ERROR:             ALWAYS_ALLOWED,
+    MessageTypes.ERROR_CONFIG:      ALWAYS_ALLOWED,
+    MessageTypes.ERROR_MAINTENANCE: ALWAYS_ALLOWED,
+    #
+    # a recently granted badge is let in while the network is down
+    #
+    MessageTypes.ERROR_NETWORK:     ALWAYS_ALLOWED + [MessageTypes.ACTIVE]
+}
+
+def compile_transitions(transitions):
+    """
+    Check a table of transitions, and turn it into a list for each state
+    code, of whether each state code may follow it.  Returns the compiled
+    table, and a list of what is wrong with the table.
+    """
+    problems = []
+    codes = MessageTypes.CODES
+    allowed = [[False] * len(MessageTypes.NAMES)
+            for name in MessageTypes.NAMES]
+    lasting_states = [state for state in MessageTypes.ALL_STATES
+            if state not in MessageTypes.INFO_ONLY]
+
+    for state, next_states in transitions.items():
+        if state not in lasting_states:
+            problems.append(repr(state) + " is not a state the tool can be in")
+            continue
+        if type(next_states) != list:
+            problems.append(state + ": " + repr(next_states) +
+                    " needs to be a list of states")
+            continue
+        for next_state in next_states:
+            if next_state not in MessageTypes.INTERLOCK_CLASS:
+                problems.append(state + ": " + repr(next_state) +
+                        " is not a state")
+            else:
+                allowed[codes[state]][codes[next_state]] = True
+
+    for state in lasting_states:
+        if state not in transitions:
+            problems.append(state + " is missing")
+
+    #
+    # every state should be reachable after powering up, and the tool should
+    # always be able to go back to being inactive
+    #
+    reached = set([codes[MessageTypes.POWER_UP]])
+    waiting = list(reached)
+    while waiting:
+        code = waiting.pop()
+        for next_code, next_allowed in enumerate(allowed[code]):
+            if next_allowed and next_code not in reached:
+                reached.add(next_code)
+                waiting.append(next_code)
+    for state in lasting_states:
+        if codes[state] not in reached:
+            problems.append(state + " can never be reached")
+        if not allowed[codes[state]][codes[MessageTypes.INACTIVE]]:
+            problems.append(state + " can never go back to " +
+                    MessageTypes.INACTIVE)
+
+    return allowed, problems
+
 ################################################################################
 #
 #  custom logging handler
 #
 ################################################################################
 
+ErrorRecord = collections.namedtuple("ErrorRecord",
+        ["created", "levelname", "name", "message", "tool"])
+
+#
+# the name of the tool whose Interlock, or connection, is being made on this
+# thread, which ErrorArrayHandler notes with each error so that a mistake in
+# one tool's config only locks out that tool
+#
+logging_tool = threading.local()
+
 class ErrorArrayHandler(logging.Handler):
     """
-    this is a logging handler which puts all messages that it receives into an
-    array so that you can display them later if you like.
+    this is a logging handler which keeps the most recent messages that it
+    receives so that you can display them later if you like.
+
+    Only the last capacity messages are kept, as compact ErrorRecords, so a
+    flapping network or LCD cannot use up the memory however long we run.
+    Every message is also counted by its logger and message template, with
+    when it was first and last seen, see get_counts(), and by the tool that
+    was being made when it was logged, see get_tools().
 
     http://pantburk.info/?blog=77
     """
-    def __init__(self):
+    #
+    # the variable parts of a message that was built by concatenation: quoted
+    # strings and numbers
+    #
+    variable_parts = re.compile(
+            r"""'[^']*'|"[^"]*"|0x[0-9a-fA-F]+|\d+(\.\d+)?""")
+    max_message = 200
+    max_template = 120
+
+    def __init__(self, capacity=100, max_sources=256):
         """
-        takes no parameters
+        capacity: how many of the most recent messages to keep
+        max_sources: how many logger and template pairs to count separately,
+            the rest are counted together as "(other)"
         """
         logging.Handler.__init__(self)
+        self.capacity = capacity
+        self.max_sources = max_sources
         self.clear_errors()
-        self.errors = []
 
     def emit(self, record):
         """
         take note of an an error
         """
-        self.errors.append(record)
+        message = record.getMessage()
+        tool = getattr(logging_tool, "name", None)
+        self.errors.append(ErrorRecord(record.created, record.levelname,
+                record.name, message[:self.max_message], tool))
+        self.tools[tool] = self.tools.get(tool, 0) + 1
+
+        if record.args:
+            template = str(record.msg)
+        else:
+            template = self.variable_parts.sub("#", message)
+        key = (record.name, template[:self.max_template])
+        if key not in self.counts and len(self.counts) >= self.max_sources:
+            key = (record.name, "(other)")
+            if key not in self.counts:
+                key = ("(other)", "(other)")
+        count = self.counts.get(key)
+        if count == None:
+            self.counts[key] = [1, record.created, record.created]
+        else:
+            count[0] += 1
+            count[2] = record.created
+        self.total += 1
 
     def clear_errors(self):
         """
         Clear out the errors that we have take note of so far.
         """
-        self.errors = []
+        self.errors = collections.deque(maxlen=self.capacity)
+        self.counts = {}
+        self.tools = {}
+        self.total = 0
 
     def get_errors(self):
         """
-        returns an array of the errors.
+        returns a list of the most recent errors, oldest first
+        """
+        return list(self.errors)
+
+    def get_counts(self):
+        """
+        returns a dictionary of (logger, template) to a dictionary of "count",
+        "first_seen" and "last_seen"
+        """
+        with self.lock:
+            return {
+                key: {"count": count, "first_seen": first_seen,
+                        "last_seen": last_seen}
+                for key, (count, first_seen, last_seen)
+                in self.counts.items()}
+
+    def get_tools(self):
+        """
+        returns the names of the tools that errors were logged for while they
+        were being made, None standing for the errors that were not any one
+        tool's
+        """
+        with self.lock:
+            return set(self.tools)
+
+class QueueHandler(logging.Handler):
+    """
+    Hands records to a QueueListener instead of writing them, so that the
+    thread which logs, often the one driving the relay, never waits on a file
+    or the console.  Python 2's logging has no QueueHandler of its own.
+    """
+    def __init__(self, queue, handlers):
+        """
+        queue: shared with the QueueListener
+        handlers: the handlers that the listener passes our records on to
+        """
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.handlers = handlers
+        self.dropped = 0
+
+    def handle(self, record):
+        """
+        no lock is needed, the queue has its own
+        """
+        if self.filter(record):
+            self.emit(record)
+        return record
+
+    def emit(self, record):
+        """
+        queue the record, dropping it rather than waiting if the writer has
+        fallen that far behind
+        """
+        try:
+            #
+            # format the message and the traceback now, while the arguments
+            # still look the way that they did when they were logged, on a
+            # copy, since the loggers above this one see the same record
+            #
+            record = copy.copy(record)
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(
+                        record.exc_info)
+                record.exc_info = None
+            self.queue.put_nowait((record, self.handlers))
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+class QueueListener(threading.Thread):
+    """
+    the background thread that does the writing for the QueueHandlers
+    """
+    def __init__(self, queue):
+        threading.Thread.__init__(self, name="QueueListener")
+        self.daemon = True
+        self.queue = queue
+
+    def run(self):
+        """
+        pass each record on to its handlers, until stop()
+        """
+        while True:
+            item = self.queue.get()
+            if item == None:
+                break
+            wakeups.tick("QueueListener")
+            record, handlers = item
+            for handler in handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        """
+        write out whatever is still queued, then end the thread
         """
-        return self.errors
+        self.queue.put(None)
+        self.join(5)
+
+def queue_logging(max_queued=10000):
+    """
+    Move the handlers that logging.config set up behind QueueHandlers, one
+    per logger, all writing through a single QueueListener.  Returns the
+    listener.
+    """
+    queue = Queue.Queue(max_queued)
+    listener = QueueListener(queue)
+
+    loggers = [logging.getLogger()] + [
+            logger for logger in logging.Logger.manager.loggerDict.values()
+            if isinstance(logger, logging.Logger)]
+    for logger in loggers:
+        handlers = list(logger.handlers)
+        if handlers:
+            for handler in handlers:
+                logger.removeHandler(handler)
+            logger.addHandler(QueueHandler(queue, handlers))
+
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
 
 ################################################################################
 #
@@ -156,13 +563,18 @@ class Connection(object):
         action_queue: used to change the current state which is passed to all
             of the other connections.  Here is how to call it from a connection:
 
-            self.interlock.action_queue.put({
-                "state": MessageTypes.INACTIVE,
-                "from": "BadgeReader.run() swipe out"})
+            self.interlock.action_queue.put(ActionMessage(
+                    MessageTypes.INACTIVE, "BadgeReader.run() swipe out"))
 
         tool_id: This is especially usesful when validating a badge swipe for
             a specific tool.
     """
+    #
+    # set by the connections whose update() waits on the hardware, which in
+    # the reactor runtime are updated from an AsyncUpdater of their own, so
+    # that they do not hold up the scheduler's thread
+    #
+    update_blocks = False
 
     def __init__(self, interlock, connection, config):
         """
@@ -172,6 +584,17 @@ class Connection(object):
         self.connection = connection
         self.config = config
         self.run_continuously = False
+        self.stopped = False
+
+        #
+        # the UpdateBudget that the interlock updates us through
+        #
+        self.budget = None
+
+        #
+        # records what we read, when the config asks for a recording
+        #
+        self.recorder = interlock.host.recorder
 
     def update(self, status):
         """
@@ -179,6 +602,50 @@ class Connection(object):
         """
         pass
 
+    def call_like_update(self, function, *args):
+        """
+        call function from wherever update() is called from, in order with
+        the updates, such as from a timer that writes to the same hardware
+        """
+        if self.budget != None:
+            self.budget.call(function, *args)
+        else:
+            function(*args)
+
+    def handles(self):
+        """
+        override this method to return the states that update() does anything
+        with, so that it is only called for those.  None, the default, means
+        every state.  Called once, after the connection is made.
+        """
+        return None
+
+    def stop(self):
+        """
+        called when the connection is being replaced because its config
+        changed.  Override this method to cancel timers and release devices,
+        threads should notice self.stopped and end.
+        """
+        self.stopped = True
+
+    def attach(self):
+        """
+        In the reactor runtime, a connection which runs continuously is asked
+        to do its work from self.interlock.scheduler, handing anything that
+        blocks to self.interlock.executor, rather than from a thread of its
+        own.  Override this method to do that and return True, otherwise its
+        thread is started as usual.
+        """
+        return False
+
+    def session_summary(self):
+        """
+        override this method to add to the report made when a session ends.
+        Return a dictionary of what this connection noticed since the last
+        call, or None if there is nothing to report.
+        """
+        return None
+
 
 ################################################################################
 #
@@ -225,12 +692,26 @@ class BadgeReader(threading.Thread, Connection):
         self.last_status = MessageTypes.INACTIVE
         self.ignore_for_now = dict()
 
+        #
+        # update() runs on the dispatch thread for every message, so the
+        # logger is looked up once here
+        #
+        self.log_update = logging.getLogger("BadgeReader.update")
+        self.log_read = logging.getLogger("BadgeReader.read")
+        self.log_throttle = logging.getLogger("BadgeReader.throttle")
+        self.log_code = logging.getLogger("BadgeReader.code")
+
         #
         # The child class must create an attribute which is an object with a
         # readline() method
         #
         self.input = None
 
+        #
+        # in the reactor runtime, what has been read of the line so far
+        #
+        self.attached = False
+        self.partial = ""
 
     def run(self):
         """
@@ -239,87 +720,156 @@ class BadgeReader(threading.Thread, Connection):
         """
 
         log_run = logging.getLogger("BadgeReader.run")
-        log_read = logging.getLogger("BadgeReader.read")
-        log_throttle = logging.getLogger("BadgeReader.throttle")
-        log_code = logging.getLogger("BadgeReader.code")
-
         log_run.info("in BadgeReader.run()")
 
+        while not self.stopped:
+            try:
+                line = self.input.readline()
+            except Exception:
+                #
+                # stop() closes the input out from under us
+                #
+                if self.stopped:
+                    break
+                raise
+            if self.stopped:
+                break
+            if self.recorder != None and line:
+                self.recorder.read(self.connection,
+                        line if line.endswith("\n") else line + "\n")
+            self.badge_read(line.rstrip())
+
+    def attach(self):
+        """
+        in the reactor runtime, read whatever the input has whenever it has
+        something, from the scheduler
+        """
+        self.attached = True
+        self.interlock.scheduler.add_reader(self.input, self.readable)
+        return True
+
+    def read_available(self):
+        """
+        what the input has to read without waiting, "" at its end, or None if
+        there is nothing after all.  Override this method if the input is not
+        a plain file.
+        """
+        try:
+            return os.read(self.input.fileno(), 4096)
+        except OSError as error:
+            if error.errno == errno.EAGAIN:
+                return None
+            raise
+
+    def readable(self):
+        """
+        the input has something to read, split it into lines
+        """
+        data = self.read_available()
+        if data == "":
+            self.log_read.error(self.connection + ": end of input")
+            self.interlock.scheduler.remove_reader(self.input)
+            return
+        if data == None:
+            return
+        if self.recorder != None:
+            self.recorder.read(self.connection, data)
+        self.partial += data
+        while "\n" in self.partial:
+            line, self.partial = self.partial.split("\n", 1)
+            self.badge_read(line.rstrip())
+
+    def badge_read(self, badge_raw):
+        """
+        tells the Interlock when we scan a badge indicating a person wants
+        permission to use this equipment
+        """
+        log_read = self.log_read
+        log_throttle = self.log_throttle
+        log_code = self.log_code
+
         ignore_scan_period = timedelta(seconds=1)
 
-        while True:
-            badge_raw = self.input.readline().rstrip()
+        if log_read.isEnabledFor(logging.INFO):
             log_read.info("read in badge '" + badge_raw + "'")
 
-            #
-            # delete old scans
-            #
-            for del_badge in self.ignore_for_now.keys():
+        #
+        # delete old scans
+        #
+        for del_badge in self.ignore_for_now.keys():
+            if log_throttle.isEnabledFor(logging.INFO):
                 log_throttle.info("comparing: " +
                         repr(self.ignore_for_now[del_badge]) +
                         " with " + repr(datetime.now()))
-                if self.ignore_for_now[del_badge] < datetime.now():
-                    log_throttle.info("removing " + repr(del_badge))
-                    del self.ignore_for_now[del_badge]
+            if self.ignore_for_now[del_badge] < datetime.now():
+                log_throttle.info("removing " + repr(del_badge))
+                del self.ignore_for_now[del_badge]
 
-            #
-            # if the badge has been recently scanned, do not process it, but
-            # remember that it was just now scanned.
-            #
+        #
+        # if the badge has been recently scanned, do not process it, but
+        # remember that it was just now scanned.
+        #
+        if log_throttle.isEnabledFor(logging.DEBUG):
             log_throttle.debug("checking for " + badge_raw + " in " +
                     repr(self.ignore_for_now))
-            if badge_raw in self.ignore_for_now:
-                if badge_raw != "":
-                    log_throttle.debug("ignoring " + badge_raw + " for now")
-                    badge_raw = ""
-            else:
-                ignore_until = datetime.now() + ignore_scan_period
-                self.ignore_for_now[badge_raw] = ignore_until
+        if badge_raw in self.ignore_for_now:
+            if badge_raw != "":
+                log_throttle.debug("ignoring " + badge_raw + " for now")
+                badge_raw = ""
+        else:
+            ignore_until = datetime.now() + ignore_scan_period
+            self.ignore_for_now[badge_raw] = ignore_until
+            if log_throttle.isEnabledFor(logging.DEBUG):
                 log_throttle.debug("added " + badge_raw + " to " +
                         repr(self.ignore_for_now))
 
-            if badge_raw != "":
+        if badge_raw != "":
+            #
+            # received a swipe while active, let's deactivate
+            #
+            if self.last_status == MessageTypes.ACTIVE:
+                self.interlock.action_queue.put(ActionMessage(
+                        MessageTypes.INACTIVE, "BadgeReader.run() swipe out"))
+            else:
                 #
-                # received a swipe while active, let's deactivate
+                # received a swipe while inactive, let's see if we have
+                # permission
                 #
-                if self.last_status == MessageTypes.ACTIVE:
-                    self.interlock.action_queue.put({
-                        "state": MessageTypes.INACTIVE,
-                        "from": "BadgeReader.run() swipe out"})
-                else:
+                try:
                     #
-                    # received a swipe while inactive, let's see if we have
-                    # permission
+                    # extract the rfid
                     #
-                    try:
-                        #
-                        # extract the rfid
-                        #
-                        badge_raw = badge_raw[self.code_skip_chars:
-                                self.code_len]
-                        badge_decimal = str(int(badge_raw, self.code_base))
-                        log_code.info("BadgeReader.run(): badge code is " +
-                                    repr(badge_decimal))
-
-                        self.interlock.action_queue.put(
-                            {"state": MessageTypes.CHECK_BADGE,
-                            "badge_id": badge_decimal,
-                            "from": "BadgeReader.run()"})
+                    badge_raw = badge_raw[self.code_skip_chars:
+                            self.code_len]
+                    badge_decimal = str(int(badge_raw, self.code_base))
+                    log_code.info("BadgeReader.run(): badge code is " +
+                                repr(badge_decimal))
 
-                    except ValueError:
-                        log_read.error(
-                            "Cannot convert " + badge_raw + " into decimal")
+                    self.interlock.action_queue.put(ActionMessage(
+                            MessageTypes.CHECK_BADGE, "BadgeReader.run()",
+                            badge_decimal))
+
+                except ValueError:
+                    log_read.error(
+                        "Cannot convert " + badge_raw + " into decimal")
+
+    def stop(self):
+        """
+        stop reading, children close their input after this
+        """
+        Connection.stop(self)
+        if self.attached:
+            self.interlock.scheduler.remove_reader(self.input)
 
     def update(self, action_message):
         """
         When the new state changes between Active, or Inactive, the then the
         read RFIDs cache is cleared.
         """
-        status = action_message["state"]
-        log_update = logging.getLogger("BadgeReader.update")
+        status = action_message.state
         if self.last_status != status:
-            log_update.info("BadgeReader.update():" +
-                        " status changed, clearing rfid cache")
+            self.log_update.info(
+                    "BadgeReader.update(): status changed, clearing rfid cache")
             self.ignore_for_now.clear()
 
             #
@@ -346,6 +896,20 @@ class SerialBadgeReader(BadgeReader):
         else:
             raise
 
+    def read_available(self):
+        """
+        what the serial port has received
+        """
+        waiting = self.input.inWaiting()
+        return self.input.read(waiting) if waiting else None
+
+    def stop(self):
+        """
+        closing the port ends the readline() that run() is waiting in
+        """
+        BadgeReader.stop(self)
+        self.input.close()
+
 ################################################################################
 #
 #  stdin BadgeReader
@@ -414,6 +978,27 @@ class InputEventStream(object):
                     line += self.scan_to_char_mapping[event.code]
         return line
 
+    def read_available(self):
+        """
+        the characters of the key presses that are waiting, including the
+        "\n" at the end of a line, or None if there are none
+        """
+        characters = ""
+        try:
+            for event in self.device.read():
+                if event.type == ecodes.EV_KEY and event.value == 1:
+                    characters += self.scan_to_char_mapping[event.code]
+        except IOError as error:
+            if error.errno != errno.EAGAIN:
+                raise
+        return characters or None
+
+    def fileno(self):
+        """
+        so that the scheduler can wait on the device
+        """
+        return self.device.fd
+
 class InputEventBadgeReader(BadgeReader):
     """
     BadgeReader which reads the rfid codes from Human Interface Device such as
@@ -429,6 +1014,19 @@ class InputEventBadgeReader(BadgeReader):
         BadgeReader.__init__(self, interlock, connection, config)
         self.input = InputEventStream(connection)
 
+    def read_available(self):
+        """
+        the key presses that are waiting
+        """
+        return self.input.read_available()
+
+    def stop(self):
+        """
+        closing the device ends the readline() that run() is waiting in
+        """
+        BadgeReader.stop(self)
+        self.input.device.close()
+
 
 ################################################################################
 #
@@ -454,6 +1052,132 @@ class InputEventBadgeReader(BadgeReader):
 #     }
 # }
 
+class BadgeRules(object):
+    """
+    Rules for whole blocks of badges, by badge number as the badge readers
+    give them, in decimal:
+
+        "1000-1999": a range, both ends included
+        "2150*": every badge starting with these digits
+        "facility:123": every Wiegand 26 card of facility code 123, that is
+            whose number, above its 16 bits of card number, is 123.
+            "facility:123:20" is for cards with 20 bits of card number.
+
+    The rules are compiled into sorted intervals of badge numbers which do
+    not overlap, so that looking a badge up is a bisect of the starts of the
+    intervals, however many rules there are.  A prefix becomes an interval
+    for every length of badge up to MAX_DIGITS.
+    """
+    MAX_DIGITS = 20
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+        self.states = []
+
+    @staticmethod
+    def is_rule(badge):
+        """
+        whether an entry of a when clause is a rule, rather than a badge
+        """
+        return isinstance(badge, basestring) and badge != "default" and \
+                (badge.endswith("*") or badge.startswith("facility:") or
+                "-" in badge)
+
+    @classmethod
+    def intervals(cls, rule):
+        """
+        the (first, last) badge numbers that rule covers, raises ValueError
+        when it does not make sense
+        """
+        if rule.endswith("*"):
+            prefix = rule[:-1]
+            if not prefix.isdigit() or prefix.startswith("0") or \
+                    len(prefix) > cls.MAX_DIGITS:
+                raise ValueError("needs to be digits, not starting with 0, " +
+                        "followed by *")
+            number = int(prefix)
+            return [(number * 10 ** (digits - len(prefix)),
+                    (number + 1) * 10 ** (digits - len(prefix)) - 1)
+                    for digits in range(len(prefix), cls.MAX_DIGITS + 1)]
+
+        if rule.startswith("facility:"):
+            parts = rule.split(":")[1:]
+            if len(parts) not in (1, 2) or \
+                    [part for part in parts if not part.isdigit()]:
+                raise ValueError("needs to be facility:<code>, or " +
+                        "facility:<code>:<bits of card number>")
+            code = int(parts[0])
+            bits = int(parts[1]) if len(parts) == 2 else 16
+            return [(code << bits, ((code + 1) << bits) - 1)]
+
+        first, _, last = rule.partition("-")
+        if not first.isdigit() or not last.isdigit() or \
+                int(first) > int(last):
+            raise ValueError("needs to be <first>-<last>, the first no " +
+                    "bigger than the last")
+        return [(int(first), int(last))]
+
+    def compile(self, rules):
+        """
+        rules is a list of (rule, state).  Returns what is wrong with them:
+        rules that do not make sense, and rules for different states that
+        cover the same badges, in which case the one with the lowest badges
+        keeps them.  Rules for the same state may overlap.
+        """
+        problems = []
+        intervals = []
+        for rule, state in rules:
+            try:
+                intervals.extend([(first, last, state, rule)
+                        for first, last in self.intervals(rule)])
+            except ValueError as error:
+                problems.append(rule + ": " + str(error))
+        intervals.sort()
+
+        starts, ends, states, owners = [], [], [], []
+        reported = set()
+        for first, last, state, rule in intervals:
+            if starts and first <= ends[-1] + 1:
+                #
+                # overlapping, or right next to, the one before
+                #
+                if states[-1] == state:
+                    ends[-1] = max(ends[-1], last)
+                    continue
+                if first <= ends[-1]:
+                    if (rule, owners[-1]) not in reported:
+                        reported.add((rule, owners[-1]))
+                        problems.append(rule + " (" + state + ") and " +
+                                owners[-1] + " (" + states[-1] + ") " +
+                                "both cover " + str(first))
+                    if last <= ends[-1]:
+                        continue
+                    first = ends[-1] + 1
+            starts.append(first)
+            ends.append(last)
+            states.append(state)
+            owners.append(rule)
+
+        self.starts, self.ends, self.states = starts, ends, states
+        return problems
+
+    def lookup(self, badge_id):
+        """
+        the state that the rules call for, or None
+        """
+        if not self.starts or not isinstance(badge_id, basestring) or \
+                not badge_id.isdigit():
+            return None
+        number = int(badge_id)
+        index = bisect.bisect_right(self.starts, number) - 1
+        if index >= 0 and number <= self.ends[index]:
+            return self.states[index]
+        return None
+
+    def __len__(self):
+        return len(self.starts)
+
 class HardcodedRFIDs(Connection, threading.Thread):
     """
     This connection type is used when you have a list of hardcoded rfid tags.
@@ -465,15 +1189,23 @@ class HardcodedRFIDs(Connection, threading.Thread):
 
         there is only one state to check, and it must be present: check_badge
         check_badge is a dictionary of states to switch to, followed by ":when",
-        the content of the dictionary is a list of rfid tags.
+        the content of the dictionary is a list of rfid tags, and of rules for
+        ranges, prefixes and facility codes of them, see BadgeRules.
+
+        badge_file, which is optional, is a roster compiled by badge_index.py,
+        for when there are too many badges to list here.  The badges listed
+        here are looked up first, then those in the roster, then the rules,
+        then "default".  So a badge can be listed as an exception to a rule.
 
         example config:
 
         "test_validation": {
             "type": "internal:hardcoded_rfids",
+            "badge_file": "/var/lib/muther/badges.idx",
             "check_badge": {
                 "error:maintenance:when": ["11505625070", "32885801092"],
                 "active:when": ["21505625070", "12885801092"],
+                "inactive:when": ["4200000-4299999", "facility:123"],
                 "login_denied:when": ["default"],
             }
         }
@@ -493,15 +1225,18 @@ class HardcodedRFIDs(Connection, threading.Thread):
                 if status == MessageTypes.CHECK_BADGE}
 
         self.rfid_to_action_mapping = dict()
+        rules = []
         for state, state_config in state_configs.items():
             error_prefix = connection + ": " + state + ": "
             log.info(connection + ": " + state + ", " +
                     "state_config: " + repr(state_config))
-            for when_clause, rfid_listing in state_config.items():
+            for when_clause, rfid_listing in sorted(state_config.items()):
                 if when_clause.split(":")[-1] == "when":
                     action = ":".join(when_clause.split(":")[:-1])
                     for rfid in rfid_listing:
-                        if rfid not in self.rfid_to_action_mapping:
+                        if BadgeRules.is_rule(rfid):
+                            rules.append((rfid, action))
+                        elif rfid not in self.rfid_to_action_mapping:
                             self.rfid_to_action_mapping[rfid] = action
                         else:
                             log.error(error_prefix + rfid + 
@@ -509,24 +1244,49 @@ class HardcodedRFIDs(Connection, threading.Thread):
                                     "configured to " + 
                                     self.rfid_to_action_mapping[rfid] )
 
+        self.rules = BadgeRules()
+        for problem in self.rules.compile(rules):
+            log.error(connection + ": " + MessageTypes.CHECK_BADGE + ": " +
+                    problem)
+
+        #
+        # the roster, which is searched where it lies rather than loaded
+        #
+        self.badge_index = None
+        if config.get("badge_file") != None:
+            try:
+                self.badge_index = badge_index.BadgeIndex(config["badge_file"])
+                log.info(connection + ": " + repr(len(self.badge_index)) +
+                        " badges in " + config["badge_file"])
+            except (IOError, OSError, ValueError) as error:
+                log.error(connection + ": badge_file: needs to be a roster " +
+                        "compiled by badge_index.py: " + repr(error))
+
+    def handles(self):
+        return [MessageTypes.CHECK_BADGE]
+
     def update(self, action_message):
-        status = action_message["state"]
+        status = action_message.state
 
         if status == MessageTypes.CHECK_BADGE:
             log = logging.getLogger("HardcodedRFIDs.update")
             error_prefix = self.connection + ": "
 
             new_state = None
-            badge_id = action_message["badge_id"]
+            badge_id = action_message.badge_id
             if badge_id in self.rfid_to_action_mapping:
                 new_state = self.rfid_to_action_mapping[badge_id]
-            elif "default" in self.rfid_to_action_mapping:
+            elif self.badge_index != None and badge_id != None:
+                new_state = self.badge_index.lookup(badge_id)
+            if new_state == None:
+                new_state = self.rules.lookup(badge_id)
+            if new_state == None and "default" in self.rfid_to_action_mapping:
                 new_state = self.rfid_to_action_mapping["default"]
 
             if new_state:
-                self.interlock.action_queue.put(
-                    {"state": new_state,
-                    "from": "HardcodedRFIDs.run()"})
+                self.interlock.action_queue.put(ActionMessage(
+                        new_state, "HardcodedRFIDs.run()",
+                        connection=self.connection))
 
             log.debug(error_prefix + ": returned from call")
 
@@ -536,74 +1296,416 @@ class HardcodedRFIDs(Connection, threading.Thread):
 #
 ################################################################################
 
-class WebServiceConnection(Connection, threading.Thread):
+def read_endpoints(config, default_timeout, error_prefix):
     """
-    This connection type is used to connect with webservices.
+    Returns the endpoints of a webservice state config as a dictionary of name
+    to {"url": url, "timeout": seconds, "optional": bool}, or None if they are
+    not valid.
+
+    "url" is the unnamed endpoint, whose reply is merged as is.  "endpoints"
+    is a dictionary of named endpoints, each either a url or a dictionary with
+    "url" and optionally "timeout" and "optional".  Nothing is decided while
+    an endpoint that is not optional is missing its reply.
     """
-    def __init__(self, interlock, connection, config):
-        """
-        format: so far only json
+    log = logging.getLogger("WebServiceConnection.init")
+    endpoints = {}
+    if 'url' in config:
+        endpoints[""] = config['url']
+    named_endpoints = config.get('endpoints', {})
+    if not isinstance(named_endpoints, dict):
+        log.error(error_prefix + "endpoints: needs to be a dictionary")
+        return None
+    endpoints.update(named_endpoints)
+
+    if not endpoints:
+        log.error(error_prefix + "url: missing")
+        return None
+
+    for name, endpoint in endpoints.items():
+        if isinstance(endpoint, unicode):
+            endpoint = {"url": endpoint}
+        if not isinstance(endpoint, dict) or \
+                type(endpoint.get('url')) != unicode:
+            log.error(error_prefix + (name + ": " if name else "") +
+                    "url: needs to be a string")
+            return None
+        try:
+            timeout = float(endpoint.get('timeout', default_timeout))
+        except (TypeError, ValueError):
+            log.error(error_prefix + name + ": timeout: " +
+                    repr(endpoint['timeout']) + " needs to be a float or int")
+            return None
+        optional = endpoint.get('optional', False)
+        if type(optional) != bool:
+            log.error(error_prefix + name + ": optional: " +
+                    repr(optional) + " needs to be true or false")
+            return None
+        endpoints[name] = {"url": endpoint['url'], "timeout": timeout,
+                "optional": optional}
+    return endpoints
+
+class GrantCache(object):
+    """
+    The badges which were recently granted access to each tool, so that they
+    can be let in while the webservice cannot be reached.  The tools in one
+    process share one.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.grants = {}
 
-        inside each state is is a webservice:
-        url: the url which can be build, put {badge_id} and {tool_id} inside the
-            url
-        save_reply: set to true if we need the data from one reply to feed
-            another url
-        new_state: is a dictionary where the keys are the new states and their
-            data is the returned data which must match the data from the url
-            call.
+    def get(self, tool_id, badge_id, grace_seconds):
         """
-        threading.Thread.__init__(self)
-        Connection.__init__(self, interlock, connection, config)
-
-        log = logging.getLogger("WebServiceConnection.init")
-        log.info("creating: " + connection)
-        self.saved_reply = dict()
-
-        self.run_state = None
-        self.connection = connection
-        self.interlock = interlock
-        self.action_message = {}
-
-        error_prefix = self.connection + ": "
+        the state that badge_id was granted on tool_id within the last
+        grace_seconds, or None
+        """
+        key = (tool_id, badge_id)
+        with self.lock:
+            grant = self.grants.get(key)
+            if grant != None:
+                granted_at, state = grant
+                if monotonic() - granted_at <= grace_seconds:
+                    return state
+                del self.grants[key]
+        return None
+
+    def remember(self, tool_id, badge_id, state, granted):
+        """
+        remember that badge_id was just given state on tool_id, or forget it
+        if that was not a grant
+        """
+        key = (tool_id, badge_id)
+        with self.lock:
+            if granted:
+                self.grants[key] = (monotonic(), state)
+            else:
+                self.grants.pop(key, None)
 
-        #
-        # these are indexed by MessageTypes.ALL_STATES
-        #
-        self.state_to_actions = {}
-        state_configs = {
-                state: state_config
-                for state, state_config in config.items()
-                if state in MessageTypes.ALL_STATES}
+def fetch_endpoints(endpoints, parms, recorder=None, channel=None):
+    """
+    Query all of the endpoints at the same time, each with its own timeout.
+    recorder, when there is one, records every reply, and every failure, as
+    having come from channel.
+
+    Returns the replies merged into one dictionary, the replies by endpoint
+    name, and a dictionary of endpoint name to what went wrong for the
+    endpoints that could not be reached, whose url needs a parameter that we
+    do not have, or whose reply is not JSON.  Every key of a named endpoint's
+    reply is merged as "name.key", so that two endpoints replying with the
+    same key cannot overwrite each other; the unnamed endpoint's reply is
+    merged as is.
+    """
+    log = logging.getLogger("WebServiceConnection.run")
+    replies = {}
+    errors = {}
 
-        for state, state_config in state_configs.items():
+    def fetch(name, endpoint, result):
+        """
+        fetch one endpoint into result, which only this thread writes to, so
+        that a thread which outlives its timeout cannot change what has
+        already been returned
+        """
+        labels = (("endpoint", name or "default"),)
+        try:
+            url = endpoint['url'].format(**parms)
+        except KeyError as error:
+            result['error'] = "Cannot build " + endpoint['url'] + \
+                    " without " + str(error)
+            metrics.registry.inc("muther_webservice_errors_total",
+                    labels + (("reason", "format"),))
+            return
+        request_start = monotonic()
+        try:
+            log.info("WebServiceConnection.run(): sent: " + url)
+            json_response = urllib2.urlopen(url, timeout=endpoint['timeout']) \
+                    .readline()
+            log.info("WebServiceConnection.run(): got: " + json_response)
+        except (urllib2.HTTPError, httplib.HTTPException):
+            #
+            # HTTPException for a bad status line or a reply cut short
+            #
+            result['error'] = "Cannot contact " + url + " (HTTP)"
+            metrics.registry.inc("muther_webservice_errors_total",
+                    labels + (("reason", "http"),))
+            if recorder != None:
+                recorder.reply(channel, url, None, "http",
+                        monotonic() - request_start)
+            return
+        except (urllib2.URLError, socket.timeout, socket.error, ValueError):
+            #
+            # ValueError for a url that is not one
+            #
+            result['error'] = "Cannot contact " + url + " (URL)"
+            metrics.registry.inc("muther_webservice_errors_total",
+                    labels + (("reason", "url"),))
+            if recorder != None:
+                recorder.reply(channel, url, None, "url",
+                        monotonic() - request_start)
+            return
+        finally:
+            metrics.registry.observe("muther_webservice_request_seconds",
+                    monotonic() - request_start, labels)
+        if recorder != None:
+            recorder.reply(channel, url, json_response, None,
+                    monotonic() - request_start)
+        try:
+            result['reply'] = json.loads(json_response)
+        except ValueError as error:
+            result['error'] = "Cannot process the reply from " + url + \
+                    " (JSON)"
+            metrics.registry.inc("muther_webservice_errors_total",
+                    labels + (("reason", "json"),))
+            # ValueError('No JSON object could be decoded',)
+            log.warning("WebServiceConnection.run(): " + repr(error) +
+                    ": cannot process: json_reply: " + repr(json_response))
+
+    if len(endpoints) == 1:
+        name, endpoint = endpoints.items()[0]
+        result = {}
+        fetch(name, endpoint, result)
+        results = [(name, result)]
+    else:
+        threads = []
+        for name, endpoint in endpoints.items():
+            result = {}
+            thread = threading.Thread(target=fetch,
+                    args=(name, endpoint, result))
+            thread.daemon = True
+            thread.start()
+            threads.append((name, endpoint, thread, result))
+        results = []
+        for name, endpoint, thread, result in threads:
+            thread.join(endpoint['timeout'] + 1)
+            if thread.is_alive():
+                #
+                # leave it to finish on its own, into a result nobody reads
+                #
+                result = {"error": "Cannot contact " + endpoint['url'] +
+                        " (timeout)"}
+                metrics.registry.inc("muther_webservice_errors_total",
+                        (("endpoint", name or "default"),
+                        ("reason", "timeout")))
+            results.append((name, result))
+
+    for name, result in results:
+        if 'error' in result:
+            errors[name] = result['error']
+        elif 'reply' in result:
+            replies[name] = result['reply']
+
+    merged = {}
+    for name in sorted(replies):
+        reply = replies[name]
+        if not name:
+            if isinstance(reply, dict):
+                merged.update(reply)
+        elif isinstance(reply, dict):
+            for key, value in reply.items():
+                merged[name + "." + key] = value
+        else:
+            merged[name] = reply
+    return merged, replies, errors
+
+def required_errors(endpoints, errors):
+    """
+    the errors from fetch_endpoints() of the endpoints that are not optional,
+    without whose replies nothing can be decided
+    """
+    return {name: error for name, error in errors.items()
+            if not endpoints.get(name, {}).get('optional')}
+
+def match_state(state_config, response):
+    """
+    find which new state has the most matches: state_config holds the
+    "<state>:when" conditions, each a dictionary of what the response must
+    contain.  When an error state ties with other states, the error state
+    wins, so that a tool that is down is not left waiting on a badge that
+    is also denied.  Returns None when no state matches, or when more than
+    one matches best and not just one of those is an error.
+    """
+    test_conditions = {
+            new_state[:-5]: condition
+            for new_state, condition in state_config.items()
+            if new_state[-5:] == ":when"}
+    matched_conditions_count = 0
+    matched_conditions_states = []
+    for potential_new_state in test_conditions:
+        conditions = test_conditions[potential_new_state]
+        if all([key in response and response[key] == conditions[key]
+            for key in conditions]):
+
+            if len(conditions) == matched_conditions_count:
+                matched_conditions_states += [potential_new_state]
+
+            if len(conditions) > matched_conditions_count:
+                matched_conditions_states = [potential_new_state]
+                matched_conditions_count = len(conditions)
+
+    if len(matched_conditions_states) > 1:
+        matched_conditions_states = [state
+                for state in matched_conditions_states
+                if state.split(":")[0] == MessageTypes.ERROR]
+    if matched_conditions_count and len(matched_conditions_states) == 1:
+        return matched_conditions_states[0]
+    return None
+
+class CircuitBreaker(object):
+    """
+    Keeps track of whether a backend is failing, so that we stop waiting on it:
+
+        closed: all is well, every request goes through
+        open: the last failures requests failed, so requests fail straight
+            away without being sent
+        half_open: open_seconds have passed since it opened, one request is
+            let through as a probe.  If it succeeds the breaker closes,
+            otherwise it opens again for another open_seconds.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failures=3, open_seconds=30):
+        self.failure_threshold = failures
+        self.open_seconds = open_seconds
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+
+    def allow(self):
+        """
+        returns whether a request may be sent now, and the state that the
+        breaker is in.  A request that is allowed must end in succeeded() or
+        failed(), or a half open breaker would never let another one through.
+        """
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True, self.state
+            if self.state == self.OPEN and \
+                    monotonic() - self.opened_at >= self.open_seconds:
+                self.state = self.HALF_OPEN
+                return True, self.state
+            return False, self.state
+
+    def succeeded(self):
+        """
+        a request got an answer
+        """
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def failed(self):
+        """
+        a request did not get an answer
+        """
+        log = logging.getLogger("CircuitBreaker")
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or \
+                    self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    log.info("opening after " + repr(self.failures) +
+                            " failures")
+                self.state = self.OPEN
+                self.opened_at = monotonic()
+
+class WebServiceConnection(Connection):
+    """
+    This connection type is used to connect with webservices.
+    """
+    def __init__(self, interlock, connection, config):
+        """
+        format: so far only json
+
+        inside each state is is a webservice:
+        url: the url which can be build, put {badge_id} and {tool_id} inside the
+            url
+        endpoints: instead of, or as well as url, a dictionary of names to
+            urls (or to {"url": url, "timeout": seconds, "optional": true})
+            which are all queried at the same time.  Their replies are merged,
+            each key as "name.key", so that a condition can be
+            {"badge.authorized": true, "maintenance.down": false}.  Nothing
+            is decided while an endpoint that is not optional is missing its
+            reply.
+        save_reply: set to true if we need the data from one reply to feed
+            another url
+        new_state: is a dictionary where the keys are the new states and their
+            data is the returned data which must match the data from the url
+            call.  The state with the most conditions that match wins, an
+            error state winning a tie.
+
+        and for the webservice as a whole:
+        timeout: seconds to wait for a reply, default 10
+        circuit_breaker: {"failures": 3, "open_seconds": 30} how many failures
+            in a row stop us from waiting on the webservice, and for how long
+            before we probe it again
+        grace_seconds: while the webservice cannot be reached, badges that
+            were granted access within this many seconds are let through,
+            default 0 which never lets anyone through
+        """
+        Connection.__init__(self, interlock, connection, config)
+
+        log = logging.getLogger("WebServiceConnection.init")
+        log.info("creating: " + connection)
+        self.saved_reply = dict()
+
+        #
+        # how long to wait, when to stop waiting, and who to let in anyway
+        #
+        try:
+            self.timeout = float(config.get("timeout", 10))
+            self.grace_seconds = float(config.get("grace_seconds", 0))
+            breaker_config = config.get("circuit_breaker", {})
+            self.breaker = CircuitBreaker(
+                    int(breaker_config.get("failures", 3)),
+                    float(breaker_config.get("open_seconds", 30)))
+        except (TypeError, ValueError, AttributeError):
+            self.timeout = 10
+            self.grace_seconds = 0
+            self.breaker = CircuitBreaker()
+            log.error(connection + ": timeout, grace_seconds and " +
+                    "circuit_breaker need to be numbers")
+        self.grant_states = [MessageTypes.ACTIVE]
+
+        self.run_state = None
+        self.connection = connection
+        self.interlock = interlock
+        self.action_message = {}
+
+        error_prefix = self.connection + ": "
+
+        #
+        # these are indexed by MessageTypes.ALL_STATES
+        #
+        self.state_to_actions = {}
+        state_configs = {
+                state: state_config
+                for state, state_config in config.items()
+                if state in MessageTypes.ALL_STATES}
+
+        for state, state_config in state_configs.items():
             error = False
             error_prefix = connection + ": " + state + ": "
             log.info(connection + ": " + state + ", " +
                     "state_config: " + repr(state_config))
 
-            if isinstance(state_config, dict):
+            if isinstance(state_config, unicode):
                 #
-                # verify the presense of "url"
+                # We must have only be give a string, better be a url
                 #
-                if 'url' not in state_config:
-                    error = True
-                    log.error(error_prefix + "url: missing")
-                elif type(state_config['url']) != unicode:
-                    error = True
-                    log.error(error_prefix + "url: needs to be a string")
-                else:
-                    #
-                    # default in save_reply
-                    #
-                    if 'save_reply' not in state_config:
-                        state_config["safe_reply"] = False
+                state_config = {"url": state_config, "save_reply": False}
 
-            elif isinstance(state_config, unicode):
+            if isinstance(state_config, dict):
                 #
-                # We must have only be give a string, better be a url
+                # verify the presense of "url" or "endpoints"
                 #
-                state_config = {"url": state_config, "save_reply": False}
+                endpoints = read_endpoints(
+                        state_config, self.timeout, error_prefix)
+                if endpoints == None:
+                    error = True
+                else:
+                    state_config["endpoints"] = endpoints
             else:
                 #
                 # not quite sure how to process this
@@ -647,9 +1749,17 @@ class WebServiceConnection(Connection, threading.Thread):
             print "trying to start heartbeat_monitor on " + \
                     config["heartbeat_monitor"]["url"]
             self.network_heartbeat = NetworkHeartbeatMonitor(
-                config["heartbeat_monitor"]["url"],
-                self.interlock.action_queue)
-            self.network_heartbeat.start()
+                config["heartbeat_monitor"],
+                self.interlock.action_queue,
+                self.interlock.tool_id,
+                self.recorder, self.connection)
+            if self.network_heartbeat.endpoints == None:
+                raise KeyError("heartbeat_monitor")
+            if interlock.runtime == "reactor":
+                self.network_heartbeat.attach(interlock.scheduler,
+                        interlock.executor)
+            else:
+                self.network_heartbeat.start()
             print "starting heartbeat_monitor on " + \
                     config["heartbeat_monitor"]["url"]
         except KeyError:
@@ -659,14 +1769,32 @@ class WebServiceConnection(Connection, threading.Thread):
         # done with all processing, lets change our state to reflect that the
         # system is powered up
         #
-        self.update({"state": MessageTypes.POWER_UP})
+        self.update(ActionMessage(MessageTypes.POWER_UP))
+
+    def stop(self):
+        """
+        the heartbeat goes with us
+        """
+        Connection.stop(self)
+        if self.network_heartbeat != None:
+            self.network_heartbeat.stop()
+
+    def handles(self):
+        """
+        the states that we query the webservice for, and the ones that the
+        heartbeat keeps track of
+        """
+        states = list(self.state_to_actions)
+        if self.network_heartbeat:
+            states += NetworkHeartbeatMonitor.states_to_remember
+        return states
 
     def update(self, action_message):
         # print "ConnectionWebService: " + repr(action_message)
         if self.network_heartbeat:
             self.network_heartbeat.update(action_message)
 
-        status = action_message["state"]
+        status = action_message.state
 
         if status in self.state_to_actions:
             log = logging.getLogger("WebServiceConnection.update")
@@ -674,98 +1802,158 @@ class WebServiceConnection(Connection, threading.Thread):
 
             self.action_message = action_message
             self.run_state = self.state_to_actions[status]
-            threading.Thread.__init__(self)
-            self.start()
+            if self.interlock.runtime == "reactor":
+                self.interlock.executor.submit(self.query,
+                        (action_message, self.run_state))
+            else:
+                query = threading.Thread(target=self.query,
+                        args=(action_message, self.run_state))
+                query.daemon = True
+                query.start()
 
             log.debug(error_prefix + ": returned from call")
 
-    def run(self):
+    def cached_grant(self, badge_id):
+        """
+        returns the state that badge_id was granted within the last
+        grace_seconds, or None
+        """
+        return self.interlock.host.grants.get(self.interlock.tool_id,
+                badge_id, self.grace_seconds)
+
+    def remember_grant(self, badge_id, state):
+        """
+        keep track of badges which were recently granted access, and forget
+        the ones which were not
+        """
+        self.interlock.host.grants.remember(self.interlock.tool_id, badge_id,
+                state, state in self.grant_states)
+
+    def network_error(self, badge_id, msg):
+        """
+        we could not get an answer from the webservice.  If the badge was
+        recently granted access let it through anyway, otherwise let everyone
+        know that the network is down.
+        """
+        log = logging.getLogger("WebServiceConnection.run")
+        cached_state = self.cached_grant(badge_id)
+        if cached_state != None:
+            log.error(msg + ", using cached grant for " + repr(badge_id))
+            self.interlock.action_queue.put(ActionMessage(
+                    cached_state, "WebServiceConnection.run() cached grant",
+                    connection=self.connection))
+        else:
+            log.error(msg)
+            self.interlock.action_queue.put(ActionMessage(
+                    MessageTypes.ERROR_NETWORK, msg,
+                    connection=self.connection))
+
+    def query(self, action_message, run_state):
         """
         This is used when we query the webservice so that we don't have to wait
         for the webservice query to complete when we make our query before
         updating the other connections.
+
+        Requests go through the circuit breaker.  While it is open we do not
+        wait on the webservice at all, and badges with a recent grant are
+        answered from the cache.  The probe that is let through once it is
+        half open is waited on like any other request, and only falls back on
+        the cache if it fails, so that a badge which has since been revoked is
+        not let in.
         """
         log = logging.getLogger("WebServiceConnection.run")
 
-        parms = self.run_state.copy()
+        parms = run_state.copy()
         parms["tool_id"] = self.interlock.tool_id
-        # print repr(self.action_message)
+        # print repr(action_message)
 
-        for key, value in self.action_message.items():
+        for key, value in action_message.items():
             parms[key] = value
 
         for key, value in self.saved_reply.items():
             parms[key] = value
 
-        # print repr(self.run_state['url'])
+        badge_id = action_message.badge_id
+        allowed = self.breaker.allow()[0]
+        if not allowed:
+            cached_state = self.cached_grant(badge_id)
+            if cached_state != None:
+                self.interlock.action_queue.put(ActionMessage(
+                        cached_state,
+                        "WebServiceConnection.run() cached grant",
+                        connection=self.connection))
+            else:
+                self.network_error(badge_id,
+                        "WebServiceConnection.run(): " + self.connection +
+                        ": circuit open, not waiting on the webservice")
+            return
+
+        # print repr(run_state['endpoints'])
         # print repr(parms)
-        json_response = ""
         try:
-            url = self.run_state['url'].format(**parms)
-            log.info("WebServiceConnection.run(): sent: " + url)
-            json_response = urllib2.urlopen(url).readline()
-            log.info("WebServiceConnection.run(): got: " + json_response)
-        except KeyError:
+            response, replies, errors = fetch_endpoints(run_state['endpoints'],
+                    parms, self.recorder, self.connection)
+        except Exception as error:
             #
-            # we don't care
+            # whatever went wrong, the breaker has to hear of it, or a probe
+            # would leave it half open for good
             #
-            pass
-        except urllib2.HTTPError:
-            msg = "WebServiceConnection.run(): Cannot contact " + url + \
-                    " (HTTP)"
-            self.interlock.action_queue.put({
-                "state": MessageTypes.ERROR_NETWORK,
-                "from": msg})
-            log.error(msg)
-        except urllib2.URLError:
-            msg = "WebServiceConnection.run(): Cannot contact " + url + " (URL)"
-            self.interlock.action_queue.put({
-                "state": MessageTypes.ERROR_NETWORK,
-                "from": msg})
-            log.error(msg)
+            log.exception("WebServiceConnection.run(): " + self.connection +
+                    ": query failed")
+            response, replies, errors = {}, {}, {None: repr(error)}
 
-        try:
-            response = json.loads(json_response)
-            # print "lets parse " + repr(response)
-            if self.run_state['save_reply']:
-                self.saved_reply = response
+        if not replies:
+            #
+            # nothing came back that we could use, which has to count as a
+            # failure even without an error, or a probe would leave the
+            # breaker half open for good
+            #
+            self.breaker.failed()
+            self.network_error(badge_id, "WebServiceConnection.run(): " +
+                    (" and ".join(errors.values()) or self.connection +
+                    ": no replies"))
+            return
+
+        self.breaker.succeeded()
+        if self.network_heartbeat:
+            self.network_heartbeat.note_reply()
+        if run_state['save_reply']:
+            self.saved_reply = response
 
+        missing = required_errors(run_state['endpoints'], errors)
+        if missing:
             #
-            # find which new state has the most matches
+            # without the replies we are missing, nothing can be decided,
+            # even when what did come back happens to match a state
             #
-            test_conditions = {
-                    new_state[:-5]: condition
-                    for new_state, condition in self.run_state.items()
-                    if new_state[-5:] == ":when"}
-            matched_conditions_count = 0
-            matched_conditions_states = []
-            for potential_new_state in test_conditions:
-                conditions = test_conditions[potential_new_state]
-                if all([response[key] == conditions[key]
-                    for key in conditions]):
-
-                    if len(conditions) == matched_conditions_count:
-                        matched_conditions_states += [potential_new_state]
-
-                    if len(conditions) > matched_conditions_count:
-                        matched_conditions_states = [potential_new_state]
-                        matched_conditions_count = len(conditions)
-
-            if matched_conditions_count and len(matched_conditions_states) == 1:
-                self.interlock.action_queue.put({
-                    "state": matched_conditions_states[0],
-                    "from": "ConnectionWebservice.run()"})
-        except ValueError as error:
-            # ValueError('No JSON object could be decoded',)
-            print "WebServiceConnection.run(): " + repr(error)
-            print "WebServiceConnection.run(): cannot process: json_reply: " + \
-                    repr(json_response)
-        except Exception as error:
-            print "WebServiceConnection.run(): " + repr(error)
+            self.network_error(badge_id, "WebServiceConnection.run(): " +
+                    " and ".join(missing.values()))
+            return
+
+        for name, error in errors.items():
+            log.warning("WebServiceConnection.run(): " + self.connection +
+                    ": " + name + " (optional): " + error)
+        new_state = match_state(run_state, response)
+        if new_state != None:
+            if badge_id != None:
+                self.remember_grant(badge_id, new_state)
+            self.interlock.action_queue.put(ActionMessage(
+                    new_state, "ConnectionWebservice.run()",
+                    connection=self.connection))
 
 class NetworkHeartbeatMonitor(threading.Thread):
     """
     This is likely to go away, and be rolled int ConnectionWebService
+
+    Checks that makermanager can be reached while the tool is not in use.  To
+    go easy on the server when every tool in the building does this:
+
+        a heartbeat is skipped when a recent check_badge reply already showed
+        that the server is reachable
+        every wait is jittered so that the tools drift apart
+        while the server is down, the wait doubles after each failure
+        the server is only declared recovered after recovery_probes probes in
+        a row succeed
     """
     states_to_remember = [
         MessageTypes.ACTIVE,
@@ -783,102 +1971,397 @@ class NetworkHeartbeatMonitor(threading.Thread):
         MessageTypes.ERROR_MAINTENANCE
     ]
 
-    def __init__(self, query_url, action_queue):
+    def __init__(self, config, action_queue, tool_id="", recorder=None,
+            channel=None):
         """
-        This is likely to go away, and be rolled int ConnectionWebService
+        config is the heartbeat_monitor section of the webservice, recorder
+        records the replies as having come from channel:
+
+        url: what to query, put {badge_id} and {tool_id} inside the url
+        endpoints: more urls to query at the same time, such as the tool's
+            maintenance status, see WebServiceConnection.  "<state>:when"
+            conditions on the merged replies, such as
+            "error:maintenance:when": {"maintenance.down": true}, pick the
+            state to be in while the server is reachable, otherwise inactive.
+        interval: seconds between heartbeats while all is well, default 30
+        timeout: seconds to wait for the server to reply, default 10
+        backoff_max: the longest wait between probes while the server is down,
+            default 300
+        recovery_probes: how many probes in a row must succeed before the
+            server is considered to be back, default 2
+        jitter: the fraction by which every wait is randomly varied, default
+            0.1
         """
         threading.Thread.__init__(self)
         self.current_mode = MessageTypes.POWER_UP
         self.action_queue = action_queue
-        self.query_url = query_url
+        self.tool_id = tool_id
+        self.recorder = recorder
+        self.channel = channel
+        self.config = config
+        self.mode_changed = WakeupEvent()
+        self.stopped = False
+
+        self.interval = float(config.get("interval", 30))
+        self.timeout = float(config.get("timeout", 10))
+        self.endpoints = read_endpoints(config, self.timeout,
+                "heartbeat_monitor: ")
+        self.backoff_max = float(config.get("backoff_max", 300))
+        self.recovery_probes = int(config.get("recovery_probes", 2))
+        self.jitter = float(config.get("jitter", .1))
+
+        #
+        # last_reply is when makermanager last answered anyone, failures
+        # how many probes in a row have failed, and successes how many probes
+        # have succeeded since then
+        #
+        self.last_reply = None
+        self.failures = 0
+        self.successes = 0
+
+        #
+        # so that we only tell the interlock once, until it has let us know
+        # about its new state
+        #
+        self.posted = False
+
+        #
+        # in the reactor runtime: the scheduler and executor that we beat
+        # from, the next beat, and whether a check is under way
+        #
+        self.scheduler = None
+        self.executor = None
+        self.timer = None
+        self.checking = False
+
+    def stop(self):
+        """
+        end the heartbeat, its webservice connection is being replaced
+        """
+        self.stopped = True
+        if self.timer != None:
+            self.timer.cancel()
+        self.mode_changed.close()
 
     def update(self, action_message):
         """
-        called from ConnectionWebService instead of main Interlock object
+        called from ConnectionWebService instead of main Interlock object.
+        Wakes up the heartbeat when it needs to start checking makermanager
+        again.
         """
-        new_state = action_message["state"]
+        new_state = action_message.state
         if new_state in self.states_to_remember:
+            was_checking = \
+                    self.current_mode in self.states_to_check_makermanger
             self.current_mode = new_state
+            self.posted = False
+            if not was_checking and \
+                    new_state in self.states_to_check_makermanger:
+                self.mode_changed.set()
+                if self.scheduler != None:
+                    self.scheduler.call_soon(self.wake)
+
+    def note_reply(self):
+        """
+        called whenever makermanager has replied, so that the heartbeat does
+        not need to ask again for a while
+        """
+        self.last_reply = monotonic()
 
-    def run(self):
+    def jittered(self, seconds):
         """
-        This is the thread to watch the status of the url.
+        vary seconds by up to the jitter fraction either way
+        """
+        return seconds * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def backoff(self):
+        """
+        how long to wait before probing a server which is down: doubling with
+        each failure up to backoff_max, half of it random so that the tools
+        do not all come back at the same moment
+        """
+        seconds = min(self.backoff_max, 2.0 ** min(self.failures - 1, 16))
+        return seconds / 2 + random.uniform(0, seconds / 2)
+
+    def check_makermanager(self):
+        """
+        query makermanager once, returns what went wrong, or None and the state
+        that the replies call for
+        """
+        error_prefix = "NetworkHeartbeatMonitor.run(): "
+        response, replies, errors = fetch_endpoints(
+                self.endpoints, {"tool_id": self.tool_id, "badge_id": ""},
+                self.recorder, self.channel)
+
+        missing = required_errors(self.endpoints, errors)
+        if missing or not replies:
+            return error_prefix + "Cannot contact makermanager: " + \
+                    " and ".join((missing or errors).values()), None
+
+        #
+        # check the maintenance status
+        #
+        return None, match_state(self.config, response) or \
+                MessageTypes.INACTIVE
+
+    def next_check(self):
+        """
+        how long to wait before checking makermanager, 0 to check it now, or
+        None to wait until update() tells us that the tool is idle again
         """
         log = logging.getLogger("NetworkHeartbeatMonitor.run")
-        log.info("start")
         error_prefix = "NetworkHeartbeatMonitor.run(): "
-        while True:
-            log.info("current_mode: " + self.current_mode)
-            if self.current_mode in self.states_to_check_makermanger:
-                errors = []
-                errors_source = {}
-                #
-                # check the makermanager
-                #
-                try:
-                    url = self.query_url.format(tool_id="", badge_id="")
-                    log.info(error_prefix + "sent: " + url)
-                    json_response = urllib2.urlopen(url).readline()
-                    log.info(error_prefix + "got: " + json_response)
-                    json.loads(json_response)
+        log.info("current_mode: " + self.current_mode)
 
-                except ValueError:
-                    error_message = error_prefix + \
-                            "makermanager is not returning valid JSON"
-                    errors += [MessageTypes.ERROR_NETWORK]
-                    errors_source[MessageTypes.ERROR_NETWORK] = error_message
-                    log.error(error_message)
-
-                except urllib2.HTTPError:
-                    error_message = error_prefix + \
-                            "Cannot contact makermanager (HTTP)"
-                    errors += [MessageTypes.ERROR_NETWORK]
-                    errors_source[MessageTypes.ERROR_NETWORK] = error_message
-                    log.error(error_message)
-
-                except urllib2.URLError:
-                    error_message = error_prefix + \
-                            "Cannot contact makermanager (URL)"
-                    errors += [MessageTypes.ERROR_NETWORK]
-                    errors_source[MessageTypes.ERROR_NETWORK] = error_message
-                    log.error(error_message)
+        if self.current_mode not in self.states_to_check_makermanger:
+            #
+            # we're busy doing stuff, no point checking the network
+            # connection until update() tells us otherwise
+            #
+            return None
 
+        if self.failures == 0 and self.last_reply != None:
+            since_reply = monotonic() - self.last_reply
+            if since_reply < self.interval:
                 #
-                # check the maintenance status
+                # makermanager answered someone recently, no need to ask
                 #
+                log.info(error_prefix + "skipped, reply seen " +
+                        repr(since_reply) + " seconds ago")
+                return self.jittered(self.interval - since_reply)
+        return 0
+
+    def checked(self, result):
+        """
+        act on what check_makermanager() found, returns how long to wait
+        before checking again
+        """
+        log = logging.getLogger("NetworkHeartbeatMonitor.run")
+        error_prefix = "NetworkHeartbeatMonitor.run(): "
+        error_message, new_state = result
 
+        if error_message == None:
+            self.note_reply()
+            if self.failures:
                 #
-                # update status as necessary
+                # half open: the server answered, but make sure it stays
+                # up before telling everyone
                 #
-                if not errors:
-                    if self.current_mode != MessageTypes.INACTIVE:
-                        #
-                        # no longer have errors, let everyone know !
-                        #
-                        self.action_queue.put({
-                            "state": MessageTypes.INACTIVE,
-                            "from": error_prefix + "found network"})
-                    #
-                    # no problems, lets check again in 30 seconds so as not to
-                    # irritate the server too much
-                    #
-                    time.sleep(30)
-                elif self.current_mode not in errors:
-                    #
-                    # if the current error state is not in the current list of
-                    # errors then make take the first error
-                    #
-                    use_error = errors[0]
-                    self.action_queue.put({
-                        "state": use_error,
-                        "from": errors_source[use_error]})
-                    time.sleep(1)
-            else:
+                self.successes += 1
+                if self.successes < self.recovery_probes:
+                    log.info(error_prefix + "probe " +
+                            repr(self.successes) + " of " +
+                            repr(self.recovery_probes) + " succeeded")
+                    return self.jittered(1)
+                self.failures = 0
+                self.successes = 0
+
+            if self.current_mode != new_state and not self.posted:
                 #
-                # we're busy doing stuff, no point checking the network
-                # connection
+                # no longer have errors, or the tool has gone in or out of
+                # maintenance, let everyone know !
                 #
-                time.sleep(.5)
+                self.posted = True
+                self.action_queue.put(ActionMessage(
+                        new_state, error_prefix + "found network",
+                        connection=self.channel))
+            #
+            # no problems, lets check again in a while so as not to
+            # irritate the server too much
+            #
+            return self.jittered(self.interval)
+        else:
+            log.error(error_message)
+            self.failures += 1
+            self.successes = 0
+            if self.current_mode != MessageTypes.ERROR_NETWORK and \
+                    not self.posted:
+                self.posted = True
+                self.action_queue.put(ActionMessage(
+                        MessageTypes.ERROR_NETWORK, error_message,
+                        connection=self.channel))
+            return self.backoff()
+
+    def run(self):
+        """
+        This is the thread to watch the status of the url.
+        """
+        log = logging.getLogger("NetworkHeartbeatMonitor.run")
+        log.info("start")
+        while not self.stopped:
+            self.mode_changed.clear()
+            wakeups.tick("NetworkHeartbeatMonitor")
+
+            seconds = self.next_check()
+            if seconds != 0:
+                self.mode_changed.wait(seconds)
+                continue
+
+            result = self.check_makermanager()
+            if self.stopped:
+                break
+            self.mode_changed.wait(self.checked(result))
+
+    def attach(self, scheduler, executor):
+        """
+        in the reactor runtime, beat from the scheduler and check makermanager
+        from the executor, instead of from a thread of our own
+        """
+        self.scheduler = scheduler
+        self.executor = executor
+        scheduler.call_soon(self.beat)
+
+    def beat(self):
+        """
+        on the scheduler: check makermanager if it is time to, otherwise come
+        back when it will be
+        """
+        self.timer = None
+        if self.stopped or self.checking:
+            return
+        wakeups.tick("NetworkHeartbeatMonitor")
+        seconds = self.next_check()
+        if seconds == None:
+            return
+        if seconds > 0:
+            self.timer = self.scheduler.call_later(seconds, self.beat)
+            return
+        self.checking = True
+        self.executor.submit(self.check_makermanager, (), self.beat_checked)
+
+    def beat_checked(self, result):
+        """
+        on the scheduler, once makermanager has been checked
+        """
+        self.checking = False
+        if not self.stopped:
+            self.timer = self.scheduler.call_later(self.checked(result),
+                    self.beat)
+
+    def wake(self):
+        """
+        on the scheduler, when update() says that the tool is idle again
+        """
+        if self.timer != None:
+            self.timer.cancel()
+        self.beat()
+
+################################################################################
+#
+#  durable event log Connection
+#
+################################################################################
+
+class EventLogConnection(Connection):
+    """
+    Tells the server about sessions starting and ending, denied badges and
+    errors.  The events go through an EventJournal on disk first, so that they
+    are not lost while the server cannot be reached, and are uploaded in
+    batches.
+    """
+    error_states = [
+        MessageTypes.ERROR,
+        MessageTypes.ERROR_CONFIG,
+        MessageTypes.ERROR_NETWORK,
+        MessageTypes.ERROR_MAINTENANCE
+    ]
+
+    def __init__(self, interlock, connection, config):
+        """
+        example config:
+
+        "event_log": {
+            "type": "event_log:connection",
+            "journal": "/var/lib/muther/events.journal",
+            "url": "https://example.org/api/toolEvents?tool={tool_id}",
+            "batch_size": 50,
+            "timeout": 10,
+            "backoff_max": 300,
+            "compact_bytes": 65536
+        }
+        """
+        Connection.__init__(self, interlock, connection, config)
+
+        log = logging.getLogger("EventLogConnection.init")
+        log.info("creating: " + connection)
+
+        self.in_session = False
+        self.last_error = None
+        self.journal = None
+        error_prefix = connection + ": "
+
+        try:
+            self.journal = event_journal.EventJournal(
+                    config["journal"],
+                    config["url"].format(tool_id=interlock.tool_id),
+                    batch_size=int(config.get("batch_size", 50)),
+                    timeout=float(config.get("timeout", 10)),
+                    backoff_max=float(config.get("backoff_max", 300)),
+                    compact_bytes=int(config.get("compact_bytes", 65536)))
+            self.journal.start()
+        except KeyError as error:
+            log.error(error_prefix + repr(error.args[0]) + ": missing")
+        except (TypeError, ValueError):
+            log.error(error_prefix + "batch_size, timeout, backoff_max and " +
+                    "compact_bytes need to be numbers")
+        except (IOError, OSError) as error:
+            log.error(error_prefix + "cannot open " + config["journal"] +
+                    ": " + repr(error))
+
+    def stop(self):
+        """
+        commit what is left, and stop uploading, so that whatever replaces us
+        can open the journal
+        """
+        Connection.stop(self)
+        if self.journal != None:
+            self.journal.stop()
+
+    def event(self, event, **details):
+        """
+        put an event into the journal
+        """
+        details["event"] = event
+        details["tool_id"] = self.interlock.tool_id
+        self.journal.append(details)
+
+    def handles(self):
+        """
+        every state, while there is a journal to write to
+        """
+        return None if self.journal != None else []
+
+    def update(self, action_message):
+        """
+        turn state changes into events
+        """
+        if self.journal == None:
+            return
+        status = action_message.state
+
+        #
+        # the Interlock starts and ends sessions before telling us about the
+        # new state
+        #
+        session = self.interlock.session
+        if session != None and not self.in_session:
+            self.in_session = True
+            self.event("session_start", badge_id=session["badge_id"],
+                    start=session["start"])
+        elif session == None and self.in_session:
+            self.in_session = False
+            self.event("session_end", report=self.interlock.last_session_report)
+
+        if status == MessageTypes.LOGIN_DENIED:
+            self.event("login_denied", badge_id=self.interlock.badge_id)
+
+        if status in self.error_states:
+            if status != self.last_error:
+                self.event("error", state=status,
+                        source=action_message.source)
+            self.last_error = status
+        elif status not in MessageTypes.INFO_ONLY:
+            self.last_error = None
 
 ################################################################################
 #
@@ -892,6 +2375,7 @@ class LcdP018Output(Connection, threading.Thread):
     listening to an i2c bus and updating an lcd display with rgb led
     backlight.
     """
+    update_blocks = True
     def __init__(self, interlock, connection, config):
         """
         """
@@ -900,6 +2384,7 @@ class LcdP018Output(Connection, threading.Thread):
 
         log = logging.getLogger("LcdP018Output.init")
         log.info("creating: " + connection)
+        self.log_update = logging.getLogger("LcdP018Output.update")
         self.mode = None
         self.lcd = None
         self.timer = None
@@ -1006,7 +2491,10 @@ class LcdP018Output(Connection, threading.Thread):
         # done with all processing, lets change our state to reflect that the
         # system is powered up
         #
-        self.update({"state": MessageTypes.POWER_UP})
+        self.update(ActionMessage(MessageTypes.POWER_UP))
+
+    def handles(self):
+        return list(self.state_to_actions)
 
     def update(self, action_message):
         """
@@ -1015,18 +2503,26 @@ class LcdP018Output(Connection, threading.Thread):
         : INACTIVE_SOON
         : INACTIVE
         """
-        status = action_message["state"]
+        status = action_message.state
 
-        log = logging.getLogger("LcdP018Output.update")
-        log.info(repr(self.i2c_bus_number) + " gets " +  status)
+        #
+        # the messages are only built when someone will read them
+        #
+        log = self.log_update
+        log_info = log.isEnabledFor(logging.INFO)
+        log_debug = log.isEnabledFor(logging.DEBUG)
+        if log_info:
+            log.info(repr(self.i2c_bus_number) + " gets " +  status)
 
         if status in self.state_to_actions:
-            log.info(repr(self.i2c_bus_number) + " displays " +  status)
+            if log_info:
+                log.info(repr(self.i2c_bus_number) + " displays " +  status)
             action = self.state_to_actions[status]
 
-            for attr in ['color', 'message', 'timeout']:
-                log.debug(": ".join([
-                    repr(self.i2c_bus_number), attr, repr(action[attr])]))
+            if log_debug:
+                for attr in ['color', 'message', 'timeout']:
+                    log.debug(": ".join([
+                        repr(self.i2c_bus_number), attr, repr(action[attr])]))
 
             self.lcd.show_rgb(action['message'], action['color'])
 
@@ -1034,22 +2530,32 @@ class LcdP018Output(Connection, threading.Thread):
                 self.timer.cancel()
 
             if action['timeout']:
-                self.timer = threading.Timer(
-                        action['timeout'], self.reset_message)
-                self.timer.start()
+                self.timer = self.interlock.scheduler.call_later(
+                        action['timeout'], self.call_like_update,
+                        self.reset_message)
             elif status not in MessageTypes.INFO_ONLY:
                 self.saved_status = status
 
-            log.debug(repr(self.i2c_bus_number) + ": returned from call")
+            if log_debug:
+                log.debug(repr(self.i2c_bus_number) + ": returned from call")
 
         else:
             log.info("nothing configured")
 
-    def reset_message(self):
+    def stop(self):
         """
-        Set the message back to the more recent non-transient state
+        no more resetting the message
         """
-        if self.saved_status != None:
+        Connection.stop(self)
+        if self.timer != None:
+            self.timer.cancel()
+            self.timer = None
+
+    def reset_message(self):
+        """
+        Set the message back to the more recent non-transient state
+        """
+        if self.saved_status != None:
             action = self.state_to_actions[self.saved_status]
             self.lcd.show_rgb(action['message'], action['color'])
 
@@ -1060,26 +2566,65 @@ class LcdP018Output(Connection, threading.Thread):
 #
 ################################################################################
 
-class DigitalOutput(Connection, threading.Thread):
+class DigitalOutput(Connection):
     """
     control the works with digital output
+
+    Timed outputs, blinking and SOS are run as steps on the interlock's
+    scheduler rather than by a thread per pin.
     """
+    update_blocks = True
+    sos_sequence = [
+            (.3, True), (.3, False),
+            (.3, True), (.3, False),
+            (.3, True),
+
+            (1, False),
+
+            (1, True), (.3, False),
+            (1, True), (.3, False),
+            (1, True),
+
+            (1, False),
+
+            (.3, True), (.3, False),
+            (.3, True), (.3, False),
+            (.3, True),
+
+            (2, False),
+    ]
 
     def __init__(self, interlock, connection, config):
         """
         """
-        threading.Thread.__init__(self)
         Connection.__init__(self, interlock, connection, config)
 
         log = logging.getLogger("DigitalOutput.init")
         log.info("creating: " + connection)
 
+        #
+        # these run on the dispatch thread while the relay is switched, so
+        # the loggers are looked up once here
+        #
+        self.log_update = logging.getLogger("DigitalOutput.update")
+        self.log_turn_on = logging.getLogger("DigitalOutput.turn_on")
+        self.log_turn_off = logging.getLogger("DigitalOutput.turn_off")
+        self.log_blink = logging.getLogger("DigitalOutput.blink")
+        self.log_sos = logging.getLogger("DigitalOutput.sos")
+
         #
         # figure out what to do with this pin for all states
         #
         self.control_pin = connection
         self.timer = None
         self.blink_time = None
+        self.blink_token = None
+
+        #
+        # update() is called from the Interlock thread, and the blink steps
+        # from the scheduler thread
+        #
+        self.lock = threading.RLock()
 
         #
         # do we want a GPIO.HIGH or GPIO.LOW to turn it "on"
@@ -1169,7 +2714,10 @@ class DigitalOutput(Connection, threading.Thread):
         # done with all processing, lets change our state to reflect that this
         # pin is inactive
         #
-        self.update({"state": MessageTypes.INACTIVE})
+        self.update(ActionMessage(MessageTypes.INACTIVE))
+
+    def handles(self):
+        return list(self.state_to_actions)
 
     def update(self, action_message):
         """
@@ -1178,35 +2726,41 @@ class DigitalOutput(Connection, threading.Thread):
         : INACTIVE_SOON
         : INACTIVE
         """
-        status = action_message["state"]
+        status = action_message.state
 
-        log = logging.getLogger("DigitalOutput.update")
-        log.info(self.control_pin + " gets " +  status)
+        log = self.log_update
+        log_debug = log.isEnabledFor(logging.DEBUG)
+        if log.isEnabledFor(logging.INFO):
+            log.info(self.control_pin + " gets " +  status)
 
         if status in self.state_to_actions:
-            log.info(self.control_pin + " gets " +  status)
             # print repr(self.state_to_actions[status])
             #    self.state_to_actions[state] =
             #        {"function": function, "parameter": seconds}
 
             action = self.state_to_actions[status]
 
-            log.debug(self.control_pin + ": action[parameter]: " +
-                    repr(action['parameter']))
-            log.debug(self.control_pin + ": action.keys(): " +
-                    repr(action.keys()))
+            if log_debug:
+                log.debug(self.control_pin + ": action[parameter]: " +
+                        repr(action['parameter']))
+                log.debug(self.control_pin + ": action.keys(): " +
+                        repr(action.keys()))
 
             function = action['function']
             parameter = action['parameter']
-            if parameter != None:
-                function(parameter)
-            else:
-                function()
-            log.debug(self.control_pin + ": returned from call")
+            with self.lock:
+                if parameter != None:
+                    function(parameter)
+                else:
+                    function()
+            if log_debug:
+                log.debug(self.control_pin + ": returned from call")
 
         elif status == "ERROR":
-            log.info(self.control_pin + ": found ERROR to do")
-            self.sos()
+            if log.isEnabledFor(logging.INFO):
+                log.info(self.control_pin + ": found ERROR to do")
+            with self.lock:
+                self.sos()
         else:
             log.info("nothing configured")
 
@@ -1214,122 +2768,110 @@ class DigitalOutput(Connection, threading.Thread):
         """
         turn the line on, taking into account whether it is HIGH or LOW on
         """
-        log = logging.getLogger("DigitalOutput.turn_on")
-        log.info(self.control_pin + ": seconds: " + repr(seconds))
+        log = self.log_turn_on
+        if log.isEnabledFor(logging.INFO):
+            log.info(self.control_pin + ": seconds: " + repr(seconds))
         self.clear_threads()
-        if seconds == None:
-            GPIO.output(self.control_pin, self._on)
-            self.timer = None
-        else:
-            GPIO.output(self.control_pin, self._on)
-            self.timer = threading.Timer(seconds, self.turn_off)
-            # lambda: GPIO.output(self.control_pin, self.off))
-            log.debug(self.control_pin + ": starting timer")
-            self.timer.start()
+        GPIO.output(self.control_pin, self._on)
+        if seconds != None:
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug(self.control_pin + ": starting timer")
+            self.timer = self.interlock.scheduler.call_later(
+                    seconds, self.timed_step, self.turn_off)
 
     def turn_off(self, seconds=None):
         """
         turn the line off, taking into account whether it is HIGH or LOW on
         """
-        log = logging.getLogger("DigitalOutput.turn_off")
-        log.info(self.control_pin + ": (" + repr(seconds) + ")")
+        log = self.log_turn_off
+        if log.isEnabledFor(logging.INFO):
+            log.info(self.control_pin + ": (" + repr(seconds) + ")")
         self.clear_threads()
         if seconds == None:
             GPIO.output(self.control_pin, self.off)
         else:
-            self.timer = threading.Timer(seconds, self.turn_on)
-            log.debug(self.control_pin + ": starting timer")
-            self.timer.start()
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug(self.control_pin + ": starting timer")
+            self.timer = self.interlock.scheduler.call_later(
+                    seconds, self.timed_step, self.turn_on)
+
+    def timed_step(self, function):
+        """
+        the end of a timed on or off
+        """
+        with self.lock:
+            function()
 
     def blink(self, seconds=.5):
         """
         make the digital line blink, the interval can be passed in, or defaults
         to a blink per second
         """
-        log = logging.getLogger("DigitalOutput.blink")
-        log.info(self.control_pin + ": (" + repr(seconds) + ")")
+        log = self.log_blink
+        if log.isEnabledFor(logging.INFO):
+            log.info(self.control_pin + ": (" + repr(seconds) + ")")
         self.clear_threads()
         self.blink_time = seconds
-        threading.Thread.__init__(self)
-        self.start()
+        self.blink_token = object()
+        self.blink_step(self.blink_token, True)
 
     def sos(self, seconds=None):
         """
         make the digital line blink SOS in morese code
         """
-        log = logging.getLogger("DigitalOutput.sos")
-        log.info(self.control_pin + ": (" + repr(seconds) + ")")
+        log = self.log_sos
+        if log.isEnabledFor(logging.INFO):
+            log.info(self.control_pin + ": (" + repr(seconds) + ")")
         self.clear_threads()
         self.blink_time = "sos"
-        self.start()
-
-    def run(self):
-        """
-        This is used when we blink the output
-        """
-        log = logging.getLogger("DigitalOutput.run")
-        log.info(self.control_pin + ": (" + repr(self.blink_time) + ")")
-        while self.blink_time != None:
-            if self.blink_time == "sos":
-                self.run_sos()
-            else:
-                self.run_blink()
+        self.blink_token = object()
+        self.sos_step(self.blink_token, 0)
 
-    def run_blink(self):
+    def blink_step(self, blink_token, blink_high):
         """
-        this is the task which actually blinks the digitial output
+        one toggle of the blinking digitial output, which schedules the next
         """
-        log = logging.getLogger("DigitalOutput.blink")
-        log.info(self.control_pin + ": cycle time: " + repr(self.blink_time))
-        blink_high = True
-        while self.blink_time != None:
+        with self.lock:
+            if self.blink_token is not blink_token:
+                return
             GPIO.output(self.control_pin,
                     {True: self._on, False: self.off}[blink_high])
-            blink_high = not blink_high
-            time.sleep(self.blink_time)
+            self.timer = self.interlock.scheduler.call_later(
+                    self.blink_time, self.blink_step, blink_token,
+                    not blink_high)
 
-    def run_sos(self):
+    def sos_step(self, blink_token, index):
         """
-        this is the task which makes the digitial output pulse SOS
+        one pulse of SOS on the digitial output, which schedules the next
         """
-        log = logging.getLogger("DigitalOutput.sos")
-        log.info(self.control_pin)
-        sequence = [
-                (.3, self._on), (.3, self.off),
-                (.3, self._on), (.3, self.off),
-                (.3, self._on),
-
-                (1, self.off),
-
-                (1, self._on), (.3, self.off),
-                (1, self._on), (.3, self.off),
-                (1, self._on),
-
-                (1, self.off),
-
-                (.3, self._on), (.3, self.off),
-                (.3, self._on), (.3, self.off),
-                (.3, self._on),
-
-                (2, self.off),
-        ]
-
-        index = 0
-        while self.blink_time == "sos":
-            seconds, value = sequence[index]
-            GPIO.output(self.control_pin, value)
-            time.sleep(seconds)
-
+        with self.lock:
+            if self.blink_token is not blink_token:
+                return
+            seconds, high = self.sos_sequence[index]
+            GPIO.output(self.control_pin, self._on if high else self.off)
             index += 1
-            index = 0 if index >= len(sequence) else index
+            index = 0 if index >= len(self.sos_sequence) else index
+            self.timer = self.interlock.scheduler.call_later(
+                    seconds, self.sos_step, blink_token, index)
+
+    def stop(self):
+        """
+        no more blinking or timing, the output is left as it is for whatever
+        replaces us
+        """
+        Connection.stop(self)
+        with self.lock:
+            self.clear_threads()
 
     def clear_threads(self):
         """
-        turn off the threads which are blinking the
+        stop the timers which are blinking or timing the output
         """
         if self.timer != None:
             self.timer.cancel()
+            self.timer = None
         self.blink_time = None
+        self.blink_token = None
 
 ################################################################################
 #
@@ -1368,14 +2910,17 @@ class StdioOutput(Connection):
         # done with all processing, lets change our state to reflect that the
         # system is powered up
         #
-        self.update({"state": MessageTypes.POWER_UP})
+        self.update(ActionMessage(MessageTypes.POWER_UP))
+
 
+    def handles(self):
+        return list(self.state_actions)
 
     def update(self, action_message):
         """
         call with any of the valid states to get the configured message
         """
-        status = action_message["state"]
+        status = action_message.state
 
         if status in self.state_actions:
             print self.state_actions[status]
@@ -1400,6 +2945,15 @@ class Monitor(threading.Thread, Connection):
         threading.Thread.__init__(self)
         self.run_continuously = True
 
+    def handles(self):
+        """
+        monitors only send messages, unless they override update(), in which
+        case it is called for every state unless they override this as well
+        """
+        if type(self).update.__func__ is not Connection.update.__func__:
+            return None
+        return []
+
 
 ################################################################################
 #
@@ -1420,6 +2974,7 @@ class DigitalMonitor(Monitor):
         Monitor.__init__(self, interlock, connection, config)
 
         GPIO.setup(self.connection, GPIO.IN)
+        self.attached = False
 
         #
         # read in the configuration
@@ -1428,7 +2983,8 @@ class DigitalMonitor(Monitor):
         self.trigger_to_new_state = {
                 trigger: status
                 for status, trigger in config.items()
-                if status in MessageTypes and trigger in triggers}
+                if status in MessageTypes.INTERLOCK_CLASS and
+                    trigger in triggers}
 
         log.info(self.connection + ": " + repr(self.trigger_to_new_state))
 
@@ -1438,31 +2994,137 @@ class DigitalMonitor(Monitor):
         gpio changes and submits a state change request.
         """
         log = logging.getLogger("DigitalMonitor.run")
-        while True:
+        while not self.stopped:
             if GPIO.input(self.connection):
                 GPIO.wait_for_edge(self.connection, GPIO.FALLING)
                 message = self.trigger_to_new_state.get("FALLING")
+                level = 0
             else:
                 GPIO.wait_for_edge(self.connection, GPIO.RISING)
                 message = self.trigger_to_new_state.get("RISING")
+                level = 1
+            if self.recorder != None:
+                self.recorder.edge(self.connection, level)
 
-            if message:
-                packet = {"state": message,
-                        "from": "DigitalMonitor: " + self.connection}
+            #
+            # wait_for_edge() cannot be interrupted, so once stopped we end
+            # at the next edge without telling anyone about it
+            #
+            if message and not self.stopped:
+                packet = ActionMessage(message,
+                        "DigitalMonitor: " + self.connection)
                 log.info(self.connection + ': sending ' + repr(packet))
                 self.interlock.action_queue.put(packet)
 
+    def attach(self):
+        """
+        In the reactor runtime, let the GPIO library watch for edges.  It
+        watches every pin from one thread of its own, and calls edge().
+        """
+        if not hasattr(GPIO, "add_event_detect"):
+            return False
+        GPIO.add_event_detect(self.connection, GPIO.BOTH, callback=self.edge)
+        self.attached = True
+        return True
+
+    def edge(self, channel):
+        """
+        called by the GPIO library when the line goes up or down
+        """
+        log = logging.getLogger("DigitalMonitor.run")
+        level = GPIO.input(self.connection)
+        if self.recorder != None:
+            self.recorder.edge(self.connection, level)
+        message = self.trigger_to_new_state.get(
+                "RISING" if level else "FALLING")
+        if message and not self.stopped:
+            packet = ActionMessage(message,
+                    "DigitalMonitor: " + self.connection)
+            log.info(self.connection + ': sending ' + repr(packet))
+            self.interlock.action_queue.put(packet)
+
+    def stop(self):
+        """
+        stop watching the line
+        """
+        Connection.stop(self)
+        if self.attached:
+            GPIO.remove_event_detect(self.connection)
+
 
 ################################################################################
 #
 #  adc Monitor
 #
 ################################################################################
+class EnergyIntegrator(object):
+    """
+    Accumulates the current sense samples of an AnalogMonitor for the length of
+    a session: watt-seconds consumed, how long the spindle was on, and the peak
+    draw.  Samples are handed over in blocks so that the arithmetic is done by
+    the builtin sum(), max() and filter() rather than one sample at a time.
+    """
+    def __init__(self, watts_full_scale, spindle_on):
+        """
+        watts_full_scale: how many watts a reading of 1.0 (1.8 volts) means
+        spindle_on: readings above this count as the spindle being on
+        """
+        self.watts_full_scale = float(watts_full_scale)
+        self.spindle_on = float(spindle_on)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        start counting again from nothing
+        """
+        self.watt_seconds = 0.0
+        self.spindle_on_seconds = 0.0
+        self.peak_watts = 0.0
+        self.seconds = 0.0
+        self.samples = 0
+
+    def add_block(self, block, seconds):
+        """
+        block is an array of readings which were taken over seconds.
+        """
+        if not block:
+            return
+        seconds_per_sample = seconds / len(block)
+        spindle_on_samples = len(filter(self.spindle_on.__lt__, block))
+
+        with self.lock:
+            self.watt_seconds += \
+                    sum(block) * self.watts_full_scale * seconds_per_sample
+            self.spindle_on_seconds += spindle_on_samples * seconds_per_sample
+            self.peak_watts = max(self.peak_watts,
+                    max(block) * self.watts_full_scale)
+            self.seconds += seconds
+            self.samples += len(block)
+
+    def summary(self):
+        """
+        returns what has been accumulated so far, and starts over
+        """
+        with self.lock:
+            summary = {
+                "watt_seconds": round(self.watt_seconds, 1),
+                "spindle_on_seconds": round(self.spindle_on_seconds, 2),
+                "peak_watts": round(self.peak_watts, 1),
+                "duty_cycle": round(self.spindle_on_seconds / self.seconds, 3)
+                        if self.seconds else 0.0,
+                "samples": self.samples
+            }
+            self.reset()
+        return summary
+
 class AnalogMonitor(Monitor):
     """
     This class if for setting states depending on whether a voltage goes high,
     low, inside a range, or outside a range
     """
+    session_states = [MessageTypes.ACTIVE, MessageTypes.INACTIVE_SOON]
+
     def __init__(self, interlock, connection, config):
         """
         connection is one of:
@@ -1472,17 +3134,33 @@ class AnalogMonitor(Monitor):
         is a dictionary where the key is either "higher", or "lower" followed by
         the value read in where the value read in is 0 thru 1 which maps to
         0 volts to 1.8 volts on the ADC line.
+
+        sample_seconds is how often the line is read while the tool is in use,
+        and idle_sample_seconds how often otherwise.  idle_sample_seconds
+        defaults to half a second in low wakeup mode, otherwise to
+        sample_seconds.
+
+        the optional "energy" entry turns on the per session energy accounting
+        for a current transformer on this line:
+
+        "energy": {
+            "watts_full_scale": 3600,
+            "spindle_on": 0.209222216129,
+            "block_size": 10
+        }
         """
+        log = logging.getLogger("AnalogMonitor.init")
+
         Monitor.__init__(self, interlock, connection, config)
 
         self.message_conditions = dict()
         state_configs = {
                 state: state_config
                 for state, state_config in config.items()
-                if state in MessageTypes.ALL_STATES and
+                if state in MessageTypes.INTERLOCK_CLASS and
                     type(state_config) == dict}
 
-        for state, state_config in state_configs:
+        for state, state_config in state_configs.items():
             conditions = {}
             for key in ['higher', 'lower']:
                 try:
@@ -1502,278 +3180,1845 @@ class AnalogMonitor(Monitor):
             if conditions:
                 self.message_conditions[state] = conditions
 
+        #
+        # how often to sample, depending on whether the tool is in use
+        #
+        try:
+            self.sample_seconds = float(config.get("sample_seconds", .01))
+            self.idle_sample_seconds = float(config.get("idle_sample_seconds",
+                .5 if interlock.low_wakeup else self.sample_seconds))
+        except (TypeError, ValueError):
+            self.sample_seconds = self.idle_sample_seconds = .01
+            log.error(connection + ": sample_seconds and " +
+                    "idle_sample_seconds need to be a float or an int")
+        self.session_changed = WakeupEvent()
+
+        #
+        # in the reactor runtime, the next sample
+        #
+        self.sample_call = None
+
+        #
+        # per session energy accounting
+        #
+        self.energy = None
+        self.in_session = False
+        self.block_size = 1
+        energy_config = config.get("energy")
+        if energy_config != None:
+            try:
+                self.energy = EnergyIntegrator(
+                        energy_config["watts_full_scale"],
+                        energy_config.get("spindle_on", 0))
+                self.block_size = int(energy_config.get("block_size", 10))
+            except (KeyError, TypeError, ValueError, AttributeError):
+                log.error(connection + ": energy: needs watts_full_scale, " +
+                        "and optionally spindle_on and block_size numbers")
+
         ADC.setup()
 
+    def handles(self):
+        return [state for state in MessageTypes.ALL_STATES
+                if state not in MessageTypes.INFO_ONLY]
+
+    def update(self, action_message):
+        """
+        keep track of whether the tool is in use so that we only account for
+        the energy used during a session
+        """
+        status = action_message.state
+        if status in self.session_states:
+            if not self.in_session:
+                self.in_session = True
+                self.session_changed.set()
+                if self.sample_call != None:
+                    self.sample_call.cancel()
+                    self.sample_call = self.interlock.scheduler.call_soon(
+                            self.sample_step)
+        elif status in MessageTypes.ALL_STATES and \
+                status not in MessageTypes.INFO_ONLY:
+            self.in_session = False
+
+    def stop(self):
+        """
+        wake run() up so that it notices that we have stopped
+        """
+        Connection.stop(self)
+        self.session_changed.close()
+        if self.sample_call != None:
+            self.sample_call.cancel()
+
+    def session_summary(self):
+        """
+        the energy used since the last session summary
+        """
+        if self.energy != None:
+            return self.energy.summary()
+        return None
+
+    def triggered(self, block):
+        """
+        returns the list of messages whose conditions are met by the block of
+        readings
+        """
+        highest = max(block)
+        lowest = min(block)
+        messages = []
+        for message, conditions in self.message_conditions.items():
+            if conditions['evaluate'] == "and":
+                #
+                # a range: is there a reading above higher that is also below
+                # lower
+                #
+                above = filter(conditions['higher'].__lt__, block)
+                trigger = bool(above) and min(above) < conditions['lower']
+            else:
+                trigger = False
+                if 'higher' in conditions:
+                    trigger |= highest > conditions['higher']
+                if 'lower' in conditions:
+                    trigger |= lowest < conditions['lower']
+            if trigger:
+                messages.append(message)
+        return messages
+
     def run(self):
         """
         This is the process which checkes the analog in pin to see if the
-        line goes too or too low.
+        line goes too or too low.  Readings are collected into blocks which
+        are then checked and accounted for in one go.
+
+        Sampling slows down to idle_sample_seconds while the tool is not in
+        use, and speeds up again as soon as a session starts.
         """
-        ADC.read(self.connection)
-        while True:
-            time.sleep(.01)
-            value = ADC.read(self.connection)
-            for message, conditions in self.message_conditions.items():
-                if conditions['evaluate'] == "and":
-                    trigger = True
-                    if 'higher' in conditions:
-                        trigger &= value > conditions['higher']
-                    if 'lower' in conditions:
-                        trigger &= value < conditions['lower']
-                else:
-                    trigger = False
-                    if 'higher' in conditions:
-                        trigger |= value > conditions['higher']
-                    if 'lower' in conditions:
-                        trigger |= value < conditions['lower']
-                if trigger:
-                    self.interlock.action_queue.put({
-                        "state": message,
-                        "from": "DigitalMonitor: " + self.connection})
-                    time.sleep(.5)
+        wakeup_name = "AnalogMonitor:" + self.connection
+        self.start_sampling()
+        while not self.stopped:
+            self.session_changed.clear()
+            self.session_changed.wait(self.sample_interval())
+            wakeups.tick(wakeup_name)
+            self.sample()
+
+    def attach(self):
+        """
+        in the reactor runtime, take each sample from the scheduler
+        """
+        self.start_sampling()
+        self.sample_call = self.interlock.scheduler.call_later(
+                self.sample_interval(), self.sample_step)
+        return True
 
-################################################################################
-#
-#  The Interlock
-#
-################################################################################
+    def sample_step(self):
+        """
+        on the scheduler: take a sample, and come back for the next one
+        """
+        if self.stopped:
+            return
+        wakeups.tick("AnalogMonitor:" + self.connection)
+        self.sample()
+        self.sample_call = self.interlock.scheduler.call_later(
+                self.sample_interval(), self.sample_step)
+
+    def sample_interval(self):
+        """
+        how long until the next sample
+        """
+        return self.sample_seconds if self.in_session else \
+                self.idle_sample_seconds
 
-class Interlock(threading.Thread):
-    """
-    the is the main Interlock class used to insure that people have permission
-    to use this tool.  It keeps track of timeing and lets all of the connections
-    know about the current state.
-    """
+    def start_sampling(self):
+        """
+        the first reading, and an empty block
+        """
+        ADC.read(self.connection)
+        self.block = array.array('f')
+        self.block_start = time.time()
+        self.block_in_session = self.in_session
+        self.quiet_until = self.block_start
 
-    def __init__(self, interlock_config, error_log):
+    def sample(self):
         """
-        Pass in the master config which also contains all the configuration
-        for the connections for this RFID Interlock installation
+        take a reading, and once a block of them has been collected, check
+        and account for it
         """
-        log = logging.getLogger("Interlock.init")
-        log.info("in interlock.__init__")
+        reading = ADC.read(self.connection)
+        if self.recorder != None:
+            self.recorder.sample(self.connection, reading)
+        self.block.append(reading)
+        if len(self.block) < self.block_size:
+            return
 
         #
-        # this is where all errors get logged
+        # only account for blocks which were sampled entirely in session
         #
-        self.error_log = error_log
+        now = time.time()
+        if self.energy != None and self.block_in_session and self.in_session:
+            self.energy.add_block(self.block, now - self.block_start)
 
         #
-        # start our threaded environment that we require
+        # once triggered, hold off for half a second before telling the
+        # interlock again, but keep on sampling for the energy accounting
         #
-        threading.Thread.__init__(self)
-        self.action_queue = Queue.Queue()
-        try:
-            self.timeout = int(interlock_config.get('timeout', 0))
-        except ValueError:
-            log.error("timeout is: " + interlock_config['timeout'] +
-                    " needs to be a float or int")
+        if now >= self.quiet_until:
+            messages = self.triggered(self.block)
+            for message in messages:
+                self.interlock.action_queue.put(ActionMessage(
+                        message, "AnalogMonitor: " + self.connection))
+            if messages:
+                self.quiet_until = now + .5
+
+        self.block = array.array('f')
+        self.block_start = now
+        self.block_in_session = self.in_session
 
-        try:
-            self.warning_seconds = int(interlock_config.get('warning', 0))
-        except ValueError:
-            log.error("warning is: " + interlock_config['warning'] +
-                    " needs to be float or int")
+################################################################################
+#
+#  time budgets for the connections' update()
+#
+################################################################################
 
-        self.timer_to_warning = None
-        self.timer_to_deactivate = None
+class UpdateBudget(object):
+    """
+    Keeps track of how long a connection's update() takes against its budget.
+    After slow_after updates in a row over budget the connection is flagged
+    as slow, and after as many in a row within budget it is not any more.
+
+    If degrade is set, a slow connection is updated from an AsyncUpdater of
+    its own, so that it stops holding up the connections after it.  It is
+    only updated inline again once the AsyncUpdater has finished every
+    message that it was given, so that the updates stay in order and never
+    run at the same time.  If asynchronous is set, it is always updated from
+    its AsyncUpdater.
+    """
+    def __init__(self, connection, seconds=.05, slow_after=3, degrade=False,
+            asynchronous=False):
+        self.connection = connection
+        self.seconds = seconds
+        self.slow_after = slow_after
+        self.slow = False
+        self.streak = 0
+        self.labels = (("connection", connection.connection),)
+        self.asynchronous = asynchronous
+        self.updater = AsyncUpdater(self) \
+                if degrade or asynchronous else None
 
         #
-        # get the tool id
+        # guards the counters below and pending, which are updated from the
+        # AsyncUpdater's thread as well as the dispatcher's
         #
-        if interlock_config.get('tool_id', "") == "":
-            self.tool_id = hex(get_mac_address())[2:-1]
-        else:
-            self.tool_id = interlock_config['tool_id']
+        self.lock = threading.Lock()
 
         #
-        # process connections
+        # the messages given to the AsyncUpdater that it has not finished yet
         #
-        connection_mapping = {
-            "digital:output":           DigitalOutput,
-            "stdio:output":             StdioOutput,
-            "lcd_p018:output":          LcdP018Output,
-            "webservice:connection":    WebServiceConnection,
-            "serial:badge_reader":      SerialBadgeReader,
-            "stdio:badge_reader":       KeyboardBadgeReader,
-            "input_event:badge_reader": InputEventBadgeReader,
-            "analog:monitor":           AnalogMonitor,
-            "digital:monitor":          DigitalMonitor,
-            "internal:hardcoded_rfids": HardcodedRFIDs,
-        }
-        self.connections = []
-
-        for connection_name, connection_config in interlock_config.items():
-            if type(connection_config) == dict and \
-                    "type" in connection_config and \
-                    connection_config['type'] in connection_mapping:
-                # try:
-                connection = connection_mapping[connection_config['type']](
-                        self, connection_name, connection_config)
-                self.connections.append(connection)
-                # if isinstance(connection, Monitor) or \
-                #         isinstance(connection, BadgeReader):
-                if connection.run_continuously:
-                    connection.start()
-                log.info("connection " + connection_name + " added")
-                print "connection " + connection_name + " added"
-                # except Exception as error:
-                # log.error("connection " + connection_name + 
-                # " could not be added: " +
-                #         repr(error.message) + repr(error.args))
-        print "finished initialziing " + str(len(self.connections)) + \
-                " connections"
-                   
-    def run(self):
-        """
-        This is the task which is run for the Interlock, this is like a job
-        scheduler that you will find in most modern operating systems.
-        """
-        # print "run forest run!"
-
-        log = logging.getLogger("Interlock.run")
-        log.debug("starting")
+        self.pending = 0
 
         #
-        #  status_update_actions is to replace a case statement.  It maps the
-        #  message types to internal to internal functions that need to be
-        #  called to perform internal housekeeping, mostly to keep up with
-        #  timing requirements
+        # since the last report
         #
-        status_update_actions = {
-            MessageTypes.ACTIVE:            self.active_mode,
-            MessageTypes.INACTIVE_SOON:     self.warning_mode,
-            MessageTypes.INACTIVE:          self.inactive_mode,
-            MessageTypes.RESET_TIMER:       self.reset_timers,
-            MessageTypes.ERROR:             self.error
-        }
-
-        self.action_queue.put({
-            "state": MessageTypes.INACTIVE,
-            "from": "Interlock.run() initial power up"})
-
-        while True:
-            log.debug("waiting on action_queue.get()")
-            message = self.action_queue.get()
-            print message
-            new_state = message.get("state")
-            queued_from = message.get("from")
-
-            log.debug("setting status to {0} because {1} said so".format(
-                    new_state, queued_from))
-
-            #
-            # perform internal housekeeping as a due to the message in the queue
-            #
-            # print "do internal housekeeping"
-            if new_state in status_update_actions:
-                status_update_actions[new_state]()
+        self.calls = 0
+        self.total_seconds = 0.0
+        self.worst_seconds = 0.0
+        self.overruns = 0
 
-            #
-            # let all of the connections know of the new state from the message
-            # in the queue
-            #
-            # for update_me in self.need_status_updates:
-            # print "tell " + str(len(self.connections)) + " connections"
-            for connection in self.connections:
-                # print "telling:"
-                # print update_me
-                connection.update(message)
-            # print "told everyone"
-
-        log.debug("ending")
-
-    def locked_out(self):
+    def update(self, message):
         """
-        Tragic errors, cannot do anything.
+        pass the message on to the connection, either right away or through
+        its AsyncUpdater
         """
-        # for update_me in self.need_status_updates:
-        for update_me in self.connections:
-            update_me.update({"state": MessageTypes.ERROR_CONFIG})
+        self.call(self.timed_update, message)
 
-    def active_mode(self):
+    def call(self, function, *args):
         """
-        We have just activated the tool, set up a timer to wake up whenever
-        we are about ready to turn the tool off
+        call function(*args) right away, or from the AsyncUpdater when the
+        connection is being updated from there, after the messages it was
+        given before
         """
-        log = logging.getLogger("Interlock.run")
-        log.debug("active_mode start")
-
-        self.clear_all_timers()
-
-        self.timer_to_warning = threading.Timer(
-                self.timeout - self.warning_seconds,
-                lambda: self.action_queue.put({
-                    "state": MessageTypes.INACTIVE_SOON,
-                    "from": "Interlock.active_mode()"}))
-
-        log.debug("active_mode starting timers")
-        self.timer_to_warning.start()
-        log.debug("active_mode end")
-
-
-    def warning_mode(self):
+        if self.updater != None:
+            with self.lock:
+                asynchronous = self.asynchronous or self.slow or \
+                        self.pending > 0
+                if asynchronous:
+                    self.pending += 1
+            if asynchronous:
+                self.updater.queue.put((function, args))
+                return
+        function(*args)
+
+    def finished(self):
         """
-        We have just about ready to turn the tool off, set up a timer to wake
-        us up whenever it is time to deactivate the tool
+        the AsyncUpdater is done with a message
         """
-        log = logging.getLogger("Interlock.run")
-        log.debug("warning_mode")
-
-        if self.timer_to_deactivate != None and self.timer_to_warning == None:
-            #
-            # already in warning mode
-            #
-            pass
-        else:
-            self.clear_all_timers()
-            self.timer_to_deactivate = threading.Timer(
-                    self.warning_seconds,
-                    lambda: self.action_queue.put(({
-                        "state": MessageTypes.INACTIVE,
-                        "from": "Interlock.active_mode()"})))
-            self.timer_to_deactivate.start()
+        with self.lock:
+            self.pending -= 1
 
-    def inactive_mode(self):
+    def timed_update(self, message):
         """
-        the tool is off, turn off all timers
+        call the connection's update(), and see how it did
         """
-        log = logging.getLogger("Interlock.run")
-        log.debug("inactive_mode() called")
+        update_start = monotonic()
+        self.connection.update(message)
+        self.note(monotonic() - update_start)
 
-        self.clear_all_timers()
-
-    def reset_timers(self):
+    def note(self, seconds):
         """
-        Clear the timers.  One call does it all.
+        take note of how long an update() took
         """
-        log = logging.getLogger("Interlock.run")
-        log.debug("reset_timers called")
-
-        if self.timer_to_warning != None or self.timer_to_deactivate != None:
-            self.action_queue.put({
-                "state": MessageTypes.ACTIVE,
-                "from": "Interlock.reset_timers()"})
+        log = logging.getLogger("Interlock.budget")
+        metrics.registry.observe("muther_connection_update_seconds", seconds,
+                self.labels)
+        over = seconds > self.seconds
+        if over:
+            metrics.registry.inc("muther_connection_overruns_total",
+                    self.labels)
+
+        with self.lock:
+            self.calls += 1
+            self.total_seconds += seconds
+            self.worst_seconds = max(self.worst_seconds, seconds)
+            if over:
+                self.overruns += 1
+            if over != self.slow:
+                self.streak += 1
+            else:
+                self.streak = 0
+
+            flipped = self.streak >= self.slow_after
+            if flipped:
+                self.slow = over
+                self.streak = 0
+
+        if flipped:
+            if over:
+                log.warning(self.connection.connection + ": update() took " +
+                        "{0:.1f} ms, more than its budget of {1:.1f} ms, "
+                        .format(seconds * 1000, self.seconds * 1000) +
+                        repr(self.slow_after) + " times in a row" +
+                        (", updating it asynchronously"
+                        if self.updater != None else ""))
+            else:
+                log.warning(self.connection.connection +
+                        ": update() is back within its budget")
 
-    def error(self):
+    def take_report(self):
         """
-        error mode.  Clear the timers.
+        returns what happened since the last report, and starts over
         """
-        log = logging.getLogger("Interlock.run")
-        log.debug("errors called")
-        self.clear_all_timers()
+        with self.lock:
+            report = {
+                "connection": self.connection.connection,
+                "calls": self.calls,
+                "total_seconds": self.total_seconds,
+                "worst_seconds": self.worst_seconds,
+                "overruns": self.overruns,
+                "slow": self.slow,
+                "degraded": self.updater != None and self.slow
+            }
+            self.calls = 0
+            self.total_seconds = 0.0
+            self.worst_seconds = 0.0
+            self.overruns = 0
+        return report
 
-    def clear_all_timers(self):
+class AsyncUpdater(threading.Thread):
+    """
+    updates a slow connection from a thread of its own, in the order in which
+    the messages were dispatched.  Its queue holds (function, args) to call.
+    """
+    def __init__(self, budget):
+        threading.Thread.__init__(self,
+                name=budget.connection.connection + ".async")
+        self.daemon = True
+        self.budget = budget
+        self.queue = Queue.Queue()
+
+    def stop(self):
         """
-        time to clear the deactivation timer and the deactivation soon timer
+        end the thread once it has caught up
         """
-        if self.timer_to_warning != None:
-            self.timer_to_warning.cancel()
+        self.queue.put(None)
+
+    def run(self):
+        log = logging.getLogger("Interlock.budget")
+        while True:
+            call = self.queue.get()
+            if call == None:
+                break
+            function, args = call
+            try:
+                function(*args)
+            except Exception:
+                log.exception(self.budget.connection.connection +
+                        ": update() failed")
+            finally:
+                self.budget.finished()
+
+################################################################################
+#
+#  connection types
+#
+################################################################################
+
+class ConnectionType(object):
+    """
+    A kind of connection that a config section can ask for with its "type".
+    The class may be given as "module:Class", and the module globals named in
+    dependencies may be LazyModules; either way nothing is imported until
+    load() is called for the first connection of this type.
+    """
+    def __init__(self, type_name, factory, dependencies=()):
+        self.type_name = type_name
+        self.factory = factory
+        self.dependencies = list(dependencies)
+        self.loaded = None
+
+    def load(self):
+        """
+        returns the connection class, importing what it needs the first time
+        """
+        if self.loaded == None:
+            module_globals = globals()
+            for global_name in self.dependencies:
+                value = module_globals[global_name]
+                if isinstance(value, LazyModule):
+                    module_globals[global_name] = value._load()
+
+            factory = self.factory
+            if isinstance(factory, basestring):
+                module_name, _, class_name = factory.partition(":")
+                factory = getattr(importlib.import_module(module_name),
+                        class_name)
+            self.loaded = factory
+        return self.loaded
+
+connection_types = {}
+
+def register_connection_type(type_name, factory, dependencies=()):
+    """
+    Make a connection type available to config sections.  factory is the
+    Connection class, or "module:Class" to import it only when it is used.
+    dependencies are the names of the LazyModules in this module that the
+    class needs.
+
+    Plugins are registered from the "plugins" section of the config, as
+    {"type": "module:Class"}, the class must take the same parameters as
+    Connection.
+    """
+    connection_types[type_name] = ConnectionType(type_name, factory,
+            dependencies)
+
+register_connection_type("digital:output", DigitalOutput, ["GPIO"])
+register_connection_type("stdio:output", StdioOutput)
+register_connection_type("lcd_p018:output", LcdP018Output, ["lcd_i2c_p018"])
+register_connection_type("webservice:connection", WebServiceConnection,
+        ["urllib2", "httplib"])
+register_connection_type("serial:badge_reader", SerialBadgeReader, ["serial"])
+register_connection_type("stdio:badge_reader", KeyboardBadgeReader)
+register_connection_type("input_event:badge_reader", InputEventBadgeReader,
+        ["InputDevice", "ecodes"])
+register_connection_type("analog:monitor", AnalogMonitor, ["ADC"])
+register_connection_type("digital:monitor", DigitalMonitor, ["GPIO"])
+register_connection_type("internal:hardcoded_rfids", HardcodedRFIDs,
+        ["badge_index"])
+register_connection_type("event_log:connection", EventLogConnection,
+        ["event_journal"])
+
+def is_connection_config(connection_config):
+    """
+    whether a section of the config describes a connection we know how to make
+    """
+    return type(connection_config) == dict and \
+            connection_config.get('type') in connection_types
+
+################################################################################
+#
+#  starting up
+#
+################################################################################
+
+def seconds_since_start():
+    """
+    how long ago the process started, from /proc, or None if we cannot tell
+    """
+    try:
+        with open("/proc/self/stat") as stat:
+            start_ticks = float(stat.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as uptime:
+            return float(uptime.read().split()[0]) - \
+                    start_ticks / os.sysconf("SC_CLK_TCK")
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+
+class BootTimeline(object):
+    """
+    Where the time goes while the daemon starts up, as marks and spans in
+    seconds since the process started, logged on "Interlock.boot" once the
+    first state has been broadcast.  Connections are made on threads of their
+    own, so spans may overlap.
+    """
+    def __init__(self):
+        self.origin = monotonic() - (seconds_since_start() or 0)
+        self.lock = threading.Lock()
+        self.events = []
+        self.mark("imported rfid_interlock")
+
+    def now(self):
+        """
+        seconds since the process started
+        """
+        return monotonic() - self.origin
+
+    def mark(self, what):
+        """
+        note that something has just happened
+        """
+        self.span(what, self.now())
+
+    def span(self, what, start, end=None):
+        """
+        note that something took from start until end
+        """
+        with self.lock:
+            self.events.append((start, end, what))
+
+    def ready(self, what):
+        """
+        the last mark, log the timeline
+        """
+        self.mark(what)
+        logging.getLogger("Interlock.init").warning(
+                "ready {0:.2f} seconds after starting, with {1} of {2} "
+                "connection types loaded".format(self.now(),
+                len([connection_type
+                        for connection_type in connection_types.values()
+                        if connection_type.loaded != None]),
+                len(connection_types)))
+        log = logging.getLogger("Interlock.boot")
+        if log.isEnabledFor(logging.INFO):
+            with self.lock:
+                events = sorted(self.events)
+            for start, end, what in events:
+                if end == None:
+                    log.info("{0:8.3f}                     {1}".format(
+                            start, what))
+                else:
+                    log.info("{0:8.3f} - {1:8.3f} {2:7.1f} ms {3}".format(
+                            start, end, (end - start) * 1000, what))
+
+boot_timeline = BootTimeline()
+
+################################################################################
+#
+#  several tools in one process
+#
+################################################################################
+
+#
+# settings that belong to the whole process, rather than to a tool, and
+# those that each tool needs its own of, which the tools in a multi-tool
+# config do not get from the top of the config
+#
+PROCESS_SETTINGS = ["tools", "logging", "log_queue", "error_log", "metrics",
+        "profiler", "plugins", "runtime", "executor_workers",
+        "wakeup_report_seconds", "record"]
+NOT_INHERITED = PROCESS_SETTINGS + ["tool_id", "tool_desc", "state_journal"]
+
+def tool_configs(config):
+    """
+    The config of each tool as (name, config).  Without "tools" the whole
+    config is the config of one tool, whose name is None.  Otherwise each of
+    "tools" is the config of a tool and its connections, which gets the
+    settings from the top of the config that it does not have itself.
+    """
+    log = logging.getLogger("Interlock.init")
+    tools = config.get("tools")
+    if tools == None:
+        return [(None, config)]
+
+    if type(tools) != dict:
+        log.error("tools is: " + repr(tools) + " needs to be a dictionary " +
+                "of tool name to its config")
+        return []
+    shared = {}
+    for name, value in config.items():
+        if is_connection_config(value):
+            log.error(name + ": connections need to be in one of the tools")
+        elif name not in NOT_INHERITED:
+            shared[name] = value
+
+    configs = []
+    for name in sorted(tools):
+        if type(tools[name]) != dict:
+            log.error("tools: " + name + ": needs to be a dictionary")
+            continue
+        tool_config = dict(shared)
+        tool_config.update(tools[name])
+        configs.append((name, tool_config))
+    return configs
+
+def check_tools(configs):
+    """
+    log an error for every tool_id, and every connection, which more than one
+    tool has, as they would be fighting over the same badges or pins
+    """
+    log = logging.getLogger("Interlock.init")
+    tool_ids = {}
+    owners = {}
+    for name, tool_config in configs:
+        tool_id = tool_config.get('tool_id', "")
+        if tool_id in tool_ids:
+            log.error("tools: " + name + " and " + tool_ids[tool_id] +
+                    " both have the tool_id " + repr(tool_id))
+        tool_ids[tool_id] = name
+        for connection_name, connection_config in tool_config.items():
+            if not is_connection_config(connection_config):
+                continue
+            if connection_name in owners:
+                log.error("tools: " + name + " and " +
+                        owners[connection_name] + " both have " +
+                        connection_name)
+            owners[connection_name] = name
+
+class Host(object):
+    """
+    What the Interlocks in one process share: the scheduler which runs every
+    timer, the executor's threads which make the webservice requests in the
+    reactor runtime, the cache of recent grants, the metrics server, the
+    recording of the inputs, and the connection types from plugins.  Each
+    Interlock keeps its own state, connections, timers and action_queue.
+    """
+    def __init__(self, config):
+        """
+        config is the whole config, the process wide settings are read from
+        its top
+        """
+        log = logging.getLogger("Interlock.init")
+        self.interlocks = []
+        self.grants = GrantCache()
+
+        #
+        # every raw input, and every transition, recorded for
+        # input_trace.py to replay
+        #
+        self.recorder = None
+        record_config = config.get('record')
+        if record_config != None:
+            try:
+                self.recorder = input_trace.TraceWriter(
+                        record_config['filename'], config)
+            except (KeyError, TypeError, IOError, OSError) as error:
+                log.error("record: needs a filename that we can write: " +
+                        repr(error))
+
+        #
+        # every timer, blink and deadline runs from this one thread
+        #
+        self.scheduler = Scheduler()
+        self.scheduler.start()
+
+        #
+        # "threads" gives every badge reader, monitor, heartbeat and query a
+        # thread of its own.  "reactor" runs them all from the scheduler's
+        # thread, reading files as they become readable, with a few executor
+        # threads for what blocks, such as webservice requests.
+        #
+        self.runtime = config.get('runtime', "threads")
+        if self.runtime not in ("threads", "reactor"):
+            log.error("runtime is: " + repr(self.runtime) + " needs to be " +
+                    "\"threads\" or \"reactor\"")
+            self.runtime = "threads"
+        self.executor = None
+        if self.runtime == "reactor":
+            try:
+                workers = int(config.get('executor_workers', 2))
+            except ValueError:
+                workers = 2
+                log.error("executor_workers is: " +
+                        repr(config['executor_workers']) +
+                        " needs to be an int")
+            self.executor = Executor(self.scheduler, workers)
+
+        #
+        # connection types from elsewhere
+        #
+        plugins = config.get('plugins', {})
+        if type(plugins) != dict:
+            log.error("plugins is: " + repr(plugins) + " needs to be a " +
+                    "dictionary of connection type to \"module:Class\"")
+            plugins = {}
+        for type_name, factory in plugins.items():
+            register_connection_type(type_name, factory)
+
+        #
+        # every so often let the log know how often threads are waking up
+        #
+        try:
+            self.wakeup_report_seconds = float(
+                    config.get('wakeup_report_seconds', 0))
+        except ValueError:
+            self.wakeup_report_seconds = 0
+            log.error("wakeup_report_seconds is: " +
+                    repr(config['wakeup_report_seconds']) +
+                    " needs to be a float or int")
+        if self.wakeup_report_seconds > 0:
+            self.scheduler.call_later(
+                    self.wakeup_report_seconds, self.report_wakeups)
+
+        #
+        # serve metrics about how we are doing
+        #
+        metrics_config = config.get('metrics')
+        if metrics_config != None:
+            try:
+                metrics.MetricsServer(
+                        metrics_config.get('address', "127.0.0.1"),
+                        int(metrics_config.get('port', 9187))).start()
+            except (AttributeError, TypeError, ValueError) as error:
+                log.error("metrics: needs an address and a port which is " +
+                        "an int: " + repr(error))
+            except socket.error as error:
+                #
+                # the tools work just as well without their metrics
+                #
+                log.warning("metrics: cannot listen, carrying on without " +
+                        "metrics: " + repr(error))
+
+    def gather(self, read):
+        """
+        For the metrics: what read(interlock) returns for every Interlock, a
+        number or a list of (labels, number), as one list of (labels, number)
+        with the tool added to the labels when there is more than one.
+        """
+        samples = []
+        for interlock in self.interlocks:
+            value = read(interlock)
+            if not isinstance(value, list):
+                value = [((), value)]
+            if len(self.interlocks) > 1:
+                value = [((("tool", interlock.tool_name),) + labels, number)
+                        for labels, number in value]
+            samples.extend(value)
+        return samples
+
+    def report_wakeups(self):
+        """
+        log how many times per second each thread has woken up since the last
+        report
+        """
+        log = logging.getLogger("Interlock.wakeups")
+        rates = wakeups.rates()
+        log.info(", ".join([
+                "{0}: {1:.2f}/s".format(name, rates[name])
+                for name in sorted(rates)]) +
+                "; total: {0:.2f}/s".format(sum(rates.values())))
+        self.scheduler.call_later(
+                self.wakeup_report_seconds, self.report_wakeups)
+
+
+################################################################################
+#
+#  The Interlock
+#
+################################################################################
+
+class Interlock(threading.Thread):
+    """
+    the is the main Interlock class used to insure that people have permission
+    to use this tool.  It keeps track of timeing and lets all of the connections
+    know about the current state.
+    """
+
+    def __init__(self, interlock_config, error_log, host=None,
+            tool_name=None):
+        """
+        Pass in the master config which also contains all the configuration
+        for the connections for this RFID Interlock installation.
+
+        With several tools in one process, each has an Interlock, they share
+        the host, and interlock_config is the tool's config from
+        tool_configs().
+        """
+        log = logging.getLogger("Interlock.init")
+        log.info("in interlock.__init__")
+        logging_tool.name = tool_name
+
+        if host == None:
+            host = Host(interlock_config)
+        self.host = host
+        self.tool_name = tool_name
+        self.boot_prefix = tool_name + ": " if tool_name != None else ""
+        host.interlocks.append(self)
+
+        #
+        # this is where all errors get logged
+        #
+        self.error_log = error_log
+
+        #
+        # start our threaded environment that we require
+        #
+        threading.Thread.__init__(self, name="Interlock" +
+                (":" + tool_name if tool_name != None else ""))
+        self.action_queue = metrics.TimedQueue(
+                "muther_action_queue_wait_seconds")
+        self.read_timeouts(interlock_config)
+
+        #
+        # the running config, as it was read, to compare with when reloading,
+        # some connections write into the copy they were given
+        #
+        self.config = copy.deepcopy(interlock_config)
+
+        self.timer_to_warning = None
+        self.timer_to_deactivate = None
+
+        #
+        # every timer, blink and deadline runs from the host's scheduler
+        #
+        self.scheduler = host.scheduler
+        self.runtime = host.runtime
+        self.executor = host.executor
+        if self.runtime == "reactor":
+            self.action_queue.ready = WakeupEvent()
+
+        #
+        # in low wakeup mode, sampling slows down while the tool is not in use
+        #
+        self.low_wakeup = bool(interlock_config.get('low_wakeup', False))
+
+        #
+        # the badge that was most recently checked, and the session it started
+        #
+        self.badge_id = None
+        self.session = None
+        self.last_session_report = None
+
+        #
+        # how long we have spent in each state, for the metrics
+        #
+        self.current_state = None
+        self.state_since = None
+        self.state_seconds = {}
+
+        #
+        # which states may follow the one we are in, by code, and the code of
+        # the one we are in, None for a state from a plugin
+        #
+        self.transitions = self.compile_transitions(interlock_config)
+        self.current_code = MessageTypes.CODES[MessageTypes.POWER_UP]
+
+        #
+        # the connection that put the tool into maintenance, the only one
+        # that may take it out again
+        #
+        self.maintenance_by = None
+
+        #
+        # set by run_from_commandline(), traces each dispatch while it runs
+        #
+        self.profiler = None
+
+        #
+        # the journal of every state transition
+        #
+        self.state_journal = None
+        journal_config = interlock_config.get('state_journal')
+        if journal_config != None:
+            try:
+                self.state_journal = state_journal.StateJournal(
+                        journal_config['filename'],
+                        int(journal_config.get('capacity', 65536)))
+            except (KeyError, TypeError, ValueError) as error:
+                log.error("state_journal: needs a filename, and a capacity " +
+                        "which is an int: " + repr(error))
+            except (IOError, OSError) as error:
+                #
+                # the tool works just as well without its journal
+                #
+                log.warning("state_journal: cannot open " +
+                        repr(journal_config['filename']) +
+                        ", carrying on without a journal: " + repr(error))
+
+        #
+        # get the tool id
+        #
+        if interlock_config.get('tool_id', "") == "":
+            from uuid import getnode as get_mac_address
+            self.tool_id = hex(get_mac_address())[2:-1]
+        else:
+            self.tool_id = interlock_config['tool_id']
+
+        #
+        # process connections
+        #
+        #
+        # made side by side, in the order the config has them
+        #
+        made = self.make_connections(interlock_config.items(),
+                timeline=boot_timeline)
+        self.connections = [made[connection_name]
+                for connection_name in interlock_config
+                if connection_name in made]
+        boot_timeline.mark(self.boot_prefix + "made " +
+                repr(len(self.connections)) + " connections")
+        print "finished initialziing " + str(len(self.connections)) + \
+                " connections"
+
+        #
+        # how long each connection's update() may take, the default for all of
+        # them can be overridden in each connection's own "update_budget"
+        #
+        default_budget = interlock_config.get('update_budget', {})
+        self.update_budgets = [
+                self.make_budget(connection, default_budget)
+                for connection in self.connections]
+        self.route()
+
+        try:
+            self.budget_report_seconds = float(
+                    default_budget.get('report_seconds', 0))
+        except ValueError:
+            self.budget_report_seconds = 0
+            log.error("update_budget: report_seconds is: " +
+                    repr(default_budget['report_seconds']) +
+                    " needs to be a float or int")
+        if self.budget_report_seconds > 0:
+            self.scheduler.call_later(
+                    self.budget_report_seconds, self.report_budgets)
+
+        #
+        # and how long each message took to dispatch to every connection
+        #
+        self.dispatch_latencies = None
+        try:
+            self.dispatch_report_seconds = float(
+                    interlock_config.get('dispatch_report_seconds', 0))
+        except ValueError:
+            self.dispatch_report_seconds = 0
+            log.error("dispatch_report_seconds is: " +
+                    repr(interlock_config['dispatch_report_seconds']) +
+                    " needs to be a float or int")
+        if self.dispatch_report_seconds > 0:
+            self.dispatch_latencies = []
+            self.scheduler.call_later(
+                    self.dispatch_report_seconds, self.report_dispatch)
+
+        #
+        # reload the config when its file changes, SIGHUP does the same
+        #
+        self.config_signature = configuration.signature()
+        try:
+            self.config_check_seconds = float(
+                    interlock_config.get('config_check_seconds', 0))
+        except ValueError:
+            self.config_check_seconds = 0
+            log.error("config_check_seconds is: " +
+                    repr(interlock_config['config_check_seconds']) +
+                    " needs to be a float or int")
+        if self.config_check_seconds > 0:
+            self.scheduler.call_later(
+                    self.config_check_seconds, self.check_config_file)
+
+        #
+        # the first state we broadcast finishes booting
+        #
+        self.booting = True
+
+        self.log_run = logging.getLogger("Interlock.run")
+
+        #
+        #  status_update_actions is to replace a case statement.  It maps the
+        #  message types to internal to internal functions that need to be
+        #  called to perform internal housekeeping, mostly to keep up with
+        #  timing requirements.  It is indexed by the message's state code.
+        #
+        self.status_update_actions = MessageTypes.table({
+            MessageTypes.ACTIVE:            self.active_mode,
+            MessageTypes.INACTIVE_SOON:     self.warning_mode,
+            MessageTypes.INACTIVE:          self.inactive_mode,
+            MessageTypes.ERROR:             self.error
+        })
+
+        #
+        # the host serves the metrics about how we are doing
+        #
+        self.describe_metrics()
+        logging_tool.name = None
+
+    def read_timeouts(self, interlock_config):
+        """
+        how long a session lasts, and how long before its end to warn
+        """
+        log = logging.getLogger("Interlock.init")
+        try:
+            self.timeout = int(interlock_config.get('timeout', 0))
+        except ValueError:
+            log.error("timeout is: " + interlock_config['timeout'] +
+                    " needs to be a float or int")
+
+        try:
+            self.warning_seconds = int(interlock_config.get('warning', 0))
+        except ValueError:
+            log.error("warning is: " + interlock_config['warning'] +
+                    " needs to be float or int")
+
+        #
+        # how long a connection may take to be made, each connection can
+        # override this with its own "init_timeout"
+        #
+        try:
+            self.init_timeout = float(
+                    interlock_config.get('init_timeout', 10))
+        except ValueError:
+            self.init_timeout = 10.0
+            log.error("init_timeout is: " +
+                    repr(interlock_config['init_timeout']) +
+                    " needs to be a float or int")
+
+    def make_connection(self, connection_name, connection_config):
+        """
+        create and start the connection that a section of the config
+        describes, returns None if the section is not a connection
+        """
+        log = logging.getLogger("Interlock.init")
+        if not is_connection_config(connection_config):
+            return None
+
+        try:
+            factory = connection_types[connection_config['type']].load()
+        except (ImportError, AttributeError, ValueError) as error:
+            log.error(connection_name + ": cannot load " +
+                    connection_config['type'] + ": " + repr(error))
+            return None
+
+        # try:
+        connection = factory(self, connection_name, connection_config)
+        # if isinstance(connection, Monitor) or \
+        #         isinstance(connection, BadgeReader):
+        if connection.run_continuously:
+            #
+            # named so that the profiler's samples say whose they are
+            #
+            connection.name = connection_name
+            if self.runtime != "reactor" or not connection.attach():
+                connection.start()
+        log.info("connection " + connection_name + " added")
+        print "connection " + connection_name + " added"
+        # except Exception as error:
+        # log.error("connection " + connection_name +
+        # " could not be added: " +
+        #         repr(error.message) + repr(error.args))
+        return connection
+
+    def make_connections(self, sections, ready=(), timeline=None):
+        """
+        Make the connections for sections, a list of (name, config), each on a
+        thread of its own so that a slow one does not hold up the others.
+
+        A connection waits for the connections named in its "depends_on" to
+        be made first, ready names those that are already running.  Each may
+        take "init_timeout" seconds once it has started.  Those that fail,
+        take too long, or depend on one that did, are logged as errors, which
+        locks us out at startup; one that finishes after it was given up on
+        is stopped.
+
+        Returns {name: connection} for those that were made.
+        """
+        log = logging.getLogger("Interlock.init")
+        sections = [(name, connection_config)
+                for name, connection_config in sections
+                if is_connection_config(connection_config)]
+
+        #
+        # imports are serialized by python's import lock anyway, and a thread
+        # that imports while this one holds that lock would never finish, so
+        # the connection types are loaded here before any thread starts
+        #
+        for name, connection_config in sections:
+            try:
+                connection_types[connection_config['type']].load()
+            except (ImportError, AttributeError, ValueError):
+                pass
+
+        lock = threading.Lock()
+        finished = WakeupEvent()
+        states = {}
+        made = {}
+
+        def make(name, connection_config):
+            logging_tool.name = self.tool_name
+            started = monotonic()
+            try:
+                connection = self.make_connection(name, connection_config)
+            except Exception:
+                log.exception(name + ": could not be made")
+                connection = None
+            seconds = monotonic() - started
+            metrics.registry.observe("muther_connection_init_seconds",
+                    seconds, (("connection", name),))
+            if timeline != None:
+                timeline.span(name + " (" + connection_config['type'] + ")",
+                        started - timeline.origin, started - timeline.origin +
+                        seconds)
+            with lock:
+                given_up = states[name] == "timed out"
+                if not given_up:
+                    states[name] = "made" if connection != None else "failed"
+                    if connection != None:
+                        made[name] = connection
+            if given_up and connection != None:
+                log.warning(name + ": made after " +
+                        "{0:.1f} seconds, too late, stopping it".format(
+                        seconds))
+                connection.stop()
+            finished.set()
+
+        dependencies = {}
+        deadlines = {}
+        for name, connection_config in sections:
+            depends_on = connection_config.get('depends_on', [])
+            if isinstance(depends_on, basestring):
+                depends_on = [depends_on]
+            if type(depends_on) != list:
+                log.error(name + ": depends_on is: " + repr(depends_on) +
+                        " needs to be a connection or a list of connections")
+                depends_on = []
+            dependencies[name] = [dependency for dependency in depends_on
+                    if dependency not in ready]
+            try:
+                deadlines[name] = float(connection_config.get('init_timeout',
+                        self.init_timeout))
+            except (TypeError, ValueError):
+                log.error(name + ": init_timeout is: " +
+                        repr(connection_config['init_timeout']) +
+                        " needs to be a float or int")
+                deadlines[name] = self.init_timeout
+            states[name] = "waiting"
+
+        waiting = [name for name, connection_config in sections]
+        configs = dict(sections)
+        while True:
+            finished.clear()
+            now = monotonic()
+            with lock:
+                #
+                # give up on those that have taken too long
+                #
+                for name, state in states.items():
+                    if state == "making" and now >= deadlines[name]:
+                        states[name] = "timed out"
+                        log.error(name + ": not made within its init_timeout" +
+                                " of " + repr(configs[name].get('init_timeout',
+                                self.init_timeout)) + " seconds")
+                        if timeline != None:
+                            timeline.mark(name + " timed out")
+
+                #
+                # start those whose dependencies are made, and fail those
+                # whose dependencies cannot be
+                #
+                for name in list(waiting):
+                    dependency_states = [states.get(dependency)
+                            for dependency in dependencies[name]]
+                    if None in dependency_states:
+                        log.error(name + ": depends_on " +
+                                repr(dependencies[name]) + " which are not " +
+                                "all connections")
+                    elif [state for state in dependency_states
+                            if state in ("failed", "timed out")]:
+                        log.error(name + ": not made because one of " +
+                                repr(dependencies[name]) + " was not")
+                    elif [state for state in dependency_states
+                            if state != "made"]:
+                        continue
+                    else:
+                        states[name] = "making"
+                        deadlines[name] += now
+                        thread = threading.Thread(target=make,
+                                args=(name, configs[name]),
+                                name="Init " + name)
+                        thread.daemon = True
+                        thread.start()
+                        waiting.remove(name)
+                        continue
+                    states[name] = "failed"
+                    waiting.remove(name)
+
+                making = [deadlines[name] for name, state in states.items()
+                        if state == "making"]
+                if not making:
+                    #
+                    # whatever is still waiting depends on itself
+                    #
+                    for name in waiting:
+                        states[name] = "failed"
+                        log.error(name + ": depends_on " +
+                                repr(dependencies[name]) + " which depend " +
+                                "on it in turn")
+                    #
+                    # those still being made, which we have given up on, set
+                    # it after this, which does nothing once it is closed
+                    #
+                    finished.close()
+                    return made
+            finished.wait(max(0, min(making) - now))
+
+    #
+    # these only take effect when the daemon is restarted
+    #
+    restart_settings = ["tool_id", "plugins", "logging", "log_queue",
+            "error_log", "metrics", "profiler", "state_journal", "low_wakeup",
+            "wakeup_report_seconds", "dispatch_report_seconds",
+            "config_check_seconds", "runtime", "executor_workers", "record"]
+
+    def compile_transitions(self, interlock_config):
+        """
+        the built in TRANSITIONS, with any that the config replaces, checked
+        and compiled.  If they do not check out the built in ones are used.
+        """
+        log = logging.getLogger("Interlock.init")
+        transitions = dict(TRANSITIONS)
+        replacements = interlock_config.get('transitions', {})
+        if type(replacements) == dict:
+            transitions.update(replacements)
+        else:
+            log.error("transitions is: " + repr(replacements) + " needs to " +
+                    "be a dictionary of state to the states that may follow")
+
+        allowed, problems = compile_transitions(transitions)
+        if problems:
+            for problem in problems:
+                log.error("transitions: " + problem)
+            log.error("using the built in transitions instead")
+            allowed, problems = compile_transitions(TRANSITIONS)
+            for problem in problems:
+                log.error("built in transitions: " + problem)
+        return allowed
+
+    def route(self):
+        """
+        work out which connections handle each state, by its code, so that a
+        message only goes to the connections that do anything with it
+        """
+        log = logging.getLogger("Interlock.init")
+        routes = [[] for name in MessageTypes.NAMES]
+        for budget in self.update_budgets:
+            handles = budget.connection.handles()
+            for code, name in enumerate(MessageTypes.NAMES):
+                if handles == None or name in handles:
+                    routes[code].append(budget)
+        self.routes = routes
+        log.debug("routes: " + ", ".join([name + ": " + repr(
+                [budget.connection.connection for budget in routes[code]])
+                for code, name in enumerate(MessageTypes.NAMES)]))
+
+    def check_config_file(self):
+        """
+        ask for a reload if the config file has changed since it was last read
+        """
+        signature = configuration.signature()
+        if signature != None and signature != self.config_signature:
+            self.config_signature = signature
+            self.action_queue.put(ActionMessage(
+                    MessageTypes.RELOAD_CONFIG,
+                    "Interlock.check_config_file()"))
+        self.scheduler.call_later(
+                self.config_check_seconds, self.check_config_file)
+
+    def reload_config(self, reason):
+        """
+        Read the config file again, and rebuild only the connections whose
+        section of it changed.  The other connections carry on as they were.
+        Runs on the Interlock's thread, between messages.
+        """
+        log = logging.getLogger("Interlock.reload")
+        reload_start = monotonic()
+        errors_before = self.error_log.total
+
+        try:
+            self.config_signature = configuration.signature()
+            new_config = dict(tool_configs(configuration.read())).get(
+                    self.tool_name)
+        except (IOError, ValueError) as error:
+            log.error("cannot reload the config, carrying on with the one " +
+                    "that is running: " + repr(error))
+            return
+        if new_config == None:
+            log.error("the config no longer has the tool " +
+                    repr(self.tool_name) + ", carrying on with the one " +
+                    "that is running")
+            return
+
+        old_config = self.config
+        restart = [setting for setting in self.restart_settings
+                if old_config.get(setting) != new_config.get(setting)]
+        if restart:
+            log.warning("changes to " + ", ".join(restart) +
+                    " take effect when the daemon is restarted")
+        self.read_timeouts(new_config)
+        if new_config.get('transitions') != old_config.get('transitions'):
+            self.transitions = self.compile_transitions(new_config)
+        self.config = copy.deepcopy(new_config)
+
+        names = [connection.connection for connection in self.connections]
+        unchanged = [name for name in names
+                if new_config.get(name) == old_config.get(name)]
+        for connection in self.connections:
+            if connection.connection not in unchanged:
+                connection.stop()
+        made = self.make_connections([(name, connection_config)
+                for name, connection_config in new_config.items()
+                if name not in unchanged], ready=unchanged)
+
+        rebuilt = []
+        removed = []
+        added = []
+        connections = []
+        for connection in self.connections:
+            name = connection.connection
+            if name in unchanged:
+                connections.append(connection)
+            elif name in made:
+                connections.append(made[name])
+                rebuilt.append(name)
+            else:
+                removed.append(name)
+        for name in new_config:
+            if name not in names and name in made:
+                connections.append(made[name])
+                added.append(name)
+
+        #
+        # keep the budgets, and their statistics, of the connections that
+        # carry on, unless the default budget changed
+        #
+        default_budget = new_config.get('update_budget', {})
+        budgets = {}
+        if default_budget == old_config.get('update_budget', {}):
+            budgets = {budget.connection: budget
+                    for budget in self.update_budgets}
+        update_budgets = []
+        for connection in connections:
+            budget = budgets.pop(connection, None)
+            if budget == None:
+                budget = self.make_budget(connection, default_budget)
+            update_budgets.append(budget)
+        for budget in self.update_budgets:
+            if budget not in update_budgets and budget.updater != None:
+                budget.updater.stop()
+
+        self.connections = connections
+        self.update_budgets = update_budgets
+        self.route()
+
+        #
+        # bring the new connections up to date with our state
+        #
+        if self.current_state != None:
+            for budget in self.update_budgets:
+                if budget.connection.connection in rebuilt + added:
+                    budget.update(ActionMessage(
+                            self.current_state, "Interlock.reload_config()"))
+
+        reload_seconds = monotonic() - reload_start
+        metrics.registry.observe("muther_config_reload_seconds",
+                reload_seconds)
+        metrics.registry.inc("muther_connections_rebuilt_total",
+                amount=len(rebuilt) + len(added))
+        log.info("reloaded the config because of " + str(reason) + " in " +
+                "{0:.1f} ms: ".format(reload_seconds * 1000) +
+                "rebuilt " + repr(len(rebuilt)) + " " + repr(rebuilt) +
+                ", added " + repr(len(added)) + " " + repr(added) +
+                ", removed " + repr(len(removed)) + " " + repr(removed) +
+                ", kept " + repr(len(connections) - len(rebuilt) - len(added)))
+        if self.error_log.total > errors_before:
+            log.error(repr(self.error_log.total - errors_before) +
+                    " errors while reloading the config")
+
+    def make_budget(self, connection, default_budget):
+        """
+        the UpdateBudget for a connection, the default for all of them can be
+        overridden in each connection's own "update_budget"
+        """
+        log = logging.getLogger("Interlock.init")
+        budget_config = dict(default_budget)
+        budget_config.update(connection.config.get('update_budget', {}))
+
+        #
+        # in the reactor runtime update() is called from the scheduler's
+        # thread, which must not wait on the hardware
+        #
+        asynchronous = self.runtime == "reactor" and connection.update_blocks
+        try:
+            budget = UpdateBudget(connection,
+                    float(budget_config.get('seconds', .05)),
+                    int(budget_config.get('slow_after', 3)),
+                    bool(budget_config.get('degrade', False)), asynchronous)
+        except (TypeError, ValueError):
+            log.error(connection.connection + ": update_budget is: " +
+                    repr(budget_config) + " seconds needs to be a float " +
+                    "and slow_after an int")
+            budget = UpdateBudget(connection, asynchronous=asynchronous)
+        if budget.updater != None:
+            budget.updater.start()
+        connection.budget = budget
+        return budget
+
+    def start(self):
+        """
+        In the reactor runtime the messages are dispatched from the
+        scheduler's thread, as soon as they are put on the action_queue,
+        otherwise from a thread of our own.
+        """
+        if self.runtime == "reactor":
+            self.scheduler.add_reader(self.action_queue.ready,
+                    self.dispatch_queued)
+            self.action_queue.put(ActionMessage(
+                    MessageTypes.INACTIVE,
+                    "Interlock.start() initial power up"))
+        else:
+            threading.Thread.start(self)
+
+    def run(self):
+        """
+        This is the task which is run for the Interlock, this is like a job
+        scheduler that you will find in most modern operating systems.
+        """
+        # print "run forest run!"
+
+        log = logging.getLogger("Interlock.run")
+        log.debug("starting")
+
+        self.action_queue.put(ActionMessage(
+                MessageTypes.INACTIVE, "Interlock.run() initial power up"))
+
+        while True:
+            log.debug("waiting on action_queue.get()")
+            self.dispatch(self.action_queue.get())
+
+        log.debug("ending")
+
+    def dispatch_queued(self):
+        """
+        in the reactor runtime, on the scheduler: dispatch every message that
+        is waiting
+        """
+        self.action_queue.ready.clear()
+        while True:
+            try:
+                message = self.action_queue.get_nowait()
+            except Queue.Empty:
+                return
+            self.dispatch(message)
+
+    def dispatch(self, message):
+        """
+        do our own housekeeping for a message, and let every connection know
+        about it
+        """
+        log = self.log_run
+        message = ActionMessage.of(message)
+        new_state = message.state
+        queued_from = message.source
+        code = message.code
+
+        if new_state == MessageTypes.RELOAD_CONFIG:
+            self.reload_config(queued_from)
+            return
+
+        #
+        # states from plugins are let through, they are not in the table
+        #
+        if code != None and self.current_code != None and \
+                not self.transitions[self.current_code][code]:
+            self.reject(message)
+            return
+
+        #
+        # only the connection that put the tool into maintenance may take it
+        # out again, otherwise a logout button followed by a swipe would get
+        # around it
+        #
+        if self.current_state == MessageTypes.ERROR_MAINTENANCE and \
+                self.maintenance_by != None and \
+                message.connection != self.maintenance_by and \
+                new_state not in MessageTypes.INFO_ONLY and \
+                new_state != MessageTypes.POWER_UP and \
+                not str(new_state).startswith(MessageTypes.ERROR):
+            self.reject(message)
+            return
+
+        #
+        # activity while the tool is on only pushes its deadline back, the
+        # connections are not told about it
+        #
+        if new_state == MessageTypes.RESET_TIMER:
+            self.reset_timers()
+            return
+
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(repr(message))
+            log.debug("setting status to {0} because {1} said so".format(
+                    new_state, queued_from))
+        dispatch_start = monotonic()
+        tracing = self.profiler != None and self.profiler.running
+        update_timings = []
+
+        if new_state == MessageTypes.CHECK_BADGE:
+            self.badge_id = message.badge_id
+
+        #
+        # perform internal housekeeping as a due to the message in the queue
+        #
+        # print "do internal housekeeping"
+        if code != None:
+            action = self.status_update_actions[code]
+            if action != None:
+                action()
+
+        #
+        # let all of the connections know of the new state from the message
+        # in the queue
+        #
+        # for update_me in self.need_status_updates:
+        # print "tell " + str(len(self.connections)) + " connections"
+        for budget in self.routes[code] if code != None \
+                else self.update_budgets:
+            # print "telling:"
+            # print update_me
+            update_start = monotonic()
+            budget.update(message)
+            if tracing:
+                update_timings.append(budget.connection.connection +
+                        "={0:.6f}".format(monotonic() - update_start))
+        # print "told everyone"
+        dispatch_seconds = monotonic() - dispatch_start
+        metrics.registry.observe("muther_dispatch_seconds",
+                dispatch_seconds)
+        if tracing:
+            self.profiler.trace(" ".join(
+                    ["{0:.6f}".format(dispatch_start), str(new_state),
+                    repr(queued_from)] + update_timings +
+                    ["total={0:.6f}".format(dispatch_seconds)]))
+
+        if new_state not in MessageTypes.INFO_ONLY:
+            self.note_state(new_state, dispatch_start)
+            self.maintenance_by = message.connection \
+                    if new_state == MessageTypes.ERROR_MAINTENANCE else None
+            metrics.registry.inc("muther_transitions_total",
+                    (("state", new_state),))
+
+        if self.host.recorder != None:
+            self.host.recorder.transition(self.tool_name, new_state,
+                    queued_from)
+
+        if self.state_journal != None:
+            badge_id = message.badge_id
+            if badge_id == None and self.session != None:
+                badge_id = self.session["badge_id"]
+            self.state_journal.record(dispatch_start, time.time(),
+                    new_state, queued_from, badge_id,
+                    monotonic() - dispatch_start)
+
+        if self.dispatch_latencies != None:
+            self.dispatch_latencies.append(monotonic() - dispatch_start)
+
+        if self.booting:
+            self.booting = False
+            boot_timeline.ready(self.boot_prefix + "broadcast " +
+                    str(new_state))
+
+    def reject(self, message):
+        """
+        A message for a state which may not follow the one we are in.  Motion
+        sensors ask for a reset_timer whenever they see anything, so those
+        are expected while the tool is off.
+        """
+        log = logging.getLogger("Interlock.transition")
+        metrics.registry.inc("muther_transitions_rejected_total",
+                (("from", self.current_state), ("to", message.state)))
+        if message.state == MessageTypes.RESET_TIMER:
+            log.debug("ignoring " + repr(message) + " while " +
+                    str(self.current_state))
+        else:
+            log.warning("ignoring " + repr(message) + " while " +
+                    str(self.current_state))
+
+    def locked_out(self):
+        """
+        Tragic errors, cannot do anything.
+        """
+        # for update_me in self.need_status_updates:
+        for update_me in self.connections:
+            update_me.update(ActionMessage(MessageTypes.ERROR_CONFIG))
+
+    def active_mode(self):
+        """
+        We have just activated the tool, set up a timer to wake up whenever
+        we are about ready to turn the tool off
+        """
+        log = logging.getLogger("Interlock.run")
+        log.debug("active_mode start")
+
+        self.clear_all_timers()
+        self.start_session()
+
+        log.debug("active_mode starting timers")
+        self.timer_to_warning = self.scheduler.call_later(
+                self.timeout - self.warning_seconds,
+                self.action_queue.put, ActionMessage(
+                        MessageTypes.INACTIVE_SOON, "Interlock.active_mode()"))
+        log.debug("active_mode end")
+
+
+    def warning_mode(self):
+        """
+        We have just about ready to turn the tool off, set up a timer to wake
+        us up whenever it is time to deactivate the tool
+        """
+        log = logging.getLogger("Interlock.run")
+        log.debug("warning_mode")
+
+        #
+        # the transitions only let us in here from active mode, unless the
+        # config lets inactive_soon follow itself, which starts it over
+        #
+        self.clear_all_timers()
+        self.timer_to_deactivate = self.scheduler.call_later(
+                self.warning_seconds,
+                self.action_queue.put, ActionMessage(
+                        MessageTypes.INACTIVE, "Interlock.active_mode()"))
+
+    def inactive_mode(self):
+        """
+        the tool is off, turn off all timers
+        """
+        log = logging.getLogger("Interlock.run")
+        log.debug("inactive_mode() called")
+
+        self.clear_all_timers()
+        self.end_session()
+
+    def reset_timers(self):
+        """
+        Something noticed the tool being used.  While it is active the warning
+        is pushed back in place, which is only a matter of changing the
+        deadline of the timer, so motion sensors can ask for this many times
+        a second.  Once the warning has been given, or is on its way, the tool
+        goes back to active mode and everyone is told about it.
+        """
+        log = logging.getLogger("Interlock.run")
+        log.debug("reset_timers called")
+
+        if self.timer_to_warning != None and self.scheduler.reschedule(
+                self.timer_to_warning,
+                monotonic() + self.timeout - self.warning_seconds):
+            metrics.registry.inc("muther_deadline_extensions_total")
+        elif self.timer_to_warning != None or \
+                self.timer_to_deactivate != None:
+            self.action_queue.put(ActionMessage(
+                    MessageTypes.ACTIVE, "Interlock.reset_timers()"))
+
+    def error(self):
+        """
+        error mode.  Clear the timers.
+        """
+        log = logging.getLogger("Interlock.run")
+        log.debug("errors called")
+        self.clear_all_timers()
+        self.end_session()
+
+    def start_session(self):
+        """
+        the tool was just activated, unless we are already in a session, this
+        is the start of a new one for the badge that was last checked
+        """
+        if self.session == None:
+            self.session = {
+                "tool_id": self.tool_id,
+                "badge_id": self.badge_id,
+                "start": time.time()
+            }
+
+    def end_session(self):
+        """
+        the tool is no longer in use, put together the session-end report from
+        what the session was and what every connection has to say about it.
+        """
+        if self.session == None:
+            return
+
+        log = logging.getLogger("Interlock.session")
+        report = self.session
+        self.session = None
+
+        report["end"] = time.time()
+        report["seconds"] = round(report["end"] - report["start"], 1)
+        for connection in self.connections:
+            summary = connection.session_summary()
+            if summary:
+                report[connection.connection] = summary
+
+        self.last_session_report = report
+        log.info(json.dumps(report, sort_keys=True))
+
+    def note_state(self, new_state, now):
+        """
+        add the time spent in the state that we are leaving to its total
+        """
+        if self.current_state != None:
+            self.state_seconds[self.current_state] = \
+                    self.state_seconds.get(self.current_state, 0) + \
+                    now - self.state_since
+        self.current_state = new_state
+        self.current_code = MessageTypes.CODES.get(new_state)
+        self.state_since = now
+
+    def state_uptime(self):
+        """
+        the seconds spent in each state so far, for the metrics
+        """
+        seconds = dict(self.state_seconds)
+        current_state, state_since = self.current_state, self.state_since
+        if current_state != None:
+            seconds[current_state] = seconds.get(current_state, 0) + \
+                    monotonic() - state_since
+        return [((("state", state),), value)
+                for state, value in seconds.items()]
+
+    def i2c_retries(self):
+        """
+        how many times each LCD has had to retry a write, for the metrics
+        """
+        return [((("connection", connection.connection),),
+                connection.lcd.retries)
+                for connection in self.connections
+                if isinstance(connection, LcdP018Output) and
+                connection.lcd != None]
+
+    def describe_metrics(self):
+        """
+        describe what we measure, and how to read the metrics that are read
+        rather than counted, which are read from every tool of the host
+        """
+        registry = metrics.registry
+        gather = self.host.gather
+        registry.describe("muther_action_queue_depth", "gauge",
+                "messages waiting in the action_queue",
+                lambda: gather(lambda interlock:
+                        interlock.action_queue.qsize()))
+        registry.describe("muther_action_queue_wait_seconds", "histogram",
+                "how long messages waited in the action_queue")
+        registry.describe("muther_dispatch_seconds", "histogram",
+                "how long each message took to dispatch to every connection")
+        registry.describe("muther_connection_update_seconds", "histogram",
+                "how long each connection's update() took")
+        registry.describe("muther_connection_overruns_total", "counter",
+                "updates that took longer than the connection's budget")
+        registry.describe("muther_connection_slow", "gauge",
+                "1 while a connection is flagged as slow",
+                lambda: gather(Interlock.slow_connections))
+        registry.describe("muther_webservice_request_seconds", "histogram",
+                "how long each webservice request took")
+        registry.describe("muther_webservice_errors_total", "counter",
+                "webservice requests that failed, by reason")
+        registry.describe("muther_i2c_retries_total", "counter",
+                "LCD writes that had to be retried",
+                lambda: gather(Interlock.i2c_retries))
+        registry.describe("muther_state_seconds_total", "counter",
+                "seconds spent in each state",
+                lambda: gather(Interlock.state_uptime))
+        registry.describe("muther_config_reload_seconds", "histogram",
+                "how long each reload of the config took")
+        registry.describe("muther_connections_rebuilt_total", "counter",
+                "connections rebuilt or added by reloading the config")
+        registry.describe("muther_connection_init_seconds", "histogram",
+                "how long each connection took to be made")
+        registry.describe("muther_transitions_total", "counter",
+                "messages which changed the state we are in, by state")
+        registry.describe("muther_deadline_extensions_total", "counter",
+                "reset_timers which only pushed back the warning")
+        registry.describe("muther_transitions_rejected_total", "counter",
+                "messages for a state which may not follow the one we are in")
+        registry.describe("muther_errors_logged_total", "counter",
+                "errors logged since we started",
+                lambda: self.error_log.total)
+
+    def report_budgets(self):
+        """
+        log the connections ranked by how much dispatch time they used since
+        the last report
+        """
+        log = logging.getLogger("Interlock.budget")
+        reports = sorted([budget.take_report()
+                for budget in self.update_budgets],
+                key=lambda report: report["total_seconds"], reverse=True)
+        all_seconds = sum([report["total_seconds"] for report in reports])
+        for rank, report in enumerate(reports):
+            log.info("{0}. {1}: {2:.1f} ms ({3:.0f}%) in {4} calls, "
+                    "worst {5:.1f} ms, {6} over budget{7}".format(rank + 1,
+                    report["connection"], report["total_seconds"] * 1000,
+                    100 * report["total_seconds"] / all_seconds
+                    if all_seconds else 0,
+                    report["calls"], report["worst_seconds"] * 1000,
+                    report["overruns"],
+                    ", degraded" if report["degraded"] else
+                    ", slow" if report["slow"] else ""))
+        self.scheduler.call_later(
+                self.budget_report_seconds, self.report_budgets)
+
+    def slow_connections(self):
+        """
+        which connections are flagged as slow, for the metrics
+        """
+        return [(budget.labels, 1 if budget.slow else 0)
+                for budget in self.update_budgets]
+
+    def report_dispatch(self):
+        """
+        log the median, 99th percentile and worst time taken to dispatch a
+        message since the last report
+        """
+        log = logging.getLogger("Interlock.dispatch")
+        latencies, self.dispatch_latencies = self.dispatch_latencies, []
+        if latencies:
+            latencies.sort()
+            log.info("{0} messages, median: {1:.3f} ms, 99%: {2:.3f} ms, "
+                    "worst: {3:.3f} ms".format(len(latencies),
+                    latencies[len(latencies) // 2] * 1000,
+                    latencies[int(len(latencies) * .99)] * 1000,
+                    latencies[-1] * 1000))
+        self.scheduler.call_later(
+                self.dispatch_report_seconds, self.report_dispatch)
+
+    def clear_all_timers(self):
+        """
+        time to clear the deactivation timer and the deactivation soon timer
+        """
+        if self.timer_to_warning != None:
+            self.timer_to_warning.cancel()
             self.timer_to_warning = None
         if self.timer_to_deactivate != None:
             self.timer_to_deactivate.cancel()
             self.timer_to_deactivate = None
 
+def start_tools(interlocks, error_log):
+    """
+    Start every Interlock, except those whose tool had errors logged while it
+    was being made, which are locked out.  Errors that are not any one
+    tool's, such as those in the settings that the tools share, lock them all
+    out.  Returns the Interlocks that were locked out.
+    """
+    tools = error_log.get_tools()
+    locked_out = [interlock for interlock in interlocks
+            if None in tools or interlock.tool_name in tools]
+    for interlock in interlocks:
+        if interlock in locked_out:
+            interlock.locked_out()
+        else:
+            interlock.start()
+    return locked_out
+
 def run_from_commandline():
     """
     This sets up the data structures required to run the RFID interlock.
@@ -1798,30 +5043,80 @@ def run_from_commandline():
     #
     config = configuration.use_file("/etc/muther.ini")
     config = configuration.read()
+    boot_timeline.mark("read the config from the " + configuration.read_from)
 
     #
     # set up logging
     #
-    error_log = ErrorArrayHandler()
+    error_log_config = config.get("error_log", {})
+    error_log = ErrorArrayHandler(error_log_config.get("capacity", 100),
+            error_log_config.get("max_sources", 256))
     error_log.setLevel(logging.ERROR)
 
     logging.config.dictConfig(config.get('logging', {}))
+
+    #
+    # the configured handlers write from a background thread, so that log
+    # files and the console do not slow down switching the relay
+    #
+    if config.get("log_queue", True):
+        queue_logging()
+
     logger = logging.getLogger()
     logger.addHandler(error_log)
     logger.setLevel(logging.DEBUG)
+    boot_timeline.mark("set up logging")
+
+    #
+    # let's do this thing, with an Interlock for each tool when the config
+    # has "tools", all of them sharing one host
+    #
+    host = Host(config)
+    configs = tool_configs(config)
+    check_tools(configs)
+    interlocks = [Interlock(tool_config, error_log, host, tool_name)
+            for tool_name, tool_config in configs]
+
+    #
+    # kill -USR1 starts the sampling profiler, kill -USR2 stops it
+    #
+    profiler_config = config.get("profiler", {})
+    profiler = SamplingProfiler(profiler_config.get("rate", 100),
+            profiler_config.get("directory", "/var/tmp"))
+    for interlock in interlocks:
+        interlock.profiler = profiler
+    signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.start())
+    signal.signal(signal.SIGUSR2, lambda signum, frame: profiler.stop())
+
+    #
+    # kill -HUP reloads the config, rebuilding only what changed
+    #
+    def reload_config(signum, frame):
+        for interlock in interlocks:
+            interlock.action_queue.put(ActionMessage(
+                    MessageTypes.RELOAD_CONFIG, "SIGHUP"))
+    signal.signal(signal.SIGHUP, reload_config)
 
     #
-    # let's do this thing
+    # an error in a tool's config locks out that tool, one in what they share
+    # locks them all out
     #
-    interlock = Interlock(config, error_log)
-    if error_log.get_errors():
+    if error_log.get_errors() or not interlocks:
         print "here are the errors"
         for init_error in error_log.get_errors():
-            print ":  ".join([
-                init_error.levelname, init_error.name, init_error.message])
-        interlock.locked_out()
-    else:
-        interlock.start()
+            print ":  ".join([init_error.tool or "*", init_error.levelname,
+                init_error.name, init_error.message])
+    for interlock in start_tools(interlocks, error_log):
+        boot_timeline.ready(interlock.boot_prefix + "locked out")
+    if not interlocks:
+        boot_timeline.ready("locked out")
+
+    #
+    # python only runs signal handlers on the main thread, so it waits here
+    # rather than in join() where they would never run
+    #
+    while True:
+        signal.pause()
 
 ################################################################################
 #
@@ -1830,4 +5125,9 @@ def run_from_commandline():
 ################################################################################
 
 if __name__ == "__main__":
+    #
+    # so that plugins which import rfid_interlock get this module, rather
+    # than a second copy of it
+    #
+    sys.modules.setdefault("rfid_interlock", sys.modules[__name__])
     run_from_commandline()
@@ -0,0 +1,472 @@
+#! /usr/bin/python
+
+"""
+Waiting without waking up.
+
+Python 2's threading.Event.wait(timeout) and threading.Timer poll in a loop
+with sleeps of up to 50 ms, so every idle thread with a timeout wakes the
+processor twenty times a second.  The classes here sleep in poll() instead,
+so a thread only wakes up when there is something to do.  poll() rather than
+select(), which cannot go past file descriptor 1023, so that a process can
+run as many tools as it has file descriptors for:
+
+    WakeupEvent: an Event whose wait(timeout) really sleeps
+    Scheduler: one thread which runs every timer, blink and deadline, and
+        in the reactor runtime also reads every file that is ready
+    Executor: a few threads for the calls that would block the Scheduler
+    WakeupCounter: counts wakeups so that they can be reported per second
+"""
+
+import time, threading, heapq, select, fcntl, os, errno, logging, Queue, math
+
+################################################################################
+#
+#  monotonic clock
+#
+################################################################################
+
+def _make_monotonic():
+    """
+    python 2 has no time.monotonic(), so ask the C library for it, and fall
+    back to the wall clock if we have to.
+    """
+    if hasattr(time, "monotonic"):
+        return time.monotonic
+
+    try:
+        import ctypes, ctypes.util
+
+        class timespec(ctypes.Structure):
+            _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+        librt = ctypes.CDLL(ctypes.util.find_library("rt") or "libc.so.6",
+                use_errno=True)
+        clock_gettime = librt.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        clock_monotonic = 1
+
+        def monotonic():
+            now = timespec()
+            if clock_gettime(clock_monotonic, ctypes.pointer(now)) != 0:
+                raise OSError(ctypes.get_errno(), "clock_gettime failed")
+            return now.tv_sec + now.tv_nsec * 1e-9
+
+        monotonic()
+        return monotonic
+    except (ImportError, OSError, AttributeError):
+        return time.time
+
+monotonic = _make_monotonic()
+
+################################################################################
+#
+#  counting wakeups
+#
+################################################################################
+
+class WakeupCounter(object):
+    """
+    Each thread that wakes up calls tick() with its name.  rates() returns the
+    wakeups per second of each name since rates() was last called.
+    """
+    def __init__(self):
+        self.counts = {}
+        self.last_counts = {}
+        self.since = monotonic()
+
+    def tick(self, name):
+        """
+        take note of a wakeup
+        """
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def rates(self):
+        """
+        returns a dictionary of name to wakeups per second
+        """
+        now = monotonic()
+        elapsed = max(now - self.since, 1e-6)
+        counts = dict(self.counts)
+        rates = {
+                name: (count - self.last_counts.get(name, 0)) / elapsed
+                for name, count in counts.items()}
+        self.last_counts = counts
+        self.since = now
+        return rates
+
+wakeups = WakeupCounter()
+
+def poll_timeout(seconds):
+    """
+    a timeout in seconds, or None, as poll() wants it: in whole milliseconds,
+    rounded up so that we never wake up just before a deadline and spin
+    """
+    if seconds == None:
+        return None
+    return max(0, int(math.ceil(seconds * 1000)))
+
+################################################################################
+#
+#  an Event that sleeps
+#
+################################################################################
+
+class WakeupEvent(object):
+    """
+    Works like threading.Event, but wait() sleeps in poll() on a pipe so it
+    does not wake up while it waits.
+
+    The pipe is only given back by close(), after which the event stays set
+    for good, so that whoever is still waiting on it wakes up.
+    """
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        for fd in (self.read_fd, self.write_fd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.flag = False
+        self.closed = False
+
+        #
+        # so that set() never writes to a file descriptor that close() has
+        # given back, and that something else may have been given since
+        #
+        self.lock = threading.Lock()
+
+    def fileno(self):
+        """
+        so that the event can be handed to poll() along with other files
+        """
+        return self.read_fd
+
+    def set(self):
+        """
+        wake up whoever is waiting
+        """
+        self.flag = True
+        with self.lock:
+            if self.closed:
+                return
+            try:
+                os.write(self.write_fd, "x")
+            except OSError:
+                #
+                # the pipe is full, so whoever is waiting will wake up anyway
+                #
+                pass
+
+    def clear(self):
+        """
+        go back to not being set
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.flag = False
+            try:
+                while os.read(self.read_fd, 4096):
+                    pass
+            except OSError:
+                pass
+
+    def is_set(self):
+        """
+        returns whether set() has been called since the last clear()
+        """
+        return self.flag
+
+    def wait(self, timeout=None):
+        """
+        sleep until set() is called, or until timeout seconds have passed.
+        Returns whether the event is set.
+        """
+        if not self.flag:
+            poller = select.poll()
+            poller.register(self.read_fd, select.POLLIN)
+            try:
+                poller.poll(poll_timeout(timeout))
+            except select.error:
+                #
+                # interrupted by a signal
+                #
+                pass
+        return self.flag
+
+    def close(self):
+        """
+        give the pipe back, the event is set from now on
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.flag = True
+            self.closed = True
+            try:
+                os.write(self.write_fd, "x")
+            except OSError:
+                pass
+            os.close(self.read_fd)
+            os.close(self.write_fd)
+
+################################################################################
+#
+#  one thread for all of the timers
+#
+################################################################################
+
+class ScheduledCall(object):
+    """
+    returned by the Scheduler so that the call can be cancelled, like a
+    threading.Timer
+    """
+    def __init__(self, deadline, function, args):
+        self.deadline = deadline
+        self.function = function
+        self.args = args
+        self.cancelled = False
+        self.made = False
+
+    def cancel(self):
+        """
+        do not make the call after all
+        """
+        self.cancelled = True
+
+class Scheduler(threading.Thread):
+    """
+    Runs functions at their deadlines from a single thread, instead of a
+    thread per threading.Timer.  The thread only wakes up when a deadline has
+    passed, when an earlier deadline is added, or when a file that is being
+    read from has something to read.
+
+    The functions are called on the scheduler's thread, so they must be quick
+    and must not block.  Whatever goes wrong is logged, and the thread keeps
+    going, as every tool in the process depends on it.
+    """
+    def __init__(self):
+        threading.Thread.__init__(self, name="Scheduler")
+        self.daemon = True
+        self.lock = threading.Lock()
+        self.calls = []
+        self.sequence = 0
+        self.readers = {}
+        self.wakeup = WakeupEvent()
+
+        #
+        # the file descriptors that are registered with the poller, which
+        # only the scheduler's thread touches
+        #
+        self.poller = select.poll()
+        self.polling = set()
+
+    def add_reader(self, file, function, *args):
+        """
+        call function(*args) whenever file, which is a file descriptor or has
+        a fileno(), has something to read
+        """
+        fd = file if isinstance(file, int) else file.fileno()
+        with self.lock:
+            self.readers[fd] = (function, args)
+        self.wakeup.set()
+
+    def remove_reader(self, file):
+        """
+        stop reading from file
+        """
+        fd = file if isinstance(file, int) else file.fileno()
+        with self.lock:
+            self.readers.pop(fd, None)
+        self.wakeup.set()
+
+    def call_soon(self, function, *args):
+        """
+        call function(*args) on the scheduler's thread as soon as it can
+        """
+        return self.call_at(0, function, *args)
+
+    def call_later(self, seconds, function, *args):
+        """
+        call function(*args) in seconds from now
+        """
+        return self.call_at(monotonic() + seconds, function, *args)
+
+    def call_at(self, deadline, function, *args):
+        """
+        call function(*args) once monotonic() reaches deadline
+        """
+        call = ScheduledCall(deadline, function, args)
+        with self.lock:
+            self.sequence += 1
+            heapq.heappush(self.calls, (deadline, self.sequence, call))
+            earliest = self.calls[0][2] is call
+        if earliest:
+            self.wakeup.set()
+        return call
+
+    def reschedule(self, call, deadline):
+        """
+        Move a call which has not been made yet to a new deadline, returns
+        whether it was still waiting.  Moving it later only changes its
+        deadline, and it is put back when the old one comes round, so that
+        pushing a deadline back many times a second costs next to nothing.
+        """
+        with self.lock:
+            if call.made or call.cancelled:
+                return False
+            earlier = deadline < call.deadline
+            call.deadline = deadline
+            if earlier:
+                self.sequence += 1
+                heapq.heappush(self.calls, (deadline, self.sequence, call))
+                earliest = self.calls[0][2] is call
+        if earlier and earliest:
+            self.wakeup.set()
+        return True
+
+    def run(self):
+        """
+        call whatever is due, then sleep until the next deadline
+        """
+        log = logging.getLogger("Scheduler.run")
+        while True:
+            self.wakeup.clear()
+            with self.lock:
+                now = monotonic()
+                due = []
+                while self.calls and self.calls[0][0] <= now:
+                    deadline, sequence, call = heapq.heappop(self.calls)
+                    if call.made:
+                        #
+                        # moved earlier, and made at its new deadline
+                        #
+                        continue
+                    if call.deadline > now:
+                        #
+                        # moved later
+                        #
+                        self.sequence += 1
+                        heapq.heappush(self.calls,
+                                (call.deadline, self.sequence, call))
+                        continue
+                    call.made = True
+                    due.append(call)
+                timeout = self.calls[0][0] - now if self.calls else None
+                reading = self.readers.keys()
+
+            for call in due:
+                if not call.cancelled:
+                    try:
+                        call.function(*call.args)
+                    except Exception:
+                        log.exception("scheduled call failed: " +
+                                repr(call.function))
+
+            if due:
+                continue
+            if not reading:
+                self.wakeup.wait(timeout)
+                wakeups.tick("Scheduler")
+                continue
+
+            try:
+                ready = self.poll(reading, timeout)
+            except Exception:
+                #
+                # keep going, or every timer and reader of every tool would
+                # stop with us, but not so fast that the log fills up
+                #
+                log.exception("poll() failed")
+                time.sleep(.1)
+                continue
+            wakeups.tick("Scheduler")
+            for fd, events in ready:
+                #
+                # a reader may be removed by the one before it
+                #
+                reader = self.readers.get(fd)
+                if reader == None:
+                    continue
+                function, args = reader
+                if events & select.POLLNVAL:
+                    log.error("not a file any more, no longer reading it: " +
+                            repr(function))
+                    self.remove_reader(fd)
+                    continue
+                try:
+                    function(*args)
+                except Exception:
+                    log.exception("reader failed: " + repr(function))
+
+    def poll(self, reading, timeout):
+        """
+        bring the poller up to date with the readers, and wait for up to
+        timeout seconds for them, returns [(fd, events)] of those that are
+        ready
+        """
+        log = logging.getLogger("Scheduler.run")
+        wanted = set(reading)
+        wanted.add(self.wakeup.fileno())
+        for fd in self.polling - wanted:
+            self.poller.unregister(fd)
+            self.polling.discard(fd)
+        for fd in wanted - self.polling:
+            try:
+                self.poller.register(fd, select.POLLIN)
+                self.polling.add(fd)
+            except (ValueError, TypeError, OverflowError) as error:
+                log.error("cannot read from " + repr(fd) + ", no longer " +
+                        "reading it: " + repr(error))
+                self.remove_reader(fd)
+        try:
+            return self.poller.poll(poll_timeout(timeout))
+        except select.error as error:
+            if error.args[0] != errno.EINTR:
+                raise
+            return []
+
+################################################################################
+#
+#  a few threads for what would block
+#
+################################################################################
+
+class Executor(object):
+    """
+    Runs the calls that would block the Scheduler, such as a webservice
+    request, on a few threads of its own, and calls back on the scheduler's
+    thread with what they returned.
+    """
+    def __init__(self, scheduler, workers=2):
+        self.scheduler = scheduler
+        self.calls = Queue.Queue()
+        self.threads = []
+        for number in range(workers):
+            thread = threading.Thread(target=self.work,
+                    name="Executor-" + str(number + 1))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, function, args=(), done=None):
+        """
+        call function(*args) on one of the executor's threads, then
+        done(result) on the scheduler's thread, or not at all if function
+        raised
+        """
+        self.calls.put((function, args, done))
+
+    def work(self):
+        """
+        a worker: wait for a call, make it, pass the result back
+        """
+        log = logging.getLogger("Executor.work")
+        while True:
+            function, args, done = self.calls.get()
+            wakeups.tick(threading.current_thread().name)
+            try:
+                result = function(*args)
+            except Exception:
+                log.exception("call failed: " + repr(function))
+                continue
+            if done != None:
+                self.scheduler.call_soon(done, result)
@@ -0,0 +1,324 @@
+#! /usr/bin/python
+
+"""
+A compact journal of every state transition, cheap enough to leave on all the
+time: fixed size records in a memory mapped ring file, so that writing one is
+a struct.pack_into, and the file never grows.
+
+The file is laid out as:
+
+    header (HEADER_SIZE bytes): magic, version, record size, capacity, how
+        many records each time index entry covers, the sequence number of the
+        next record, and the table of state names as JSON
+    time index: the wall time of the first record in each chunk of the ring
+    records: capacity records of RECORD
+
+Each record holds the monotonic time, the wall time, the state (an index into
+the table of state names), the start of the source's description, a hash of
+the badge id, and how long the transition took to dispatch.
+
+Run from the command line to answer questions about the journal:
+
+    state_journal.py /var/lib/muther/states.ring sessions-per-badge
+    state_journal.py /var/lib/muther/states.ring denials-per-hour --hours 24
+    state_journal.py /var/lib/muther/states.ring time-in-error
+    state_journal.py /var/lib/muther/states.ring dump --hours 1
+"""
+
+import mmap, os, struct, json, zlib, time, bisect, threading
+
+MAGIC = "MSTJ"
+VERSION = 1
+HEADER = struct.Struct("<4sHHIIQ")
+HEADER_SIZE = 4096
+STATE_NAMES_OFFSET = HEADER.size
+RECORD = struct.Struct("<ddHHIf16s")
+INDEX_ENTRY = struct.Struct("<d")
+
+def badge_hash(badge_id):
+    """
+    a 32 bit hash of the badge id, 0 for no badge
+    """
+    if not badge_id:
+        return 0
+    return zlib.crc32(str(badge_id)) & 0xffffffff or 1
+
+class StateJournal(object):
+    """
+    Open an existing journal, or create one with room for capacity records.
+    Opened for writing, record() adds a transition; opened for reading,
+    records() goes through them oldest first.
+    """
+    def __init__(self, filename, capacity=65536, index_every=256,
+            writable=True):
+        self.filename = filename
+        self.writable = writable
+        self.lock = threading.Lock()
+
+        if writable and not os.path.exists(filename):
+            #
+            # so that the chunks of the time index line up as the ring wraps
+            #
+            capacity = self.index_entries(capacity, index_every) * index_every
+            self.create(filename, capacity, index_every)
+
+        self.file = open(filename, "r+b" if writable else "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0,
+                access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+
+        magic, version, record_size, self.capacity, self.index_every, \
+                next_sequence = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION or \
+                record_size != RECORD.size:
+            raise ValueError(filename + ": not a version " + repr(VERSION) +
+                    " state journal")
+
+        self.index_offset = HEADER_SIZE
+        self.records_offset = self.index_offset + \
+                INDEX_ENTRY.size * self.index_entries(self.capacity,
+                        self.index_every)
+        self.state_names = self.read_state_names()
+        self.state_codes = {
+                name: code for code, name in enumerate(self.state_names)}
+
+    @staticmethod
+    def index_entries(capacity, index_every):
+        """
+        how many entries the time index has
+        """
+        return (capacity + index_every - 1) // index_every
+
+    @classmethod
+    def create(cls, filename, capacity, index_every):
+        """
+        make an empty journal
+        """
+        directory = os.path.dirname(filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        size = HEADER_SIZE + \
+                INDEX_ENTRY.size * cls.index_entries(capacity, index_every) + \
+                RECORD.size * capacity
+        temporary_filename = filename + ".tmp"
+        with open(temporary_filename, "wb") as journal:
+            journal.write(HEADER.pack(MAGIC, VERSION, RECORD.size, capacity,
+                    index_every, 0))
+            journal.write("[]")
+            journal.truncate(size)
+        os.rename(temporary_filename, filename)
+
+    def close(self):
+        """
+        done with the journal
+        """
+        self.map.close()
+        self.file.close()
+
+    def next_sequence(self):
+        """
+        the sequence number that the next record will get
+        """
+        return HEADER.unpack_from(self.map, 0)[5]
+
+    def read_state_names(self):
+        """
+        the table of state names from the header
+        """
+        table = self.map[STATE_NAMES_OFFSET:HEADER_SIZE].rstrip("\0")
+        return [str(name) for name in json.loads(table or "[]")]
+
+    def state_code(self, state):
+        """
+        the code for a state name, adding it to the table if it is new
+        """
+        code = self.state_codes.get(state)
+        if code == None:
+            names = self.state_names + [state]
+            table = json.dumps(names)
+            if len(table) > HEADER_SIZE - STATE_NAMES_OFFSET:
+                return 0xffff
+            self.map[STATE_NAMES_OFFSET:STATE_NAMES_OFFSET + len(table)] = \
+                    table
+            self.state_names = names
+            code = len(names) - 1
+            self.state_codes[state] = code
+        return code
+
+    def record(self, monotonic_time, wall_time, state, source="",
+            badge_id=None, latency=0.0):
+        """
+        add a transition to the ring, overwriting the oldest when it is full
+        """
+        source = (source or "")[:16]
+        if isinstance(source, unicode):
+            source = source.encode("ascii", "replace")
+        with self.lock:
+            sequence = self.next_sequence()
+            slot = sequence % self.capacity
+            RECORD.pack_into(self.map, self.records_offset + slot * RECORD.size,
+                    monotonic_time, wall_time, self.state_code(state), 0,
+                    badge_hash(badge_id), latency, source)
+            if slot % self.index_every == 0:
+                INDEX_ENTRY.pack_into(self.map, self.index_offset +
+                        INDEX_ENTRY.size * (slot // self.index_every),
+                        wall_time)
+            struct.pack_into("<Q", self.map, HEADER.size - 8, sequence + 1)
+
+    def read(self, sequence):
+        """
+        the record with this sequence number, as a dictionary
+        """
+        slot = sequence % self.capacity
+        monotonic_time, wall_time, state, flags, badge, latency, source = \
+                RECORD.unpack_from(self.map,
+                        self.records_offset + slot * RECORD.size)
+        return {
+            "sequence": sequence,
+            "monotonic": monotonic_time,
+            "time": wall_time,
+            "state": self.state_names[state]
+                    if state < len(self.state_names) else "?",
+            "badge": badge,
+            "latency": latency,
+            "from": source.rstrip("\0")
+        }
+
+    def first_sequence(self, since=None):
+        """
+        the sequence number of the oldest record, or of the first record at or
+        after since, found with the time index
+        """
+        next_sequence = self.next_sequence()
+        oldest = max(0, next_sequence - self.capacity)
+        if since == None or next_sequence == 0:
+            return oldest
+
+        #
+        # the index entries that are in the ring, oldest first, as
+        # (wall time, sequence number of the first record they cover)
+        #
+        first_chunk = (oldest + self.index_every - 1) // self.index_every
+        last_chunk = (next_sequence - 1) // self.index_every
+        chunks = []
+        for chunk in range(first_chunk, last_chunk + 1):
+            sequence = chunk * self.index_every
+            slot = sequence % self.capacity
+            chunks.append((INDEX_ENTRY.unpack_from(self.map,
+                    self.index_offset +
+                    INDEX_ENTRY.size * (slot // self.index_every))[0],
+                    sequence))
+
+        position = bisect.bisect_left(chunks, (since, -1))
+        sequence = oldest if position == 0 else chunks[position - 1][1]
+        while sequence < next_sequence and self.read(sequence)["time"] < since:
+            sequence += 1
+        return sequence
+
+    def records(self, since=None, until=None):
+        """
+        the records from since until until, oldest first
+        """
+        sequence = self.first_sequence(since)
+        next_sequence = self.next_sequence()
+        while sequence < next_sequence:
+            record = self.read(sequence)
+            if until != None and record["time"] > until:
+                break
+            yield record
+            sequence += 1
+
+################################################################################
+#
+#  queries
+#
+################################################################################
+
+SESSION_STATES = ["active", "inactive_soon"]
+INFO_ONLY_STATES = ["testing_network", "check_badge", "login_denied"]
+
+def sessions_per_badge(records):
+    """
+    how many sessions each badge hash started
+    """
+    counts = {}
+    previous_state = None
+    for record in records:
+        if record["state"] == "active" and \
+                previous_state not in SESSION_STATES:
+            counts[record["badge"]] = counts.get(record["badge"], 0) + 1
+        if record["state"] not in INFO_ONLY_STATES:
+            previous_state = record["state"]
+    return counts
+
+def denials_per_hour(records):
+    """
+    how many badges were denied in each hour
+    """
+    counts = {}
+    for record in records:
+        if record["state"] == "login_denied":
+            hour = int(record["time"] // 3600 * 3600)
+            counts[hour] = counts.get(hour, 0) + 1
+    return counts
+
+def time_in_error(records):
+    """
+    how many seconds were spent in each error state
+    """
+    seconds = {}
+    previous = None
+    for record in records:
+        if record["state"] in INFO_ONLY_STATES:
+            continue
+        if previous != None and previous["state"].startswith("error"):
+            elapsed = record["monotonic"] - previous["monotonic"]
+            if elapsed < 0:
+                #
+                # rebooted in between, the monotonic clock started over
+                #
+                elapsed = max(0, record["time"] - previous["time"])
+            seconds[previous["state"]] = \
+                    seconds.get(previous["state"], 0) + elapsed
+        previous = record
+    return seconds
+
+def main(argv=None):
+    """
+    answer questions about a state journal from the command line
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description="query a state journal")
+    parser.add_argument("journal")
+    parser.add_argument("query", choices=["sessions-per-badge",
+            "denials-per-hour", "time-in-error", "dump"])
+    parser.add_argument("--hours", type=float,
+            help="only look at the last this many hours")
+    arguments = parser.parse_args(argv)
+
+    journal = StateJournal(arguments.journal, writable=False)
+    since = time.time() - arguments.hours * 3600 if arguments.hours else None
+    records = journal.records(since)
+
+    if arguments.query == "sessions-per-badge":
+        counts = sessions_per_badge(records)
+        for badge in sorted(counts, key=counts.get, reverse=True):
+            print "%08x %6d" % (badge, counts[badge])
+    elif arguments.query == "denials-per-hour":
+        counts = denials_per_hour(records)
+        for hour in sorted(counts):
+            print time.strftime("%Y-%m-%d %H:00", time.localtime(hour)), \
+                    "%6d" % counts[hour]
+    elif arguments.query == "time-in-error":
+        seconds = time_in_error(records)
+        for state in sorted(seconds):
+            print "%-20s %10.1f" % (state, seconds[state])
+    else:
+        for record in records:
+            print time.strftime("%Y-%m-%d %H:%M:%S",
+                    time.localtime(record["time"])), \
+                    "%-18s %08x %8.4f %s" % (record["state"], record["badge"],
+                    record["latency"], record["from"])
+    journal.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+#! /usr/bin/python
+
+"""
+the rules for blocks of badges, and the compiled roster
+
+    cd beagle-bone-black/software && python -m unittest discover -s tests
+"""
+
+import os, sys, shutil, tempfile, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        ".."))
+
+import badge_index
+from rfid_interlock import BadgeRules
+
+class BadgeRulesTest(unittest.TestCase):
+    def rules(self, rules, problems=[]):
+        badge_rules = BadgeRules()
+        self.assertEqual(badge_rules.compile(rules), problems)
+        return badge_rules
+
+    def test_range(self):
+        rules = self.rules([("1000-1999", "active")])
+        self.assertEqual(rules.lookup("999"), None)
+        self.assertEqual(rules.lookup("1000"), "active")
+        self.assertEqual(rules.lookup("1999"), "active")
+        self.assertEqual(rules.lookup("2000"), None)
+
+    def test_prefix(self):
+        rules = self.rules([("2150*", "active")])
+        self.assertEqual(rules.lookup("2150"), "active")
+        self.assertEqual(rules.lookup("21509999"), "active")
+        self.assertEqual(rules.lookup("215"), None)
+        self.assertEqual(rules.lookup("2151"), None)
+
+    def test_facility(self):
+        rules = self.rules([("facility:123", "active"),
+                ("facility:9:20", "login_denied")])
+        self.assertEqual(rules.lookup(str(123 << 16)), "active")
+        self.assertEqual(rules.lookup(str((123 << 16) + 65535)), "active")
+        self.assertEqual(rules.lookup(str(124 << 16)), None)
+        self.assertEqual(rules.lookup(str((9 << 20) + 5)), "login_denied")
+
+    def test_not_a_number(self):
+        rules = self.rules([("1000-1999", "active")])
+        self.assertEqual(rules.lookup("1500a"), None)
+        self.assertEqual(rules.lookup(None), None)
+        self.assertEqual(rules.lookup(1500), None)
+
+    def test_same_state_overlaps(self):
+        rules = self.rules([("1000-1999", "active"), ("1500-2500", "active"),
+                ("2501-2600", "active")])
+        self.assertEqual(rules.starts, [1000])
+        self.assertEqual(rules.ends, [2600])
+
+    def test_different_state_overlaps(self):
+        badge_rules = BadgeRules()
+        problems = badge_rules.compile([("1000-1999", "active"),
+                ("1500-2500", "login_denied")])
+        self.assertEqual(problems, ["1500-2500 (login_denied) and " +
+                "1000-1999 (active) both cover 1500"])
+
+        #
+        # the rule with the lowest badges keeps the ones they share
+        #
+        self.assertEqual(badge_rules.lookup("1700"), "active")
+        self.assertEqual(badge_rules.lookup("2200"), "login_denied")
+
+    def test_inside_another(self):
+        badge_rules = BadgeRules()
+        problems = badge_rules.compile([("1000-1999", "active"),
+                ("1500-1600", "login_denied")])
+        self.assertEqual(len(problems), 1)
+        self.assertEqual(badge_rules.lookup("1550"), "active")
+        self.assertEqual(badge_rules.lookup("1999"), "active")
+
+    def test_nonsense(self):
+        badge_rules = BadgeRules()
+        problems = badge_rules.compile([("2000-1000", "active"),
+                ("0123*", "active"), ("facility:x", "active")])
+        self.assertEqual(len(problems), 3)
+        self.assertEqual(badge_rules.lookup("1500"), None)
+
+    def test_is_rule(self):
+        self.assertTrue(BadgeRules.is_rule("1000-1999"))
+        self.assertTrue(BadgeRules.is_rule("2150*"))
+        self.assertTrue(BadgeRules.is_rule("facility:123"))
+        self.assertFalse(BadgeRules.is_rule("8945884"))
+        self.assertFalse(BadgeRules.is_rule("default"))
+
+class BadgeIndexTest(unittest.TestCase):
+    roster = [
+        "# badge, state",
+        "8945884, active",
+        "9089706 error:maintenance",
+        "10216663",
+        "",
+        "123, login_denied  # expired"
+    ]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "badges.idx")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def compile(self, lines):
+        entries, problems = badge_index.read_roster(lines)
+        self.assertEqual(problems, [])
+        self.assertEqual(badge_index.compile_roster(entries, self.filename),
+                [])
+
+    def test_read_roster(self):
+        entries, problems = badge_index.read_roster(self.roster)
+        self.assertEqual(problems, [])
+        self.assertEqual(entries, [
+            ("8945884", "active", 2),
+            ("9089706", "error:maintenance", 3),
+            ("10216663", "active", 4),
+            ("123", "login_denied", 6)])
+        entries, problems = badge_index.read_roster(["1 active extra",
+                "1" * (badge_index.KEY_WIDTH + 1)])
+        self.assertEqual(entries, [])
+        self.assertEqual(len(problems), 2)
+
+    def test_lookup(self):
+        self.compile(self.roster)
+        index = badge_index.BadgeIndex(self.filename)
+        self.assertEqual(len(index), 4)
+        self.assertEqual(index.lookup("8945884"), "active")
+        self.assertEqual(index.lookup(9089706), "error:maintenance")
+        self.assertEqual(index.lookup("10216663"), "active")
+        self.assertEqual(index.lookup("123"), "login_denied")
+
+        #
+        # neighbours, and prefixes, of the badges that are there
+        #
+        for badge in ("12", "1234", "8945883", "8945885", "0", "99999999",
+                "1" * (badge_index.KEY_WIDTH + 1)):
+            self.assertEqual(index.lookup(badge), None)
+        self.assertEqual(index.states(), {"active": 2,
+                "error:maintenance": 1, "login_denied": 1})
+
+    def test_empty(self):
+        self.compile([])
+        index = badge_index.BadgeIndex(self.filename)
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.lookup("123"), None)
+
+    def test_many(self):
+        self.compile([str(badge) for badge in range(1, 5000, 3)])
+        index = badge_index.BadgeIndex(self.filename)
+        for badge in range(1, 5000):
+            self.assertEqual(index.lookup(str(badge)),
+                    "active" if badge % 3 == 1 else None)
+
+    def test_conflicts(self):
+        entries, problems = badge_index.read_roster(["1 active",
+                "1 login_denied", "2 active", "2 active", "3 nonsense"])
+        problems = badge_index.compile_roster(entries, self.filename,
+                ["active", "login_denied"])
+        self.assertEqual(problems, [
+            "line 2: 1: is also on line 1 as active",
+            "line 5: nonsense: is not a state"])
+        self.assertFalse(os.path.exists(self.filename))
+
+    def test_replaced(self):
+        self.compile(["1 active"])
+        index = badge_index.BadgeIndex(self.filename)
+        self.assertEqual(index.lookup("1"), "active")
+        self.compile(["1 login_denied", "2"])
+        self.assertEqual(index.lookup("1"), "login_denied")
+        self.assertEqual(index.lookup("2"), "active")
+
+    def test_broken_replacement(self):
+        self.compile(["1 active"])
+        index = badge_index.BadgeIndex(self.filename)
+        with open(self.filename + ".new", "wb") as broken:
+            broken.write("not an index")
+        os.rename(self.filename + ".new", self.filename)
+        self.assertEqual(index.lookup("1"), "active")
+
+    def test_not_an_index(self):
+        with open(self.filename, "wb") as broken:
+            broken.write("x" * badge_index.HEADER_SIZE)
+        self.assertRaises(ValueError, badge_index.BadgeIndex, self.filename)
+
+if __name__ == "__main__":
+    unittest.main()
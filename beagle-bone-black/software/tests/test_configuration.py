@@ -0,0 +1,71 @@
+#! /usr/bin/python
+
+"""
+checking the config, starting with the example muther.ini
+
+    cd beagle-bone-black/software && python -m unittest discover -s tests
+"""
+
+import os, sys, json, unittest
+
+directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, directory)
+
+import configuration
+
+def example():
+    with open(os.path.join(directory, "muther.ini")) as example_file:
+        return json.load(example_file)
+
+def errors(problems):
+    return [problem for problem in problems if problem.startswith("error: ")]
+
+class ExampleTest(unittest.TestCase):
+    def test_example(self):
+        self.assertEqual(errors(configuration.check(example())), [])
+
+    def test_saved_connections(self):
+        """
+        the webservice and event log that the example keeps aside
+        """
+        config = example()
+        saveme = config.pop("saveme")
+        for name in ("save_makermanager", "event_log"):
+            config[name] = saveme[name]
+        self.assertEqual(configuration.check(config, warn=False), [])
+
+    def test_defaults(self):
+        config = example()
+        configuration.check(config, fill_defaults=True)
+        self.assertEqual(config["config_check_seconds"], 0)
+        self.assertEqual(config["runtime"], "threads")
+
+class CheckTest(unittest.TestCase):
+    def test_bad_setting(self):
+        self.assertEqual(errors(configuration.check({"timeout": "a"})),
+                ["error: timeout: 'a' needs to be a float or an int"])
+
+    def test_bad_connection_type(self):
+        problems = errors(configuration.check(
+                {"P9_9": {"type": "nope"}}))
+        self.assertEqual(len(problems), 1)
+        self.assertTrue(problems[0].startswith(
+                "error: P9_9: type: 'nope' should be one of: "))
+
+    def test_tools(self):
+        problems = configuration.check({"tools": {
+            "lathe": {"timeout": "a"},
+            "mill": 3}})
+        self.assertEqual(errors(problems), [
+            "error: tools: lathe: timeout: 'a' needs to be a float or an int",
+            "error: tools: mill: needs to be a dictionary"])
+
+    def test_webservice_needs_a_url(self):
+        problems = errors(configuration.check({"ws": {
+            "type": "webservice:connection",
+            "check_badge": {"active:when": {"authorized": True}}}}))
+        self.assertEqual(len(problems), 1)
+        self.assertIn("needs to be a url", problems[0])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,150 @@
+#! /usr/bin/python
+
+"""
+the Scheduler's ordering of calls, and WakeupEvent
+
+    cd beagle-bone-black/software && python -m unittest discover -s tests
+"""
+
+import os, sys, time, Queue, logging, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        ".."))
+
+from scheduler import Scheduler, WakeupEvent, monotonic
+
+#
+# the failures that the scheduler logs are expected here
+#
+logging.getLogger().addHandler(logging.NullHandler())
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = Scheduler()
+        self.scheduler.start()
+        self.made = Queue.Queue()
+
+    def call(self, seconds, name):
+        return self.scheduler.call_later(seconds, self.made.put, name)
+
+    def names(self, count):
+        """
+        the names of the next count calls that are made, in order
+        """
+        return [self.made.get(timeout=2) for number in range(count)]
+
+    def assertNothingMade(self, seconds=.15):
+        self.assertRaises(Queue.Empty, self.made.get, True, seconds)
+
+    def test_deadline_order(self):
+        self.call(.15, "c")
+        self.call(.05, "a")
+        self.call(.1, "b")
+        self.assertEqual(self.names(3), ["a", "b", "c"])
+
+    def test_same_deadline_in_order_added(self):
+        deadline = monotonic() + .05
+        for name in ("a", "b", "c"):
+            self.scheduler.call_at(deadline, self.made.put, name)
+        self.assertEqual(self.names(3), ["a", "b", "c"])
+
+    def test_reschedule_later(self):
+        moved = self.call(.05, "moved")
+        self.call(.1, "stays")
+        self.assertTrue(self.scheduler.reschedule(moved, monotonic() + .2))
+        self.assertEqual(self.names(2), ["stays", "moved"])
+        self.assertNothingMade()
+
+    def test_reschedule_earlier(self):
+        self.call(.15, "stays")
+        moved = self.call(5, "moved")
+        self.assertTrue(self.scheduler.reschedule(moved, monotonic() + .05))
+        self.assertEqual(self.names(2), ["moved", "stays"])
+
+        #
+        # the entry left behind at the old deadline is not made again
+        #
+        self.assertNothingMade()
+
+    def test_reschedule_many_times(self):
+        call = self.call(.05, "pushed back")
+        for number in range(100):
+            self.scheduler.reschedule(call, monotonic() + .1)
+        self.assertEqual(self.names(1), ["pushed back"])
+        self.assertNothingMade()
+
+    def test_cancel(self):
+        cancelled = self.call(.05, "cancelled")
+        self.call(.1, "made")
+        cancelled.cancel()
+        self.assertEqual(self.names(1), ["made"])
+        self.assertNothingMade()
+        self.assertFalse(self.scheduler.reschedule(cancelled,
+                monotonic() + .05))
+
+    def test_cancel_after_reschedule(self):
+        call = self.call(.05, "cancelled")
+        self.scheduler.reschedule(call, monotonic() + .1)
+        call.cancel()
+        self.assertNothingMade(.2)
+
+    def test_reschedule_after_made(self):
+        call = self.call(0, "made")
+        self.assertEqual(self.names(1), ["made"])
+        self.assertFalse(self.scheduler.reschedule(call, monotonic() + .05))
+        self.assertNothingMade()
+
+    def test_failing_call(self):
+        self.scheduler.call_later(0, lambda: 1 / 0)
+        self.call(.05, "after")
+        self.assertEqual(self.names(1), ["after"])
+
+class WakeupEventTest(unittest.TestCase):
+    def test_set_and_clear(self):
+        event = WakeupEvent()
+        self.assertFalse(event.is_set())
+        self.assertFalse(event.wait(.01))
+        event.set()
+        self.assertTrue(event.is_set())
+        self.assertTrue(event.wait(0))
+        event.clear()
+        self.assertFalse(event.is_set())
+        self.assertFalse(event.wait(.01))
+        event.close()
+
+    def test_set_many_times(self):
+        event = WakeupEvent()
+        for number in range(100000):
+            event.set()
+        event.clear()
+        self.assertFalse(event.wait(0))
+        event.close()
+
+    def test_close(self):
+        event = WakeupEvent()
+        event.close()
+        self.assertTrue(event.is_set())
+        started = time.time()
+        self.assertTrue(event.wait(5))
+        self.assertLess(time.time() - started, 1)
+
+        #
+        # still set, and safe to use, after it is closed
+        #
+        event.clear()
+        event.set()
+        event.close()
+        self.assertTrue(event.wait(0))
+
+    def test_close_wakes_the_scheduler(self):
+        scheduler = Scheduler()
+        scheduler.start()
+        event = WakeupEvent()
+        scheduler.add_reader(event, lambda: None)
+        event.close()
+        made = Queue.Queue()
+        scheduler.call_later(.05, made.put, "made")
+        self.assertEqual(made.get(timeout=2), "made")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,150 @@
+#! /usr/bin/python
+
+"""
+the ring of state transitions, and the questions it answers
+
+    cd beagle-bone-black/software && python -m unittest discover -s tests
+"""
+
+import os, sys, shutil, tempfile, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        ".."))
+
+import state_journal
+from state_journal import StateJournal, badge_hash
+
+class StateJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "states.ring")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def fill(self, journal, count, start=1000.0):
+        """
+        count transitions a second apart, each to "state<number>"
+        """
+        for number in range(count):
+            journal.record(number, start + number, "state" + str(number % 3),
+                    "source" + str(number), str(number), .001)
+
+    def test_records(self):
+        journal = StateJournal(self.filename, capacity=8, index_every=4)
+        self.assertEqual(list(journal.records()), [])
+        self.fill(journal, 5)
+        records = list(journal.records())
+        self.assertEqual([record["sequence"] for record in records],
+                range(5))
+        self.assertEqual(records[4]["state"], "state1")
+        self.assertEqual(records[4]["from"], "source4")
+        self.assertEqual(records[4]["badge"], badge_hash("4"))
+        self.assertEqual(records[4]["time"], 1004.0)
+
+    def test_wraps_around(self):
+        journal = StateJournal(self.filename, capacity=8, index_every=4)
+        self.fill(journal, 21)
+        self.assertEqual(journal.next_sequence(), 21)
+        records = list(journal.records())
+        self.assertEqual([record["sequence"] for record in records],
+                range(13, 21))
+        self.assertEqual([record["time"] for record in records],
+                [1000.0 + number for number in range(13, 21)])
+
+    def test_capacity_rounded_up_to_the_index(self):
+        journal = StateJournal(self.filename, capacity=10, index_every=4)
+        self.assertEqual(journal.capacity, 12)
+
+    def test_since_and_until(self):
+        journal = StateJournal(self.filename, capacity=8, index_every=4)
+        self.fill(journal, 21)
+        self.assertEqual([record["sequence"]
+                for record in journal.records(since=1015.5)],
+                range(16, 21))
+        self.assertEqual([record["sequence"]
+                for record in journal.records(since=1015, until=1017)],
+                [15, 16, 17])
+
+        #
+        # since before the oldest record that is left
+        #
+        self.assertEqual([record["sequence"]
+                for record in journal.records(since=0)], range(13, 21))
+        self.assertEqual(list(journal.records(since=2000)), [])
+
+    def test_reopened(self):
+        journal = StateJournal(self.filename, capacity=8, index_every=4)
+        self.fill(journal, 10)
+        journal.close()
+        reader = StateJournal(self.filename, writable=False)
+        self.assertEqual([record["sequence"] for record in reader.records()],
+                range(2, 10))
+        self.assertEqual(reader.state_names, ["state0", "state1", "state2"])
+        reader.close()
+
+        journal = StateJournal(self.filename, capacity=1000)
+        self.assertEqual(journal.capacity, 8)
+        self.fill(journal, 1, start=2000.0)
+        self.assertEqual(journal.next_sequence(), 11)
+
+    def test_long_source(self):
+        journal = StateJournal(self.filename, capacity=8, index_every=4)
+        journal.record(0, 1000.0, "active", "HardcodedRFIDs.run(), and more")
+        self.assertEqual(list(journal.records())[0]["from"],
+                "HardcodedRFIDs.r")
+
+    def test_not_a_journal(self):
+        with open(self.filename, "wb") as broken:
+            broken.write("x" * state_journal.HEADER_SIZE)
+        self.assertRaises(ValueError, StateJournal, self.filename)
+
+class QueriesTest(unittest.TestCase):
+    def record(self, seconds, state, badge=0):
+        return {"monotonic": seconds, "time": 1000.0 + seconds,
+                "state": state, "badge": badge}
+
+    def test_sessions_per_badge(self):
+        records = [
+            self.record(0, "inactive"),
+            self.record(1, "check_badge", 1),
+            self.record(2, "active", 1),
+            self.record(3, "inactive_soon", 1),
+            self.record(4, "active", 1),
+            self.record(5, "check_badge", 1),
+            self.record(6, "active", 1),
+            self.record(7, "inactive"),
+            self.record(8, "active", 2),
+            self.record(9, "inactive"),
+            self.record(10, "active", 1)]
+        self.assertEqual(state_journal.sessions_per_badge(records),
+                {1: 2, 2: 1})
+
+    def test_denials_per_hour(self):
+        records = [
+            self.record(0, "login_denied"),
+            self.record(10, "login_denied"),
+            self.record(3600, "login_denied"),
+            self.record(3601, "active")]
+        self.assertEqual(state_journal.denials_per_hour(records),
+                {0: 2, 3600: 1})
+
+    def test_time_in_error(self):
+        records = [
+            self.record(0, "error:network"),
+            self.record(5, "check_badge"),
+            self.record(10, "inactive"),
+            self.record(20, "error:maintenance"),
+            self.record(50, "error:network"),
+            self.record(51, "inactive")]
+        self.assertEqual(state_journal.time_in_error(records),
+                {"error:network": 11, "error:maintenance": 30})
+
+    def test_time_in_error_across_a_reboot(self):
+        records = [self.record(100, "error:network"),
+                dict(self.record(2, "inactive"), time=1130.0)]
+        self.assertEqual(state_journal.time_in_error(records),
+                {"error:network": 30})
+
+if __name__ == "__main__":
+    unittest.main()
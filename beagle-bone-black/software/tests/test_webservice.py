@@ -0,0 +1,346 @@
+#! /usr/bin/python
+
+"""
+the circuit breaker, the cache of grants, querying the endpoints and
+matching their replies to a state, with the webservice faked
+
+    cd beagle-bone-black/software && python -m unittest discover -s tests
+"""
+
+import os, sys, time, json, Queue, logging, threading, unittest, urllib2
+import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        ".."))
+
+import rfid_interlock
+from rfid_interlock import CircuitBreaker, GrantCache, ActionMessage, \
+        MessageTypes, fetch_endpoints, required_errors, match_state, \
+        read_endpoints
+
+#
+# the failures that the webservice logs are expected here
+#
+logging.getLogger().addHandler(logging.NullHandler())
+
+class FakeURLs(object):
+    """
+    stands in for urllib2: replies maps each url to the JSON text it returns,
+    or to the exception it raises, and delays to how long it takes
+    """
+    HTTPError = urllib2.HTTPError
+    URLError = urllib2.URLError
+
+    def __init__(self, replies=None, delays=None):
+        self.replies = replies or {}
+        self.delays = delays or {}
+        self.opened = []
+
+    def urlopen(self, url, timeout=None):
+        self.opened.append(url)
+        time.sleep(self.delays.get(url, 0))
+        reply = self.replies.get(url,
+                urllib2.URLError("no such url: " + url))
+        if isinstance(reply, Exception):
+            raise reply
+        return StringIO.StringIO(reply + "\n")
+
+class FakeWebservice(unittest.TestCase):
+    """
+    puts a FakeURLs in place of urllib2 for the test
+    """
+    def setUp(self):
+        self.real_urllib2 = rfid_interlock.urllib2
+        self.urls = FakeURLs()
+        rfid_interlock.urllib2 = self.urls
+
+    def tearDown(self):
+        rfid_interlock.urllib2 = self.real_urllib2
+
+class CircuitBreakerTest(unittest.TestCase):
+    def test_closed(self):
+        breaker = CircuitBreaker(failures=2, open_seconds=60)
+        self.assertEqual(breaker.allow(), (True, CircuitBreaker.CLOSED))
+        breaker.failed()
+        self.assertEqual(breaker.allow(), (True, CircuitBreaker.CLOSED))
+        breaker.succeeded()
+        breaker.failed()
+        self.assertEqual(breaker.allow(), (True, CircuitBreaker.CLOSED))
+
+    def test_opens_after_failures_in_a_row(self):
+        breaker = CircuitBreaker(failures=2, open_seconds=60)
+        breaker.failed()
+        breaker.failed()
+        self.assertEqual(breaker.allow(), (False, CircuitBreaker.OPEN))
+
+    def test_one_probe_when_half_open(self):
+        breaker = CircuitBreaker(failures=1, open_seconds=.05)
+        breaker.failed()
+        self.assertEqual(breaker.allow(), (False, CircuitBreaker.OPEN))
+        time.sleep(.06)
+        self.assertEqual(breaker.allow(), (True, CircuitBreaker.HALF_OPEN))
+        self.assertEqual(breaker.allow(), (False, CircuitBreaker.HALF_OPEN))
+
+    def test_probe_fails(self):
+        breaker = CircuitBreaker(failures=3, open_seconds=.05)
+        for number in range(3):
+            breaker.failed()
+        time.sleep(.06)
+        self.assertTrue(breaker.allow()[0])
+        breaker.failed()
+        self.assertEqual(breaker.allow(), (False, CircuitBreaker.OPEN))
+        time.sleep(.06)
+        self.assertTrue(breaker.allow()[0])
+
+    def test_probe_succeeds(self):
+        breaker = CircuitBreaker(failures=1, open_seconds=.05)
+        breaker.failed()
+        time.sleep(.06)
+        self.assertTrue(breaker.allow()[0])
+        breaker.succeeded()
+        self.assertEqual(breaker.allow(), (True, CircuitBreaker.CLOSED))
+        self.assertEqual(breaker.failures, 0)
+
+class GrantCacheTest(unittest.TestCase):
+    def test_remember(self):
+        grants = GrantCache()
+        self.assertEqual(grants.get("1", "123", 60), None)
+        grants.remember("1", "123", "active", True)
+        self.assertEqual(grants.get("1", "123", 60), "active")
+        self.assertEqual(grants.get("2", "123", 60), None)
+        self.assertEqual(grants.get("1", "124", 60), None)
+
+    def test_forget_what_was_not_granted(self):
+        grants = GrantCache()
+        grants.remember("1", "123", "active", True)
+        grants.remember("1", "123", "login_denied", False)
+        self.assertEqual(grants.get("1", "123", 60), None)
+
+    def test_grace(self):
+        grants = GrantCache()
+        grants.remember("1", "123", "active", True)
+        time.sleep(.02)
+        self.assertEqual(grants.get("1", "123", .01), None)
+
+        #
+        # and it is gone for good
+        #
+        self.assertEqual(grants.get("1", "123", 60), None)
+
+class WebServiceConnectionTest(FakeWebservice):
+    """
+    a webservice whose breaker opens after one failure, and which lets
+    recently granted badges in for a minute while it is open
+    """
+    url = "http://makermanager/?badge={badge_id}&tool={tool_id}"
+
+    def setUp(self):
+        FakeWebservice.setUp(self)
+        config = {"tool_id": "1", "timeout": 20, "warning": 3,
+            "ws": {"type": "webservice:connection", "timeout": 1,
+                "grace_seconds": 60,
+                "circuit_breaker": {"failures": 1, "open_seconds": .1},
+                "check_badge": {"url": unicode(self.url),
+                    "active:when": {"authorized": True},
+                    "login_denied:when": {"authorized": False}}}}
+        self.interlock = rfid_interlock.Interlock(config,
+                rfid_interlock.ErrorArrayHandler())
+        self.ws = self.interlock.connections[0]
+
+    def reply(self, badge_id, reply):
+        self.urls.replies[self.url.format(badge_id=badge_id, tool_id="1")] = \
+                reply if isinstance(reply, Exception) else json.dumps(reply)
+
+    def swipe(self, badge_id):
+        """
+        the state, and where it came from, that a swipe of badge_id leads to
+        """
+        self.ws.update(ActionMessage(MessageTypes.CHECK_BADGE, "test",
+                badge_id))
+        message = self.interlock.action_queue.get(timeout=5)
+        return message.state, message.source
+
+    def test_granted(self):
+        self.reply("123", {"authorized": True})
+        self.assertEqual(self.swipe("123"),
+                ("active", "ConnectionWebservice.run()"))
+        self.reply("124", {"authorized": False})
+        self.assertEqual(self.swipe("124")[0], "login_denied")
+        self.assertEqual(self.ws.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_cached_grant_while_down(self):
+        self.reply("123", {"authorized": True})
+        self.swipe("123")
+        self.reply("123", urllib2.URLError("down"))
+        self.assertEqual(self.swipe("123"),
+                ("active", "WebServiceConnection.run() cached grant"))
+        self.assertEqual(self.ws.breaker.state, CircuitBreaker.OPEN)
+
+        #
+        # while the breaker is open the webservice is not even asked
+        #
+        opened = len(self.urls.opened)
+        self.assertEqual(self.swipe("123")[0], "active")
+        self.assertEqual(self.swipe("124")[0], MessageTypes.ERROR_NETWORK)
+        self.assertEqual(len(self.urls.opened), opened)
+
+    def test_probe_revokes_the_grant(self):
+        self.reply("123", {"authorized": True})
+        self.swipe("123")
+        self.reply("123", urllib2.URLError("down"))
+        self.swipe("123")
+
+        #
+        # the probe is waited for, rather than the cached grant used
+        #
+        time.sleep(.15)
+        self.reply("123", {"authorized": False})
+        self.assertEqual(self.swipe("123"),
+                ("login_denied", "ConnectionWebservice.run()"))
+        self.assertEqual(self.ws.breaker.state, CircuitBreaker.CLOSED)
+
+        self.reply("123", urllib2.URLError("down"))
+        self.assertEqual(self.swipe("123")[0], MessageTypes.ERROR_NETWORK)
+
+    def test_probe_fails(self):
+        self.reply("123", urllib2.URLError("down"))
+        self.swipe("123")
+        time.sleep(.15)
+        self.assertEqual(self.swipe("123")[0], MessageTypes.ERROR_NETWORK)
+        self.assertEqual(self.ws.breaker.state, CircuitBreaker.OPEN)
+
+    def test_unexpected_exceptions_fail_the_probe(self):
+        self.reply("123", urllib2.URLError("down"))
+        self.swipe("123")
+        time.sleep(.15)
+        self.reply("123", rfid_interlock.httplib.BadStatusLine(""))
+        self.assertEqual(self.swipe("123")[0], MessageTypes.ERROR_NETWORK)
+        self.assertEqual(self.ws.breaker.state, CircuitBreaker.OPEN)
+
+        time.sleep(.15)
+        self.reply("123", RuntimeError("unexpected"))
+        self.assertEqual(self.swipe("123")[0], MessageTypes.ERROR_NETWORK)
+        self.assertEqual(self.ws.breaker.state, CircuitBreaker.OPEN)
+
+class FetchEndpointsTest(FakeWebservice):
+    def endpoints(self, config):
+        return read_endpoints(config, 1, "test: ")
+
+    def test_merge(self):
+        self.urls.replies = {
+            "http://badge/": json.dumps({"authorized": True, "name": "b"}),
+            "http://maintenance/": json.dumps({"down": False, "name": "m"}),
+            "http://default/": json.dumps({"name": "d"})
+        }
+        merged, replies, errors = fetch_endpoints(self.endpoints({
+            "url": u"http://default/",
+            "endpoints": {
+                "badge": u"http://badge/",
+                "maintenance": u"http://maintenance/"}}), {})
+        self.assertEqual(merged, {"name": "d",
+                "badge.authorized": True, "badge.name": "b",
+                "maintenance.down": False, "maintenance.name": "m"})
+        self.assertEqual(sorted(replies), ["", "badge", "maintenance"])
+        self.assertEqual(errors, {})
+
+    def test_parameters(self):
+        self.urls.replies = {"http://badge/?badge=123&tool=1": "{}"}
+        merged, replies, errors = fetch_endpoints(self.endpoints({
+            "url": u"http://badge/?badge={badge_id}&tool={tool_id}"}),
+            {"badge_id": "123", "tool_id": "1"})
+        self.assertEqual(errors, {})
+        merged, replies, errors = fetch_endpoints(self.endpoints({
+            "url": u"http://badge/?badge={badge_id}&tool={tool_id}"}),
+            {"tool_id": "1"})
+        self.assertEqual(list(errors), [""])
+        self.assertIn("without", errors[""])
+
+    def test_partial_failure(self):
+        self.urls.replies = {
+            "http://badge/": json.dumps({"authorized": True}),
+            "http://maintenance/": "not json",
+            "http://news/": urllib2.URLError("down"),
+            "http://status/": rfid_interlock.httplib.BadStatusLine("")
+        }
+        endpoints = self.endpoints({"endpoints": {
+            "badge": u"http://badge/",
+            "maintenance": u"http://maintenance/",
+            "news": {"url": u"http://news/", "optional": True},
+            "status": u"http://status/",
+            "bad": u"not a url"}})
+        merged, replies, errors = fetch_endpoints(endpoints, {})
+        self.assertEqual(merged, {"badge.authorized": True})
+        self.assertEqual(sorted(errors),
+                ["bad", "maintenance", "news", "status"])
+        self.assertIn("(JSON)", errors["maintenance"])
+        self.assertIn("(HTTP)", errors["status"])
+        self.assertIn("(URL)", errors["news"])
+        self.assertEqual(sorted(required_errors(endpoints, errors)),
+                ["bad", "maintenance", "status"])
+
+    def test_timeout(self):
+        self.urls.replies = {
+            "http://fast/": json.dumps({"ok": True}),
+            "http://slow/": json.dumps({"ok": True})}
+        self.urls.delays = {"http://slow/": 1.5}
+        merged, replies, errors = fetch_endpoints(self.endpoints({
+            "endpoints": {
+                "fast": u"http://fast/",
+                "slow": {"url": u"http://slow/", "timeout": .1}}}), {})
+        self.assertEqual(merged, {"fast.ok": True})
+        self.assertIn("(timeout)", errors["slow"])
+
+        #
+        # the thread that was given up on cannot change what was returned
+        #
+        time.sleep(.5)
+        self.assertEqual(merged, {"fast.ok": True})
+        self.assertEqual(list(replies), ["fast"])
+
+    def test_optional_must_be_true_or_false(self):
+        self.assertEqual(self.endpoints({"endpoints": {
+            "news": {"url": u"http://news/", "optional": "yes"}}}), None)
+
+class MatchStateTest(unittest.TestCase):
+    config = {
+        "active:when": {"badge.authorized": True, "maintenance.down": False},
+        "login_denied:when": {"badge.authorized": False},
+        "error:maintenance:when": {"maintenance.down": True}
+    }
+
+    def test_most_conditions_win(self):
+        self.assertEqual(match_state(self.config,
+                {"badge.authorized": True, "maintenance.down": False}),
+                "active")
+        self.assertEqual(match_state(self.config,
+                {"badge.authorized": False, "maintenance.down": False}),
+                "login_denied")
+
+    def test_no_match(self):
+        self.assertEqual(match_state(self.config, {}), None)
+        self.assertEqual(match_state(self.config,
+                {"badge.authorized": True}), None)
+
+    def test_error_wins_a_tie(self):
+        self.assertEqual(match_state(self.config,
+                {"badge.authorized": False, "maintenance.down": True}),
+                "error:maintenance")
+
+    def test_tie_without_an_error(self):
+        config = {
+            "active:when": {"authorized": True},
+            "login_denied:when": {"expired": True}
+        }
+        self.assertEqual(match_state(config,
+                {"authorized": True, "expired": True}), None)
+
+    def test_tie_between_errors(self):
+        config = {
+            "error:maintenance:when": {"down": True},
+            "error:network:when": {"reachable": False}
+        }
+        self.assertEqual(match_state(config,
+                {"down": True, "reachable": False}), None)
+
+if __name__ == "__main__":
+    unittest.main()